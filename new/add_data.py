@@ -1,5 +1,6 @@
 import sqlite3
 
+from database import bump_data_version, make_vehicle_id
 
 DB_PATH = 'tracking.db'
 
@@ -34,7 +35,7 @@ def populate_data(routes_data, waypoints_data, vehicles_to_populate):
     for item in vehicles_to_populate:
         plate, v_type, region, seats, route_name, service = item["vd"]
         route_id = route_ids[route_name]
-        vehicle_id = f"{region[:2].upper()}-{v_type.upper()}-{plate[-4:]}"
+        vehicle_id = make_vehicle_id(region, v_type, plate)
         
         last_idx, last_lat, last_lon, direction = 0, None, None, 'forward'
         
@@ -49,6 +50,7 @@ def populate_data(routes_data, waypoints_data, vehicles_to_populate):
             (vehicle_id, license_plate, vehicle_type, region, seats, service_type, current_route_id, last_segment_index, last_known_lat, last_known_lon, direction)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """, (vehicle_id, plate, v_type, region, seats, service, route_id, last_idx, last_lat, last_lon, direction))
+    bump_data_version(cursor, 'routes')
     conn.commit()
 
 
@@ -73,13 +75,14 @@ def register_vehicle(license_plate, vehicle_type, region, seats, route_name, ser
         return {"success": False, "message": f"Route '{route_name}' not found."}
     
     route_id = route_result[0]
-    vehicle_id = f"{region[:2].upper()}-{vehicle_type.upper()}-{license_plate[-4:]}"
+    vehicle_id = make_vehicle_id(region, vehicle_type, license_plate)
 
     try:
         cursor.execute("""
             INSERT INTO vehicles (vehicle_id, license_plate, vehicle_type, region, seats, service_type, current_route_id, last_segment_index)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?)
         """, (vehicle_id, license_plate, vehicle_type, region, seats, service_type, route_id, 0))
+        bump_data_version(cursor, 'routes')
         conn.commit()
         conn.close()
         return {"success": True, "vehicle_id": vehicle_id}
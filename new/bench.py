@@ -0,0 +1,189 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+from datetime import datetime, timezone
+from itertools import groupby
+
+import numpy as np
+
+import database
+import get_routes
+from bench_sharding import synthesize_fleet
+from metrics import metrics
+
+
+
+# end-to-end benchmark: simulator -> tracking.db -> server queries -> socket.io emitter
+#   python bench.py --routes 40 --vehicles 500 --duration 1800 --clients 50
+# everything runs in a scratch directory with its own tracking.db and offline
+# routing. the simulation runs on a VirtualClock for `duration` simulated
+# seconds, then the server side is driven in-process: stop lookups through
+# get_vehicles_data_by_waypoint, and the emitter with `clients` socket.io test
+# clients, replaying the recorded gps packets the way the event bus would feed
+# them. prints one JSON report
+
+
+
+def percentiles(values, scale=1.0):
+    if not values:
+        return {"n": 0}
+    arr = np.asarray(values, dtype=np.float64) * scale
+    return {
+        "n": len(arr),
+        "p50": round(float(np.percentile(arr, 50)), 3),
+        "p99": round(float(np.percentile(arr, 99)), 3),
+        "max": round(float(arr.max()), 3),
+        "mean": round(float(arr.mean()), 3),
+    }
+
+
+
+def run_simulation(engine, duration, seed):
+    import simulation
+    from sim_clock import VirtualClock
+
+    clock = VirtualClock(start=datetime(2024, 1, 1, 6, 0, tzinfo=timezone.utc))
+    started = time.perf_counter()
+    summary = asyncio.run(simulation.main(engine=engine, clock=clock, seed=seed, duration=duration))
+    wall = time.perf_counter() - started
+
+    writer = summary["gps_writer"]
+    write_seconds = metrics.timers["gps_write_batch"][-2] if "gps_write_batch" in metrics.timers else 0.0
+    return {
+        "engine": engine,
+        "vehicles": summary["vehicles"],
+        "simulated_seconds": duration,
+        "wall_seconds": round(wall, 3),
+        "vehicle_ticks": summary["vehicle_ticks"],
+        "ticks_per_sec": round(summary["vehicle_ticks"] / wall) if wall else None,
+        "rows_written": writer["rows_written"],
+        "flushes": writer["flushes"],
+        "db_rows_per_sec": round(writer["rows_written"] / wall) if wall else None,
+        "db_rows_per_write_sec": round(writer["rows_written"] / write_seconds) if write_seconds else None,
+        "max_flush_ms": writer["max_flush_ms"],
+        "compacted_points": summary["history"]["points_in"],
+        "route_memory": summary["routes"],
+    }
+
+
+
+def bench_queries(lookup, stop_names, repeats):
+    latencies = []
+    for _ in range(repeats):
+        for name in stop_names:
+            started = time.perf_counter()
+            lookup(name)
+            latencies.append(time.perf_counter() - started)
+    return percentiles(latencies, scale=1000)
+
+
+
+def recorded_ticks(server, max_cycles):
+    # the hot table's packets grouped by timestamp second, in bus packet shape
+    rows = server.db_read("""
+        SELECT vehicle_id, timestamp, latitude, longitude, speed_kmh, heading, status, gps_status
+        FROM live_gps_positions ORDER BY timestamp
+    """, label="bench_replay")
+    ticks = [
+        [{
+            'vehicle_id': r['vehicle_id'], 'timestamp': r['timestamp'],
+            'location': {'lat': r['latitude'], 'lon': r['longitude']},
+            'speed_kmh': r['speed_kmh'], 'heading': r['heading'], 'status': r['status'], 'gps_status': r['gps_status'],
+        } for r in group]
+        for _, group in groupby(rows, key=lambda r: r['timestamp'][:19])
+    ]
+    return ticks[-max_cycles:]
+
+
+
+def bench_emitter(server, stop_names, n_clients, max_cycles, rng):
+    server.eta_feed.poll()
+    server.waypoint_route_index.refresh()
+    server.live_state.load()
+
+    clients = []
+    for _ in range(n_clients):
+        client = server.socketio.test_client(server.app)
+        client.emit('subscribe', {'stops': rng.sample(stop_names, min(len(stop_names), rng.randint(1, 3)))})
+        clients.append(client)
+
+    cycle_times = []
+    for packets in recorded_ticks(server, max_cycles):
+        for packet in packets:
+            server.live_state.on_message("gps", packet)
+        dirty = server.live_state.take_dirty_routes()
+        active = server.rooms.active_rooms()
+        touched = [room for room, route_ids in server._routes_of_rooms(active).items() if route_ids & dirty]
+        started = time.perf_counter()
+        if touched:
+            server.push_room_updates(touched)
+        cycle_times.append(time.perf_counter() - started)
+
+    n_rooms = len(server.rooms.members)
+    sizes = {}
+    for client in clients:
+        for message in client.get_received():
+            sizes.setdefault(message['name'], []).append(len(json.dumps(message['args'])))
+        client.disconnect()
+
+    return {
+        "clients": n_clients,
+        "rooms": n_rooms,
+        "cycles": len(cycle_times),
+        "cycle_ms": percentiles(cycle_times, scale=1000),
+        "payload_bytes": {
+            name: {**percentiles(values), "total": sum(values)} for name, values in sorted(sizes.items())
+        },
+    }
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end simulator/server benchmark on a synthetic fleet")
+    parser.add_argument("--routes", type=int, default=40)
+    parser.add_argument("--vehicles", type=int, default=500)
+    parser.add_argument("--duration", type=float, default=1800, help="simulated seconds")
+    parser.add_argument("--engine", choices=["tasks", "vectorized"], default="tasks")
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--query-repeats", type=int, default=20)
+    parser.add_argument("--emitter-cycles", type=int, default=300, help="most recent simulated seconds to replay")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    os.chdir(workdir)
+    try:
+        get_routes.set_provider(get_routes.SyntheticProvider())
+        database.create_database_schema()
+        synthesize_fleet(database.DB_PATH, args.routes, args.vehicles, seed=args.seed)
+
+        report = {"routes": args.routes, "simulation": run_simulation(args.engine, args.duration, args.seed)}
+
+        # imported after the simulation: the server module sets up flask/gevent state on import
+        import server
+        stop_names = sorted({row['waypoint_name'] for row in server.db_read(
+            "SELECT waypoint_name FROM waypoints WHERE waypoint_type != 'start'", label="bench_stops")})
+        rng = random.Random(args.seed)
+        # the query itself, then what clients see through query_cache (mostly hits within a tick)
+        report["queries"] = {
+            "get_vehicles_data_by_waypoints_ms": bench_queries(
+                lambda name: server.get_vehicles_data_by_waypoints([name]), stop_names, args.query_repeats),
+            "cached_get_vehicles_data_by_waypoint_ms": bench_queries(
+                server.get_vehicles_data_by_waypoint, stop_names, args.query_repeats),
+        }
+        report["emitter"] = bench_emitter(server, stop_names, args.clients, args.emitter_cycles, rng)
+        report["query_cache"] = dict(server.query_cache.stats)
+        report["db"] = server.get_db(server.DB_PATH).metrics()
+    finally:
+        if args.keep:
+            print(f"scratch directory kept at {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(report, indent=2))
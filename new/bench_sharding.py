@@ -0,0 +1,103 @@
+import argparse
+import json
+import multiprocessing as mp
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+
+import database
+import get_routes
+
+
+
+# throughput of sharding.Coordinator at 1, 2, 4, ... shards on a synthetic fleet
+#   python bench_sharding.py --vehicles 4000 --duration 15
+# runs in a scratch directory with its own tracking.db, offline routing and no
+# database writes, so it measures simulation CPU scaling only
+
+
+
+def synthesize_fleet(db_path, n_routes, n_vehicles, seed=1):
+    rng = random.Random(seed)
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    for r in range(n_routes):
+        cursor.execute("INSERT INTO routes (route_name) VALUES (?)", (f"Synthetic {r}",))
+        route_id = cursor.lastrowid
+        lat, lon = 30.5 + rng.uniform(0, 1.5), 74.5 + rng.uniform(0, 1.5)
+        n_stops = rng.randint(4, 8)
+        for seq in range(1, n_stops + 1):
+            wp_type = 'start' if seq == 1 else 'end' if seq == n_stops else 'stop'
+            major = 1 if wp_type != 'stop' else 0
+            cursor.execute("""
+                INSERT INTO waypoints (route_id, sequence, waypoint_name, is_major_stop, is_skippable, latitude, longitude, waypoint_type)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (route_id, seq, f"Stop {r}-{seq}", major, int(not major and rng.random() < 0.4), lat, lon, wp_type))
+            lat += rng.uniform(0.03, 0.08)
+            lon += rng.uniform(-0.05, 0.05)
+
+    cursor.executemany("""
+        INSERT INTO vehicles (vehicle_id, license_plate, vehicle_type, region, seats, service_type, current_route_id, direction)
+        VALUES (?, ?, 'Bus', 'Punjab', 52, ?, ?, ?)
+    """, [
+        (f"PU-BUS-{i:06d}", f"PB{i:08d}", rng.choice(['Local', 'Express']),
+         rng.randint(1, n_routes), rng.choice(['forward', 'backward']))
+        for i in range(n_vehicles)
+    ])
+    conn.commit()
+    conn.close()
+
+
+
+def run(shard_counts, duration, engine, update_interval):
+    from sharding import Coordinator
+    from simulation import get_vehicles_for_simulation
+
+    vehicles = get_vehicles_for_simulation()
+    results = []
+    for shards in shard_counts:
+        coordinator = Coordinator(shards, by="route", engine=engine, write_db=False, event_bus_address=None,
+                                  update_interval=update_interval, report_interval=1)
+        totals = coordinator.run(vehicles, duration=duration, report_interval=1)
+        results.append({"shards": shards, "ticks_per_sec": totals["ticks_per_sec"]})
+
+    base = results[0]["ticks_per_sec"] or 1.0
+    for r in results:
+        r["speedup"] = round(r["ticks_per_sec"] / base, 2)
+        r["efficiency"] = round(r["speedup"] / (r["shards"] / results[0]["shards"]), 2)
+    return results
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--routes", type=int, default=40)
+    parser.add_argument("--vehicles", type=int, default=2000)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--engine", choices=["tasks", "vectorized"], default="tasks")
+    parser.add_argument("--update-interval", type=float, default=0.001,
+                        help="tiny interval keeps every shard CPU-bound")
+    parser.add_argument("--max-shards", type=int, default=mp.cpu_count())
+    args = parser.parse_args()
+
+    shard_counts = [1]
+    while shard_counts[-1] * 2 <= args.max_shards:
+        shard_counts.append(shard_counts[-1] * 2)
+
+    workdir = tempfile.mkdtemp(prefix="bench_sharding_")
+    os.chdir(workdir)
+    # set_provider covers this process; shards started with spawn/forkserver re-import
+    # get_routes and pick the provider from the environment instead
+    os.environ["ROUTE_PROVIDER"] = "synthetic"
+    get_routes.set_provider(get_routes.SyntheticProvider())
+    try:
+        database.create_database_schema()
+        synthesize_fleet(database.DB_PATH, args.routes, args.vehicles)
+        results = run(shard_counts, args.duration, args.engine, args.update_interval)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(json.dumps({"cpu_count": mp.cpu_count(), "vehicles": args.vehicles, "engine": args.engine,
+                      "results": results}, indent=2))
@@ -0,0 +1,76 @@
+import random
+import time
+
+from geopy.distance import geodesic
+
+from route_geometry import RouteGeometry
+
+
+
+# compares the old per-point geodesic min() scan from build_full_route
+# against RouteGeometry.nearest_indices on a synthetic route
+#   python bench_snapping.py
+
+
+
+def synthetic_route(n_points, start=(30.896345, 75.845206), seed=42):
+    rng = random.Random(seed)
+    lat, lon = start
+    coords = []
+    for _ in range(n_points):
+        lat += rng.uniform(0.0, 0.0002)
+        lon += rng.uniform(-0.0002, 0.0002)
+        coords.append([lon, lat])
+    return coords
+
+
+
+def pick_stops(coords, n_stops, seed=7):
+    rng = random.Random(seed)
+    picks = sorted(rng.sample(range(len(coords)), n_stops))
+    # nudge each stop off the line a little, like a real bus stand would be
+    return [(coords[i][1] + 0.00005, coords[i][0] - 0.00005) for i in picks]
+
+
+
+def snap_old(coords, stops):
+    return [
+        min(range(len(coords)), key=lambda i: geodesic((lat, lon), (coords[i][1], coords[i][0])).m)
+        for lat, lon in stops
+    ]
+
+
+
+def snap_new(coords, stops):
+    geometry = RouteGeometry.from_api_coords(coords)
+    return geometry.nearest_indices([s[0] for s in stops], [s[1] for s in stops]).tolist()
+
+
+
+def timed(fn, *args, repeat=1):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+
+def main(n_points=10_000, n_stops=6):
+    coords = synthetic_route(n_points)
+    stops = pick_stops(coords, n_stops)
+
+    old_s, old_idx = timed(snap_old, coords, stops)
+    new_s, new_idx = timed(snap_new, coords, stops, repeat=5)
+
+    print(f"route points: {n_points}, stops: {n_stops}")
+    print(f"geodesic min() scan : {old_s * 1000:10.1f} ms")
+    print(f"vectorized haversine: {new_s * 1000:10.2f} ms")
+    print(f"speedup             : {old_s / new_s:10.0f}x")
+    print(f"same indices        : {old_idx == new_idx}")
+
+
+
+if __name__ == "__main__":
+    main()
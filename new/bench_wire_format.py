@@ -0,0 +1,113 @@
+import argparse
+import json
+import random
+import time
+
+from subscriptions import RoomRegistry, stop_room
+from wire_format import Decoder, Encoder, pack_records
+
+
+
+# bytes per update and encode time of the socket.io room payloads, json vs the
+# binary format from wire_format.py, on a synthetic fleet spread over stop rooms
+#   python bench_wire_format.py --vehicles 5000 --rooms 50 --clients-per-room 20
+# json is encoded once per room emit (as python-socketio does); binary packs the
+# records once per room and the id indices once per connection
+
+
+
+def synthetic_fleet(n_vehicles, seed):
+    rng = random.Random(seed)
+    return [{
+        'vehicle_id': f"PU-BUS-{i:06d}",
+        'latitude': 30.5 + rng.uniform(0, 1.5),
+        'longitude': 74.5 + rng.uniform(0, 1.5),
+        'heading': rng.uniform(0, 360),
+        'speed_kmh': rng.uniform(30, 60),
+        'status': 'moving',
+        'gps_status': 'functional',
+    } for i in range(n_vehicles)]
+
+
+
+def move(fleet, fraction, rng):
+    for v in fleet:
+        if rng.random() < fraction:
+            v['latitude'] += rng.uniform(-0.0003, 0.0003)
+            v['longitude'] += rng.uniform(-0.0003, 0.0003)
+            v['heading'] = (v['heading'] + rng.uniform(-20, 20)) % 360
+            v['status'] = 'stopped' if rng.random() < 0.1 else 'moving'
+
+
+
+def run(n_vehicles, n_rooms, clients_per_room, cycles, moving_fraction, seed):
+    rng = random.Random(seed)
+    fleet = synthetic_fleet(n_vehicles, seed)
+    rooms = [stop_room(f"Stop {r}") for r in range(n_rooms)]
+    vehicles_of = {room: [v for i, v in enumerate(fleet) if i % n_rooms == r] for r, room in enumerate(rooms)}
+    registry = RoomRegistry()
+    encoders = {room: [Encoder() for _ in range(clients_per_room)] for room in rooms}
+    decoder = Decoder()
+
+    totals = {fmt: {"bytes": 0, "rows": 0, "seconds": 0.0, "frames": 0} for fmt in ("json", "binary")}
+    first = {}
+    for cycle in range(cycles + 1):
+        if cycle:
+            move(fleet, moving_fraction, rng)
+        for room in rooms:
+            payload = registry.update(room, vehicles_of[room])
+            if payload is None:
+                continue
+            event = "snapshot" if cycle == 0 else "delta"
+
+            started = time.perf_counter()
+            encoded = json.dumps(payload, separators=(",", ":")).encode()
+            json_seconds = time.perf_counter() - started
+
+            started = time.perf_counter()
+            records = pack_records(payload["u"])
+            frames = [encoder.encode(event, payload, records) for encoder in encoders[room]]
+            binary_seconds = time.perf_counter() - started
+
+            if cycle <= 1 and room == rooms[0]:
+                # round trip check on one connection's frames
+                decoded = decoder.decode(frames[0])[1]["u"]
+                assert [row[:3] for row in decoded] == [list(row[:3]) for row in payload["u"]]
+
+            for fmt, size, seconds in (("json", len(encoded), json_seconds), ("binary", len(frames[-1]), binary_seconds)):
+                if cycle == 0:
+                    first[fmt] = first.get(fmt, 0) + size * clients_per_room
+                    continue
+                t = totals[fmt]
+                t["bytes"] += size * clients_per_room
+                t["rows"] += len(payload["u"]) * clients_per_room
+                t["seconds"] += seconds
+                t["frames"] += clients_per_room
+
+    report = {}
+    for fmt, t in totals.items():
+        report[fmt] = {
+            "snapshot_bytes": first.get(fmt, 0),
+            "delta_bytes": t["bytes"],
+            "bytes_per_update": round(t["bytes"] / t["rows"], 2) if t["rows"] else None,
+            "encode_us_per_update": round(t["seconds"] * 1e6 / (t["rows"] / clients_per_room), 3) if t["rows"] else None,
+            "encode_ms_per_cycle": round(t["seconds"] * 1000 / cycles, 3),
+        }
+    report["binary_vs_json_bytes"] = round(report["binary"]["delta_bytes"] / report["json"]["delta_bytes"], 3)
+    return report
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vehicles", type=int, default=5000)
+    parser.add_argument("--rooms", type=int, default=50)
+    parser.add_argument("--clients-per-room", type=int, default=20)
+    parser.add_argument("--cycles", type=int, default=20)
+    parser.add_argument("--moving-fraction", type=float, default=0.8)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    report = run(args.vehicles, args.rooms, args.clients_per_room, args.cycles, args.moving_fraction, args.seed)
+    print(json.dumps({"vehicles": args.vehicles, "rooms": args.rooms, "clients_per_room": args.clients_per_room,
+                      **report}, indent=2))
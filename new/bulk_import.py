@@ -0,0 +1,199 @@
+import argparse
+import csv
+import itertools
+import sqlite3
+import time
+
+from database import DB_PATH, SECONDARY_INDEXES, bump_data_version, make_vehicle_id
+
+
+
+# streaming fleet onboarding, e.g.
+#   python bulk_import.py --waypoints waypoints.csv --vehicles vehicles.csv
+# waypoints.csv  route_name,sequence,waypoint_name,is_major_stop,is_skippable,latitude,longitude,waypoint_type
+# vehicles.csv   license_plate,vehicle_type,region,seats,route_name,service_type[,init_waypoint,init_direction]
+# (the same fields add_data.populate_data takes). routes are created from the
+# waypoint rows. everything goes in as one transaction with the secondary indexes
+# on the loaded tables dropped and rebuilt at the end; existing rows are kept
+# (INSERT OR IGNORE), as in populate_data
+
+LOAD_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=OFF",         # one commit at the end; a crash just means re-running the import
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-262144",      # 256 MB page cache for the index rebuilds
+)
+
+CHUNK_SIZE = 5000
+
+
+
+
+def read_chunks(path, chunk_size=CHUNK_SIZE):
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = csv.DictReader(f)
+        while True:
+            chunk = list(itertools.islice(reader, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+
+
+def _flag(value):
+    return 1 if str(value).strip().lower() in ("1", "true", "yes", "y") else 0
+
+
+
+
+class BulkImporter:
+
+    def __init__(self, db_path=DB_PATH, chunk_size=CHUNK_SIZE):
+        self.db_path = db_path
+        self.chunk_size = chunk_size
+        self.route_ids = {}
+        self.stats = {}
+
+
+    def _count(self, table, key, value=1):
+        self.stats.setdefault(table, {"read": 0, "inserted": 0, "ignored": 0, "rejected": 0, "seconds": 0.0})[key] += value
+
+
+    def _insert(self, cursor, table, sql, rows):
+        before = cursor.connection.total_changes
+        cursor.executemany(sql, rows)
+        inserted = cursor.connection.total_changes - before
+        self._count(table, "inserted", inserted)
+        self._count(table, "ignored", len(rows) - inserted)
+
+
+    def _ensure_routes(self, cursor, names):
+        missing = sorted({n for n in names if n not in self.route_ids})
+        if not missing:
+            return
+        self._insert(cursor, "routes", "INSERT OR IGNORE INTO routes (route_name) VALUES (?)", [(n,) for n in missing])
+        for start in range(0, len(missing), 500):
+            batch = missing[start:start + 500]
+            cursor.execute(
+                f"SELECT route_name, route_id FROM routes WHERE route_name IN ({','.join('?' * len(batch))})", batch
+            )
+            self.route_ids.update(cursor.fetchall())
+
+
+    def load_waypoints(self, cursor, path):
+        started = time.perf_counter()
+        for chunk in read_chunks(path, self.chunk_size):
+            self._count("waypoints", "read", len(chunk))
+            self._ensure_routes(cursor, (row['route_name'] for row in chunk))
+            rows = [
+                (self.route_ids[row['route_name']], int(row['sequence']), row['waypoint_name'],
+                 _flag(row['is_major_stop']), _flag(row['is_skippable']),
+                 float(row['latitude']), float(row['longitude']), row['waypoint_type'])
+                for row in chunk
+            ]
+            self._insert(cursor, "waypoints", """
+                INSERT OR IGNORE INTO waypoints (route_id, sequence, waypoint_name, is_major_stop, is_skippable, latitude, longitude, waypoint_type)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+        self._count("waypoints", "seconds", time.perf_counter() - started)
+
+
+    def load_vehicles(self, cursor, path):
+        started = time.perf_counter()
+        # one pass over waypoints for the optional starting positions, not one per chunk
+        cursor.execute("SELECT route_id, waypoint_name, sequence, latitude, longitude FROM waypoints")
+        waypoints_map = {(route_id, name): (seq - 1, lat, lon) for route_id, name, seq, lat, lon in cursor.fetchall()}
+        cursor.execute("SELECT route_name, route_id FROM routes")
+        self.route_ids.update(cursor.fetchall())
+
+        for chunk in read_chunks(path, self.chunk_size):
+            self._count("vehicles", "read", len(chunk))
+            rows = []
+            for row in chunk:
+                route_id = self.route_ids.get(row['route_name'])
+                if route_id is None:
+                    self._count("vehicles", "rejected")
+                    continue
+                plate, v_type, region = row['license_plate'], row['vehicle_type'], row['region']
+
+                last_idx, last_lat, last_lon, direction = 0, None, None, 'forward'
+                init_waypoint = row.get('init_waypoint')
+                if init_waypoint and (route_id, init_waypoint) in waypoints_map:
+                    last_idx, last_lat, last_lon = waypoints_map[(route_id, init_waypoint)]
+                    direction = row.get('init_direction') or 'forward'
+
+                rows.append((
+                    make_vehicle_id(region, v_type, plate), plate, v_type, region, int(row['seats'] or 0),
+                    row.get('service_type') or 'Local', route_id, last_idx, last_lat, last_lon, direction,
+                ))
+            self._insert(cursor, "vehicles", """
+                INSERT OR IGNORE INTO vehicles
+                (vehicle_id, license_plate, vehicle_type, region, seats, service_type, current_route_id, last_segment_index, last_known_lat, last_known_lon, direction)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+        self._count("vehicles", "seconds", time.perf_counter() - started)
+
+
+    def run(self, waypoints_path=None, vehicles_path=None):
+        tables = {"routes", "waypoints"} if waypoints_path else set()
+        if vehicles_path:
+            tables.add("vehicles")
+        deferred = [(name, definition) for table, name, definition in SECONDARY_INDEXES if table in tables]
+
+        started = time.perf_counter()
+        conn = sqlite3.connect(self.db_path, isolation_level=None, timeout=60)
+        try:
+            for pragma in LOAD_PRAGMAS:
+                conn.execute(pragma)
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                for name, _ in deferred:
+                    cursor.execute(f"DROP INDEX IF EXISTS {name}")
+                if waypoints_path:
+                    self.load_waypoints(cursor, waypoints_path)
+                if vehicles_path:
+                    self.load_vehicles(cursor, vehicles_path)
+
+                index_started = time.perf_counter()
+                for name, definition in deferred:
+                    cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {definition}")
+                self.stats["index_rebuild_seconds"] = round(time.perf_counter() - index_started, 3)
+
+                bump_data_version(cursor, 'routes')
+                cursor.execute("COMMIT")
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+
+        total = time.perf_counter() - started
+        for table, s in self.stats.items():
+            if isinstance(s, dict):
+                s["rows_per_sec"] = round(s["read"] / s["seconds"]) if s["seconds"] else None
+                s["seconds"] = round(s["seconds"], 3)
+        self.stats["total_seconds"] = round(total, 3)
+        return self.stats
+
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk-load routes, waypoints and vehicles from CSV")
+    parser.add_argument("--waypoints", help="waypoints CSV (routes are created from it)")
+    parser.add_argument("--vehicles", help="vehicles CSV")
+    parser.add_argument("--db", default=DB_PATH)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+    if not args.waypoints and not args.vehicles:
+        parser.error("nothing to import, pass --waypoints and/or --vehicles")
+
+    stats = BulkImporter(args.db, args.chunk_size).run(args.waypoints, args.vehicles)
+    for table in ("routes", "waypoints", "vehicles"):
+        s = stats.get(table)
+        if s:
+            rate = f", {s['rows_per_sec']} rows/s" if s.get("rows_per_sec") else ""
+            print(f"{table}: {s['inserted']} inserted, {s['ignored']} already present, "
+                  f"{s['rejected']} rejected{rate}")
+    print(f"indexes rebuilt in {stats['index_rebuild_seconds']}s, total {stats['total_seconds']}s")
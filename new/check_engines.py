@@ -0,0 +1,147 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import tempfile
+from datetime import datetime, timezone
+
+import database
+import get_routes
+from bench_sharding import synthesize_fleet
+
+
+
+# checks that the tasks and vectorized engines serve the same stops in the same
+# order, arrivals and departures alike:
+#   python check_engines.py --routes 4 --vehicles 20 --duration 14400
+# both run in virtual time on one synthetic fleet in a scratch directory, with
+# the stop events recorded instead of written. dwell times come from different
+# random streams, so only each vehicle's sequence of (event, waypoint) is
+# compared, up to the shorter of the two, and the run has to be long enough for
+# every vehicle to finish at least one round trip. each stream must also pair
+# every arrival with a departure from the same waypoint. the same stop twice
+# running is fine on its own: 'start' waypoints aren't stops, so the stop next to
+# one is served on both sides of that turnaround
+
+
+
+class EventRecorder:
+    # stands in for EventPublisher
+
+    def __init__(self):
+        self.events = {}
+
+    def publish_many(self, topic, items):
+        for item in items:
+            self.events.setdefault(item["vehicle_id"], []).append((topic, item["waypoint_id"]))
+
+
+
+async def record(engine, vehicles, duration, seed):
+    from route_cache import RouteCache, RouteCacheStore
+    from sharding import PacketCounter
+    from sim_clock import VirtualClock, vehicle_rng
+    from simulation import RouteManager, StopEventLog, VehicleSimulator
+
+    clock = VirtualClock(start=datetime(2024, 1, 1, 6, 0, tzinfo=timezone.utc))
+    route_manager = RouteManager(route_cache=RouteCache(store=RouteCacheStore()))
+    recorder = EventRecorder()
+    stop_events = StopEventLog(recorder, write_db=False)
+    sink = PacketCounter()
+    speeds = [vehicle_rng(seed, v['vehicle_id']).randint(35, 60) for v in vehicles]
+    clock_task = clock.start()
+
+    if engine == "vectorized":
+        from fleet_engine import FleetEngine
+        fleet = FleetEngine(route_manager, sink, clock=clock, stop_events=stop_events, rng=random.Random(seed))
+        await fleet.load(vehicles, speeds)
+        tasks = [fleet.start()]
+    else:
+        tasks = [
+            VehicleSimulator(v, route_manager, sink, speed_kmh=speed, clock=clock,
+                             rng=vehicle_rng(seed, v['vehicle_id']), stop_events=stop_events).start()
+            for v, speed in zip(vehicles, speeds)
+        ]
+
+    await asyncio.create_task(clock.track(clock.sleep(duration)))
+    for task in tasks + [clock_task]:
+        task.cancel()
+    await asyncio.gather(*tasks, clock_task, return_exceptions=True)
+    return recorder.events
+
+
+
+def stops_per_round_trip(vehicle):
+    from simulation import get_mission_waypoints_for_route
+    waypoints = get_mission_waypoints_for_route(vehicle['current_route_id'])
+    if vehicle['service_type'] == 'Express':
+        waypoints = [w for w in waypoints if not w['is_skippable']]
+    # both termini once per direction, the one it started at is served only on the way back
+    return 2 * (len(waypoints) - 1)
+
+
+
+def unpaired(events):
+    # index of the first event breaking arrival/departure pairing, or None
+    for i, (topic, waypoint_id) in enumerate(events):
+        expected = "arrival" if i % 2 == 0 else "departure"
+        if topic != expected or (i % 2 and waypoint_id != events[i - 1][1]):
+            return i
+    return None
+
+
+
+def compare(vehicles, tasks_events, vectorized_events):
+    mismatched, short, broken = [], [], []
+    for v in vehicles:
+        a = tasks_events.get(v['vehicle_id'], [])
+        b = vectorized_events.get(v['vehicle_id'], [])
+        for engine, events in (("tasks", a), ("vectorized", b)):
+            at = unpaired(events)
+            if at is not None:
+                broken.append({"vehicle_id": v['vehicle_id'], "engine": engine, "at": at, "events": events[max(at - 2, 0):at + 2]})
+        n = min(len(a), len(b))
+        if a[:n] != b[:n]:
+            first = next(i for i in range(n) if a[i] != b[i])
+            mismatched.append({"vehicle_id": v['vehicle_id'], "at": first, "tasks": a[first:first + 4],
+                               "vectorized": b[first:first + 4]})
+        elif sum(1 for topic, _ in a[:n] if topic == "arrival") < stops_per_round_trip(v):
+            short.append(v['vehicle_id'])
+    return mismatched, short, broken
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the stop event streams of both simulation engines")
+    parser.add_argument("--routes", type=int, default=4)
+    parser.add_argument("--vehicles", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=14400, help="simulated seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="check_engines_")
+    os.chdir(workdir)
+    try:
+        get_routes.set_provider(get_routes.SyntheticProvider())
+        database.create_database_schema()
+        synthesize_fleet(database.DB_PATH, args.routes, args.vehicles, seed=args.seed)
+
+        from simulation import get_vehicles_for_simulation
+        vehicles = get_vehicles_for_simulation()
+        tasks_events = asyncio.run(record("tasks", vehicles, args.duration, args.seed))
+        vectorized_events = asyncio.run(record("vectorized", vehicles, args.duration, args.seed))
+        mismatched, short, broken = compare(vehicles, tasks_events, vectorized_events)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps({
+        "vehicles": len(vehicles),
+        "events": {"tasks": sum(map(len, tasks_events.values())),
+                   "vectorized": sum(map(len, vectorized_events.values()))},
+        "mismatched": mismatched,
+        "short_of_round_trip": short,
+        "unpaired": broken,
+    }, indent=2))
+    raise SystemExit(1 if mismatched or short or broken else 0)
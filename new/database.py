@@ -4,12 +4,80 @@ import random
 DB_PATH = 'tracking.db'
 
 
+def bump_data_version(cursor, name):
+    cursor.execute("""
+        INSERT INTO data_versions (name, version) VALUES (?, 1)
+        ON CONFLICT (name) DO UPDATE SET version = version + 1
+    """, (name,))
+
+
+
+def get_data_version(cursor, name):
+    cursor.execute("SELECT version FROM data_versions WHERE name = ?", (name,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+
+def make_vehicle_id(region, vehicle_type, license_plate):
+    return f"{region[:2].upper()}-{vehicle_type.upper()}-{license_plate[-4:]}"
+
+
+
+# (table, name, definition); bulk_import.py drops the ones on the tables it loads
+# and rebuilds them once at the end
+SECONDARY_INDEXES = [
+    ("live_gps_positions", "idx_live_vehicle_ts", "live_gps_positions (vehicle_id, timestamp DESC)"),
+    ("waypoint_history", "idx_history_vehicle_ts", "waypoint_history (vehicle_id, arrival_timestamp DESC)"),
+    ("live_gps_positions", "idx_live_epoch", "live_gps_positions (ts_epoch)"),
+    ("waypoint_history", "idx_history_epoch", "waypoint_history (arrival_epoch)"),
+    ("vehicles", "idx_vehicles_route", "vehicles (current_route_id)"),
+    ("waypoints", "idx_waypoints_name", "waypoints (waypoint_name)"),
+]
+
+
+# (table, column, iso timestamp column) integer unix seconds kept by sqlite itself,
+# so writers don't change and retention.py / history_store.py compare integers on
+# an index instead of iso strings (which don't sort together with and without microseconds)
+EPOCH_COLUMNS = [
+    ("live_gps_positions", "ts_epoch", "timestamp"),
+    ("waypoint_history", "arrival_epoch", "arrival_timestamp"),
+]
+
+
+
+def add_epoch_columns(cursor):
+    # virtual generated columns: no rewrite of existing rows, computed on insert for the index
+    for table, column, source in EPOCH_COLUMNS:
+        existing = {row[1] for row in cursor.execute(f"PRAGMA table_xinfo({table})").fetchall()}
+        if column not in existing:
+            cursor.execute(f"""
+                ALTER TABLE {table} ADD COLUMN {column} INTEGER
+                GENERATED ALWAYS AS (CAST(strftime('%s', {source}) AS INTEGER)) VIRTUAL
+            """)
+
+
+
+def ensure_epoch_columns(conn):
+    # for long-running processes on a tracking.db from before the epoch columns;
+    # conn is a db.Database writer (dict rows) inside a transaction
+    cursor = conn.cursor()
+    cursor.row_factory = None    # add_epoch_columns reads plain tuples
+    add_epoch_columns(cursor)
+    tables = {table for table, _, _ in EPOCH_COLUMNS}
+    for table, name, definition in SECONDARY_INDEXES:
+        if table in tables:
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {definition}")
+
+
 
 
 
 def create_database_schema():
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
+    # only takes on a new file; retention.py frees pages with PRAGMA incremental_vacuum
+    cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
 
     cursor.execute("""
     CREATE TABLE IF NOT EXISTS vehicles (
@@ -92,8 +160,72 @@ def create_database_schema():
 
 
 
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_live_vehicle_ts ON live_gps_positions (vehicle_id, timestamp DESC);")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_history_vehicle_ts ON waypoint_history (vehicle_id, arrival_timestamp DESC);")
+    # bumped by anything that edits routes/waypoints/vehicle assignments so
+    # long-running readers (server.py) know when to rebuild their caches
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS data_versions (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    );
+    """)
+
+
+
+
+    # one row per vehicle, upserted on every gps write so "where is each bus now"
+    # reads never have to scan live_gps_positions
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS vehicle_latest_position (
+        vehicle_id TEXT PRIMARY KEY,
+        timestamp TEXT NOT NULL,
+        latitude REAL NOT NULL,
+        longitude REAL NOT NULL,
+        speed_kmh REAL,
+        heading REAL,
+        status TEXT,
+        gps_status TEXT DEFAULT 'functional'
+    );
+    """)
+
+    cursor.execute("""
+    INSERT OR IGNORE INTO vehicle_latest_position
+        (vehicle_id, timestamp, latitude, longitude, speed_kmh, heading, status, gps_status)
+    SELECT p.vehicle_id, p.timestamp, p.latitude, p.longitude, p.speed_kmh, p.heading, p.status, p.gps_status
+    FROM live_gps_positions p
+    INNER JOIN (
+        SELECT vehicle_id, MAX(timestamp) as max_ts
+        FROM live_gps_positions
+        GROUP BY vehicle_id
+    ) latest ON p.vehicle_id = latest.vehicle_id AND p.timestamp = latest.max_ts
+    """)
+    
+
+
+
+    # latest mid-trip state per vehicle, upserted in batches by the simulator so a
+    # restart resumes where each bus was instead of snapping it back onto its route.
+    # distance_along_route is metres along the route in `direction`; a 'finished'
+    # bus is at the start of its next trip in `direction`, waiting out dwell_remaining
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS vehicle_checkpoints (
+        vehicle_id TEXT PRIMARY KEY,
+        route_id INTEGER NOT NULL,
+        direction TEXT NOT NULL,
+        distance_along_route REAL NOT NULL,
+        segment_index INTEGER NOT NULL DEFAULT 0,
+        latitude REAL NOT NULL,
+        longitude REAL NOT NULL,
+        status TEXT NOT NULL,
+        dwell_remaining REAL NOT NULL DEFAULT 0,
+        saved_at TEXT NOT NULL
+    );
+    """)
+
+
+
+    add_epoch_columns(cursor)
+    for _, name, definition in SECONDARY_INDEXES:
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {definition};")
     
 
     conn.commit()
@@ -0,0 +1,192 @@
+import asyncio
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+
+# shared data access for simulation.py and server.py: one long-lived writer
+# connection (sqlite only ever has one writer anyway) plus a pool of readers,
+# all in WAL mode so readers never block the writer. every query is timed
+# under a label; asyncio callers go through arun/aread/awrite so the event loop
+# never waits on disk, and server.py runs the sync calls on gevent's threadpool
+
+DB_PATH = 'tracking.db'
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=268435456",
+)
+
+
+
+
+def dict_row(cursor, row):
+    return {col[0]: value for col, value in zip(cursor.description, row)}
+
+
+
+
+class QueryStats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_label = {}
+
+
+    def record(self, label, elapsed, failed=False):
+        with self.lock:
+            s = self.by_label.get(label)
+            if s is None:
+                s = self.by_label[label] = {"count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0}
+            ms = elapsed * 1000
+            s["count"] += 1
+            s["errors"] += failed
+            s["total_ms"] += ms
+            s["max_ms"] = max(s["max_ms"], ms)
+
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                label: dict(s, avg_ms=round(s["total_ms"] / s["count"], 3) if s["count"] else 0.0)
+                for label, s in self.by_label.items()
+            }
+
+
+
+
+class Database:
+
+    def __init__(self, path=DB_PATH, readers=4, busy_timeout=30, cached_statements=256):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.cached_statements = cached_statements
+        self.stats = QueryStats()
+
+        self.write_lock = threading.Lock()
+        self.writer = self._connect()
+        self.readers = queue.Queue()
+        for _ in range(readers):
+            self.readers.put(self._connect())
+        # one thread per reader plus one for the writer
+        self.executor = ThreadPoolExecutor(max_workers=readers + 1, thread_name_prefix="db")
+
+
+    def _connect(self):
+        # sqlite3 keeps up to `cached_statements` prepared statements per connection,
+        # so repeated queries with the same SQL text skip re-parsing
+        conn = sqlite3.connect(
+            self.path, timeout=self.busy_timeout, check_same_thread=False,
+            cached_statements=self.cached_statements,
+        )
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        conn.row_factory = dict_row
+        return conn
+
+
+    @contextmanager
+    def _timed(self, label):
+        started = time.perf_counter()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self.stats.record(label, time.perf_counter() - started, failed)
+
+
+    @contextmanager
+    def reader(self):
+        conn = self.readers.get()
+        try:
+            yield conn
+        finally:
+            self.readers.put(conn)
+
+
+    @contextmanager
+    def transaction(self, label="transaction"):
+        # the writer connection inside BEGIN/COMMIT; rolls back on error
+        with self.write_lock, self._timed(label), self.writer:
+            yield self.writer
+
+
+    def read(self, sql, params=(), label=None):
+        with self.reader() as conn, self._timed(label or _label(sql)):
+            return conn.execute(sql, params).fetchall()
+
+
+    def read_one(self, sql, params=(), label=None):
+        with self.reader() as conn, self._timed(label or _label(sql)):
+            return conn.execute(sql, params).fetchone()
+
+
+    def write(self, sql, params=(), label=None):
+        with self.transaction(label or _label(sql)) as conn:
+            return conn.execute(sql, params).rowcount
+
+
+    def write_many(self, sql, rows, label=None):
+        with self.transaction(label or _label(sql)) as conn:
+            return conn.executemany(sql, rows).rowcount
+
+
+    async def arun(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+
+    async def aread(self, sql, params=(), label=None):
+        return await self.arun(self.read, sql, params, label)
+
+
+    async def awrite(self, sql, params=(), label=None):
+        return await self.arun(self.write, sql, params, label)
+
+
+    async def awrite_many(self, sql, rows, label=None):
+        return await self.arun(self.write_many, sql, rows, label)
+
+
+    def metrics(self):
+        return self.stats.snapshot()
+
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        with self.write_lock:
+            self.writer.close()
+        while not self.readers.empty():
+            self.readers.get_nowait().close()
+
+
+
+
+def _label(sql):
+    return " ".join(sql.split())[:60]
+
+
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+
+def get_db(path=DB_PATH):
+    # one Database per path per process; keyed on pid so forked shards open their own
+    key = (os.path.abspath(path), os.getpid())
+    with _databases_lock:
+        db = _databases.get(key)
+        if db is None:
+            db = _databases[key] = Database(path)
+        return db
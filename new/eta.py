@@ -0,0 +1,223 @@
+from datetime import datetime, timezone
+
+from route_geometry import haversine_m
+
+
+
+# travel times between consecutive stops are learned from waypoint_history as
+# arrivals come in: one running mean/variance (Welford) per
+# (route, from stop, to stop, time-of-day bucket), plus an all-day one per pair
+# for buckets with no data yet. a segment's time is arrival -> next arrival, so
+# it includes the dwell at the first stop (and the layover at a terminus).
+# on every arrival the vehicle's expected offsets to each downstream stop are
+# rebuilt once; live positions only move the time to the next stop, so looking
+# up an ETA is a couple of dict reads
+
+BUCKET_MINUTES = 60             # buckets are on the arrival timestamp's own clock (UTC from the simulator)
+MIN_BUCKET_SAMPLES = 3
+MAX_SEGMENT_SECONDS = 3 * 3600  # longer gaps are restarts/outages, not travel
+FALLBACK_SPEED_KMH = 30
+LEFT_STOP_M = 30                # closer than this to the last stop counts as still dwelling
+
+
+
+
+class RunningStats:
+    __slots__ = ("count", "mean", "m2")
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    @property
+    def std(self):
+        return (self.m2 / (self.count - 1)) ** 0.5 if self.count > 1 else 0.0
+
+
+
+
+def parse_epoch(timestamp):
+    ts = datetime.fromisoformat(timestamp)
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts.timestamp()
+
+
+
+def time_bucket(epoch, bucket_minutes=BUCKET_MINUTES):
+    ts = datetime.fromtimestamp(epoch, timezone.utc)
+    return (ts.hour * 60 + ts.minute) // bucket_minutes
+
+
+
+
+class EtaEngine:
+
+    def __init__(self, bucket_minutes=BUCKET_MINUTES, fallback_speed_kmh=FALLBACK_SPEED_KMH):
+        self.bucket_minutes = bucket_minutes
+        self.fallback_mps = fallback_speed_kmh / 3.6
+        self.segment_stats = {}     # (route_id, from_wp, to_wp, bucket or None) -> RunningStats
+        self.stops = {}             # waypoint_id -> stop row
+        self.patterns = {}          # (route_id, service_type) -> [waypoint_id, ...] in sequence order
+        self.waypoints_by_name = {}
+        self.vehicles = {}          # vehicle_id -> {"service_type", "direction"}
+        self.progress = {}          # vehicle_id -> where it is and what it expects next
+        self.upcoming = {}          # waypoint_id -> vehicle_ids that will reach it this trip
+        self.last_history_id = 0
+        self.stats = {"arrivals": 0, "segments_learned": 0}
+
+
+    def load_stops(self, waypoints):
+        # waypoints: rows of waypoint_id, route_id, sequence, waypoint_name, latitude,
+        # longitude, waypoint_type, is_skippable. 'start' points are never arrived at
+        self.stops = {}
+        self.waypoints_by_name = {}
+        by_route = {}
+        for wp in sorted(waypoints, key=lambda w: (w['route_id'], w['sequence'])):
+            if wp['waypoint_type'] == 'start':
+                continue
+            self.stops[wp['waypoint_id']] = wp
+            self.waypoints_by_name.setdefault(wp['waypoint_name'], []).append(wp['waypoint_id'])
+            by_route.setdefault(wp['route_id'], []).append(wp)
+
+        # express buses don't stop at skippable stops, so they see a shorter pattern
+        self.patterns = {}
+        for route_id, stops in by_route.items():
+            self.patterns[(route_id, 'Local')] = [wp['waypoint_id'] for wp in stops]
+            self.patterns[(route_id, 'Express')] = [wp['waypoint_id'] for wp in stops if not wp['is_skippable']]
+
+
+    def load_vehicles(self, vehicles):
+        # keeps a direction already inferred from arrivals over the (possibly stale) stored one
+        for v in vehicles:
+            state = self.vehicles.setdefault(v['vehicle_id'], {"direction": v['direction']})
+            state["service_type"] = v['service_type']
+
+
+    def _pattern(self, vehicle_id, route_id):
+        service_type = self.vehicles.get(vehicle_id, {}).get("service_type")
+        return self.patterns.get((route_id, 'Express' if service_type == 'Express' else 'Local'), [])
+
+
+    def expected_seconds(self, route_id, from_wp, to_wp, at_epoch):
+        stats = self.segment_stats.get((route_id, from_wp, to_wp, time_bucket(at_epoch, self.bucket_minutes)))
+        if stats is None or stats.count < MIN_BUCKET_SAMPLES:
+            stats = self.segment_stats.get((route_id, from_wp, to_wp, None)) or stats
+        if stats is not None and stats.count:
+            return stats.mean
+        a, b = self.stops[from_wp], self.stops[to_wp]
+        return float(haversine_m(a['latitude'], a['longitude'], b['latitude'], b['longitude'])) / self.fallback_mps
+
+
+    def _learn(self, route_id, from_wp, to_wp, departed_epoch, seconds):
+        for bucket in (time_bucket(departed_epoch, self.bucket_minutes), None):
+            key = (route_id, from_wp, to_wp, bucket)
+            stats = self.segment_stats.get(key)
+            if stats is None:
+                stats = self.segment_stats[key] = RunningStats()
+            stats.add(seconds)
+        self.stats["segments_learned"] += 1
+
+
+    def _forget_upcoming(self, vehicle_id):
+        previous = self.progress.pop(vehicle_id, None)
+        if previous is not None:
+            for wp in previous["offsets"]:
+                waiting = self.upcoming.get(wp)
+                if waiting is not None:
+                    waiting.discard(vehicle_id)
+                    if not waiting:
+                        del self.upcoming[wp]
+        return previous
+
+
+    def on_arrival(self, history_id, vehicle_id, waypoint_id, timestamp):
+        self.last_history_id = max(self.last_history_id, history_id)
+        stop = self.stops.get(waypoint_id)
+        if stop is None:
+            return
+        self.stats["arrivals"] += 1
+        arrived = parse_epoch(timestamp)
+        route_id = stop['route_id']
+        pattern = self._pattern(vehicle_id, route_id)
+        if waypoint_id not in pattern:
+            return
+        idx = pattern.index(waypoint_id)
+
+        previous = self._forget_upcoming(vehicle_id)
+        vehicle = self.vehicles.setdefault(vehicle_id, {"service_type": None, "direction": 'forward'})
+        if previous is not None and previous["route_id"] == route_id and previous["idx"] != idx:
+            vehicle["direction"] = 'forward' if idx > previous["idx"] else 'backward'
+            elapsed = arrived - previous["arrived"]
+            if abs(idx - previous["idx"]) == 1 and 0 < elapsed <= MAX_SEGMENT_SECONDS:
+                self._learn(route_id, previous["waypoint_id"], waypoint_id, previous["arrived"], elapsed)
+
+        # turn around at either terminus
+        if vehicle["direction"] == 'forward' and idx == len(pattern) - 1:
+            vehicle["direction"] = 'backward'
+        elif vehicle["direction"] == 'backward' and idx == 0:
+            vehicle["direction"] = 'forward'
+        step = 1 if vehicle["direction"] == 'forward' else -1
+
+        # seconds from arrival here to each downstream stop, chained through the
+        # bucket the vehicle will actually be in when it gets to each segment
+        offsets = {}
+        elapsed = 0.0
+        current = waypoint_id
+        for downstream in (pattern[idx + 1:] if step == 1 else pattern[:idx][::-1]):
+            elapsed += self.expected_seconds(route_id, current, downstream, arrived + elapsed)
+            offsets[downstream] = elapsed
+            current = downstream
+
+        next_wp = next(iter(offsets), None)
+        self.progress[vehicle_id] = {
+            "route_id": route_id, "waypoint_id": waypoint_id, "idx": idx, "arrived": arrived,
+            "next_wp": next_wp, "offsets": offsets,
+            "next_eta": arrived + offsets[next_wp] if next_wp is not None else arrived,
+        }
+        for wp in offsets:
+            self.upcoming.setdefault(wp, set()).add(vehicle_id)
+
+
+    def on_position(self, vehicle_id, lat, lon, now):
+        # only the time to the next stop moves between arrivals
+        p = self.progress.get(vehicle_id)
+        if p is None or p["next_wp"] is None:
+            return
+        # either stop may have gone in a load_stops() since the arrival that set this up
+        last, nxt = self.stops.get(p["waypoint_id"]), self.stops.get(p["next_wp"])
+        if last is None or nxt is None:
+            return
+        segment = p["offsets"][p["next_wp"]]
+        done_m = float(haversine_m(last['latitude'], last['longitude'], lat, lon))
+        left_m = float(haversine_m(lat, lon, nxt['latitude'], nxt['longitude']))
+        if done_m < LEFT_STOP_M:
+            # still at the stop: the segment time includes the dwell, so count it down
+            remaining = segment - (now - p["arrived"])
+        else:
+            remaining = segment * left_m / (done_m + left_m)
+        p["next_eta"] = now + max(remaining, 0.0)
+
+
+    def eta(self, vehicle_id, waypoint_id):
+        p = self.progress.get(vehicle_id)
+        if p is None or waypoint_id not in p["offsets"]:
+            return None
+        return p["next_eta"] + p["offsets"][waypoint_id] - p["offsets"][p["next_wp"]]
+
+
+    def etas_for_stop(self, waypoint_name):
+        # [(vehicle_id, eta epoch seconds), ...] soonest first, over every route serving the stop
+        etas = [
+            (vehicle_id, self.eta(vehicle_id, wp))
+            for wp in self.waypoints_by_name.get(waypoint_name, ())
+            for vehicle_id in self.upcoming.get(wp, ())
+        ]
+        return sorted(etas, key=lambda e: e[1])
@@ -0,0 +1,163 @@
+import asyncio
+import json
+import os
+import socket
+import time
+
+
+
+# local pub/sub between simulation.py and server.py. the simulator publishes
+# newline-delimited json {"t": topic, "d": data} to every connected subscriber;
+# server.py consumes it and pushes straight to browsers, so tracking.db is only
+# written for persistence. EVENT_BUS_ADDRESS is tcp://host:port or unix:///path,
+# e.g. tcp://127.0.0.1:5055; unset means no bus and server.py polls tracking.db.
+# server.py also takes a comma-separated list and subscribes to each, which is
+# how it follows a sharded simulator (one publisher per shard, see shard_address)
+EVENT_BUS_ADDRESS = os.environ.get("EVENT_BUS_ADDRESS")
+
+
+
+
+def parse_address(address):
+    if address.startswith("unix://"):
+        return "unix", address[len("unix://"):]
+    if address.startswith("tcp://"):
+        host, _, port = address[len("tcp://"):].rpartition(":")
+        return "tcp", (host or "127.0.0.1", int(port))
+    raise ValueError(f"Unsupported event bus address '{address}', expected tcp://host:port or unix:///path")
+
+
+
+def split_addresses(value):
+    return [address.strip() for address in (value or "").split(",") if address.strip()]
+
+
+
+def shard_address(address, shard_id):
+    # shard n publishes on port + n, or on path.n for unix sockets
+    kind, target = parse_address(address)
+    if kind == "unix":
+        return f"unix://{target}.{shard_id}"
+    return f"tcp://{target[0]}:{target[1] + shard_id}"
+
+
+
+def encode(topic, data):
+    return (json.dumps({"t": topic, "d": data}, separators=(",", ":")) + "\n").encode()
+
+
+
+
+class EventPublisher:
+    # slow subscribers get dropped messages rather than stalling the simulator
+
+    def __init__(self, address, max_buffer_bytes=4 * 1024 * 1024):
+        self.address = address
+        self.max_buffer_bytes = max_buffer_bytes
+        self.subscribers = set()
+        self.server = None
+        self.stats = {"published": 0, "dropped": 0, "subscribers": 0}
+
+
+    async def start(self):
+        kind, target = parse_address(self.address)
+        if kind == "unix":
+            if os.path.exists(target):
+                os.unlink(target)
+            self.server = await asyncio.start_unix_server(self._on_connect, path=target)
+        else:
+            self.server = await asyncio.start_server(self._on_connect, host=target[0], port=target[1])
+        print(f"[event-bus] publishing on {self.address}")
+
+
+    async def _on_connect(self, reader, writer):
+        self.subscribers.add(writer)
+        self.stats["subscribers"] = len(self.subscribers)
+        try:
+            # subscribers never send anything; this just notices them going away
+            await reader.read()
+        except (asyncio.CancelledError, ConnectionError):
+            # close() cancels these; finishing normally keeps asyncio's stream
+            # callback from logging the cancellation as an error
+            pass
+        finally:
+            self.subscribers.discard(writer)
+            self.stats["subscribers"] = len(self.subscribers)
+            writer.close()
+
+
+    def _send(self, payload, count):
+        for writer in list(self.subscribers):
+            if writer.is_closing():
+                self.subscribers.discard(writer)
+            elif writer.transport.get_write_buffer_size() > self.max_buffer_bytes:
+                self.stats["dropped"] += count
+            else:
+                writer.write(payload)
+        self.stats["published"] += count
+
+
+    def publish(self, topic, data):
+        if self.subscribers:
+            self._send(encode(topic, data), 1)
+
+
+    def publish_many(self, topic, items):
+        if self.subscribers and items:
+            self._send(b"".join(encode(topic, item) for item in items), len(items))
+
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            for writer in list(self.subscribers):
+                writer.close()
+            await self.server.wait_closed()
+            self.server = None
+
+
+
+
+class PacketFanout:
+    # what the simulators submit packets to: persistence and the live bus
+
+    def __init__(self, gps_writer, publisher):
+        self.gps_writer = gps_writer
+        self.publisher = publisher
+
+    def submit(self, packet):
+        self.gps_writer.submit(packet)
+        self.publisher.publish("gps", packet)
+
+    def submit_many(self, packets):
+        self.gps_writer.submit_many(packets)
+        self.publisher.publish_many("gps", packets)
+
+
+
+
+def subscribe(address, on_message, socket_module=socket, sleep=time.sleep, reconnect_delay=1.0):
+    # blocking consumer loop; server.py passes gevent's socket/sleep so it yields to the hub
+    kind, target = parse_address(address)
+    while True:
+        try:
+            if kind == "unix":
+                sock = socket_module.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            else:
+                sock = socket_module.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.connect(target)
+        except OSError:
+            sleep(reconnect_delay)
+            continue
+
+        print(f"[event-bus] subscribed to {address}")
+        try:
+            stream = sock.makefile("rb")
+            for line in stream:
+                message = json.loads(line)
+                on_message(message["t"], message["d"])
+        except (OSError, ValueError) as e:
+            print(f"[event-bus] connection lost: {e}")
+        finally:
+            sock.close()
+        sleep(reconnect_delay)
@@ -0,0 +1,358 @@
+import asyncio
+import random
+import time
+import numpy as np
+
+from db import get_db
+from metrics import metrics
+from sim_clock import RealTimeClock
+
+from simulation import DB_PATH, Checkpoint, StopEventLog, get_mission_waypoints_for_route, save_vehicle_states
+
+
+MOVING, STOPPED, FINISHED = 0, 1, 2
+STATUS_NAMES = ("moving", "stopped", "finished")
+
+# gap between tracks in the concatenated distance axis so the end of one
+# track never ties with the start of the next in searchsorted
+TRACK_GAP_M = 1.0
+
+
+
+
+class FleetEngine:
+    # whole fleet as struct-of-arrays, advanced with one set of numpy ops per tick
+    # instead of one VehicleSimulator task per bus. stop dwell, Express skipping and
+    # terminus turnaround follow VehicleSimulator.run
+
+    def __init__(self, route_manager, gps_writer, update_interval=1, rng=None, clock=None, stop_events=None):
+        self.route_manager = route_manager
+        self.gps_writer = gps_writer
+        self.stop_events = stop_events if stop_events is not None else StopEventLog(write_db=False)
+        self.update_interval = update_interval
+        self.rng = rng or random.Random()
+        self.clock = clock or RealTimeClock()
+
+        self.tracks = {}
+        self.track_keys = []
+        self.stats = {"ticks": 0, "last_step_ms": 0.0, "max_step_ms": 0.0, "packets": 0, "arrivals": 0, "departures": 0}
+
+
+
+    async def _add_track(self, route_id, direction, mission_waypoints):
+        key = (route_id, direction)
+        if key in self.tracks:
+            return self.tracks[key]
+
+        waypoints = list(reversed(mission_waypoints)) if direction == 'backward' else list(mission_waypoints)
+        geometry, stop_indices = await self.route_manager.build_full_route(
+            waypoints, f"route-{route_id}-{direction}", route_id=route_id, direction=direction
+        )
+        if not geometry or len(geometry) < 2:
+            self.tracks[key] = None
+            return None
+
+        self.tracks[key] = len(self.track_keys)
+        self.track_keys.append((key, geometry, stop_indices))
+        return self.tracks[key]
+
+
+
+    async def load(self, vehicles_data, speeds_kmh, checkpoints=None):
+        waypoints_by_route = {}
+        for vehicle_data in vehicles_data:
+            route_id = vehicle_data['current_route_id']
+            if route_id not in waypoints_by_route:
+                waypoints_by_route[route_id] = await get_db(DB_PATH).arun(get_mission_waypoints_for_route, route_id)
+
+        # both directions of every route up front, turnarounds then just swap track index
+        for route_id, mission_waypoints in waypoints_by_route.items():
+            await self._add_track(route_id, 'forward', mission_waypoints)
+            await self._add_track(route_id, 'backward', mission_waypoints)
+
+        self._build_track_arrays()
+
+        vehicles, speeds = [], []
+        for vehicle_data, speed in zip(vehicles_data, speeds_kmh):
+            route_id = vehicle_data['current_route_id']
+            if self.tracks.get((route_id, 'forward')) is None or self.tracks.get((route_id, 'backward')) is None:
+                print(f"[{vehicle_data['vehicle_id']}] No route geometry, not simulating.")
+                continue
+            vehicles.append(vehicle_data)
+            speeds.append(speed)
+        self._build_vehicle_arrays(vehicles, speeds, checkpoints or {})
+        print(f"[fleet] {len(self.vehicle_ids)} vehicles on {len(self.track_keys)} tracks")
+
+
+
+    def _build_track_arrays(self):
+        lats, lons, cum, bearings = [], [], [], []
+        track_start, track_end, track_offset, track_length = [], [], [], []
+        stop_start, stop_end = [], []
+        stop_dist, stop_waypoint, stop_major, stop_skippable = [], [], [], []
+
+        point_count, offset = 0, 0.0
+        for (key, geometry, stop_indices) in self.track_keys:
+            n = len(geometry)
+            lats.append(geometry.lats)
+            lons.append(geometry.lons)
+            cum.append(geometry.cumulative + offset)
+            # pad so bearings line up with points; the last point of a track is never a segment start
+            bearings.append(np.append(geometry.bearings, 0.0))
+            track_start.append(point_count)
+            track_end.append(point_count + n)
+            track_offset.append(offset)
+            track_length.append(geometry.total_length)
+
+            stop_start.append(len(stop_dist))
+            for point_index in sorted(stop_indices):
+                info = stop_indices[point_index]
+                stop_dist.append(float(geometry.cumulative[point_index]))
+                stop_waypoint.append(info['waypoint_id'])
+                stop_major.append(bool(info['is_major']))
+                stop_skippable.append(bool(info['is_skippable']))
+            stop_end.append(len(stop_dist))
+
+            point_count += n
+            offset += geometry.total_length + TRACK_GAP_M
+
+        self.lats = np.concatenate(lats)
+        self.lons = np.concatenate(lons)
+        self.cumulative = np.concatenate(cum)
+        self.bearings = np.concatenate(bearings)
+        self.track_start = np.array(track_start, dtype=np.int64)
+        self.track_end = np.array(track_end, dtype=np.int64)
+        self.track_offset = np.array(track_offset, dtype=np.float64)
+        self.track_length = np.array(track_length, dtype=np.float64)
+        self.stop_start = np.array(stop_start, dtype=np.int64)
+        self.stop_end = np.array(stop_end, dtype=np.int64)
+        # sentinel so next_stop == stop_end can still be indexed
+        self.stop_dist = np.array(stop_dist + [np.inf], dtype=np.float64)
+        self.stop_waypoint = stop_waypoint
+        self.stop_major = stop_major
+        self.stop_skippable = stop_skippable
+
+        self.opposite_track = np.empty(len(self.track_keys), dtype=np.int64)
+        for i, ((route_id, direction), _, _) in enumerate(self.track_keys):
+            other = 'backward' if direction == 'forward' else 'forward'
+            self.opposite_track[i] = self.tracks.get((route_id, other), i)
+
+
+
+    def _build_vehicle_arrays(self, vehicles, speeds_kmh, checkpoints):
+        n = len(vehicles)
+        self.vehicle_ids = [v['vehicle_id'] for v in vehicles]
+        self.vehicle_data = vehicles
+        self.track = np.array([self.tracks[(v['current_route_id'], v['direction'])] for v in vehicles], dtype=np.int64)
+        self.distance = np.zeros(n, dtype=np.float64)
+        self.speed_mps = np.array(speeds_kmh, dtype=np.float64) * 1000 / 3600
+        self.status = np.full(n, MOVING, dtype=np.int8)
+        self.dwell_remaining = np.zeros(n, dtype=np.float64)
+        self.express = np.array([v['service_type'] == 'Express' for v in vehicles], dtype=bool)
+        self.heading = np.zeros(n, dtype=np.float64)
+        self.at_stop = np.full(n, -1, dtype=np.int64)    # stop a STOPPED bus is dwelling at, for its departure
+
+        for i, v in enumerate(vehicles):
+            checkpoint = checkpoints.get(v['vehicle_id'])
+            if checkpoint is not None:
+                self._restore(i, checkpoint)
+            elif v.get('last_known_lat') and v.get('last_known_lon'):
+                geometry = self.track_keys[self.track[i]][1]
+                point_index = min(geometry.nearest_index(v['last_known_lat'], v['last_known_lon']), len(geometry) - 2)
+                self.distance[i] = geometry.cumulative[point_index]
+
+        self.next_stop = self._first_stop_after(self.track, self.distance)
+        self._update_positions()
+
+
+
+    def _restore(self, i, checkpoint):
+        # checkpoints put a finished bus at the start of its next trip; here it waits
+        # at the end of the previous one and the turnaround in step() swaps the track
+        track = self.tracks[(checkpoint.route_id, checkpoint.direction)]
+        if checkpoint.status == "finished":
+            track = self.opposite_track[track]
+            self.distance[i] = self.track_length[track]
+        else:
+            self.distance[i] = min(checkpoint.distance_along_route, self.track_length[track])
+        self.track[i] = track
+        self.status[i] = STATUS_NAMES.index(checkpoint.status) if checkpoint.status in STATUS_NAMES else MOVING
+        if self.status[i] != MOVING:
+            self.dwell_remaining[i] = checkpoint.dwell_remaining
+        if self.status[i] == STOPPED:
+            lo, hi = self.stop_start[track], self.stop_end[track]
+            at = np.flatnonzero(np.abs(self.stop_dist[lo:hi] - self.distance[i]) <= 1.0)
+            if len(at):
+                self.at_stop[i] = lo + at[-1]
+
+
+
+    def _first_stop_after(self, tracks, distances):
+        next_stop = self.stop_start[tracks].copy()
+        for i in range(len(tracks)):
+            t = tracks[i]
+            lo, hi = self.stop_start[t], self.stop_end[t]
+            next_stop[i] = lo + np.searchsorted(self.stop_dist[lo:hi], distances[i], side='right')
+        return next_stop
+
+
+
+    def _update_positions(self):
+        global_distance = self.track_offset[self.track] + self.distance
+        idx = np.searchsorted(self.cumulative, global_distance, side='right') - 1
+        idx = np.clip(idx, self.track_start[self.track], self.track_end[self.track] - 2)
+
+        seg_start = self.cumulative[idx]
+        seg_length = self.cumulative[idx + 1] - seg_start
+        frac = np.divide(global_distance - seg_start, seg_length, out=np.zeros_like(seg_length), where=seg_length > 0)
+        frac = np.clip(frac, 0.0, 1.0)
+
+        self.lat = self.lats[idx] + frac * (self.lats[idx + 1] - self.lats[idx])
+        self.lon = self.lons[idx] + frac * (self.lons[idx + 1] - self.lons[idx])
+        self.heading = self.bearings[idx]
+        self.point_index = idx - self.track_start[self.track]
+
+
+
+    def step(self, dt):
+        timestamp = self.clock.now().isoformat()
+        arrivals, departures, finished = [], [], []
+
+        # dwell countdown; stopped buses pull out, finished ones turn around
+        waiting = self.status != MOVING
+        self.dwell_remaining[waiting] -= dt
+        done = waiting & (self.dwell_remaining <= 0)
+        for i in np.flatnonzero(done & (self.status == STOPPED) & (self.at_stop >= 0)):
+            departures.append((self.vehicle_ids[i], self.stop_waypoint[self.at_stop[i]], timestamp))
+        self.at_stop[done] = -1
+        turnaround = done & (self.status == FINISHED)
+        self.status[done] = MOVING
+        if turnaround.any():
+            self.track[turnaround] = self.opposite_track[self.track[turnaround]]
+            self.distance[turnaround] = 0.0
+            # the stop at distance 0 is the terminus just served, as in VehicleSimulator.run
+            self.next_stop[turnaround] = self._first_stop_after(self.track[turnaround], self.distance[turnaround])
+
+        moving = np.flatnonzero(self.status == MOVING)
+        track = self.track[moving]
+        length = self.track_length[track]
+        target = np.minimum(self.distance[moving] + self.speed_mps[moving] * dt, length)
+
+        # only buses that crossed their next stop this tick drop to python
+        next_stop = self.next_stop[moving]
+        next_stop_dist = np.where(next_stop < self.stop_end[track], self.stop_dist[next_stop], np.inf)
+        crossed = np.flatnonzero(target >= next_stop_dist)
+        for j in crossed:
+            i = moving[j]
+            t = self.track[i]
+            s = self.next_stop[i]
+            while s < self.stop_end[t] and self.stop_dist[s] <= target[j]:
+                if self.stop_skippable[s] and self.express[i]:
+                    s += 1
+                    continue
+                target[j] = self.stop_dist[s]
+                self.status[i] = STOPPED
+                self.dwell_remaining[i] = 600 if self.stop_major[s] else self.rng.randint(240, 300)
+                self.at_stop[i] = s
+                arrivals.append((self.vehicle_ids[i], self.stop_waypoint[s], timestamp))
+                s += 1
+                break
+            self.next_stop[i] = s
+
+        self.distance[moving] = target
+
+        # reached the terminus and not dwelling at its stop: trip over
+        at_end = moving[(target >= length) & (self.status[moving] == MOVING)]
+        for i in at_end:
+            self.status[i] = FINISHED
+            self.dwell_remaining[i] = self.rng.randint(600, 900)
+            finished.append(i)
+
+        self._update_positions()
+        packets = self._packets(moving, timestamp)
+        return packets, arrivals, departures, finished
+
+
+
+    def _packets(self, indices, timestamp):
+        lat = np.round(self.lat[indices], 6).tolist()
+        lon = np.round(self.lon[indices], 6).tolist()
+        status = self.status[indices].tolist()
+        heading = np.round(self.heading[indices], 2).tolist()
+        speed = np.round(self.speed_mps[indices] * 3.6, 2).tolist()
+        packets = []
+        for k, i in enumerate(indices.tolist()):
+            packets.append({
+                "vehicle_id": self.vehicle_ids[i],
+                "timestamp": timestamp,
+                "location": {"lat": lat[k], "lon": lon[k]},
+                "speed_kmh": speed[k] if status[k] == MOVING else 0,
+                "heading": heading[k] if status[k] != FINISHED else 0,
+                "status": STATUS_NAMES[status[k]],
+                "gps_status": "functional"
+            })
+        return packets
+
+
+
+    def _save_finished(self, finished):
+        states = []
+        for i in finished:
+            route_id, direction = self.track_keys[self.track[i]][0]
+            new_direction = 'backward' if direction == 'forward' else 'forward'
+            states.append((self.vehicle_ids[i], float(self.lat[i]), float(self.lon[i]), 0, new_direction))
+        save_vehicle_states(states)
+
+
+    def states(self):
+        return [
+            (vehicle_id, float(self.lat[i]), float(self.lon[i]), int(self.point_index[i]), self.track_keys[self.track[i]][0][1])
+            for i, vehicle_id in enumerate(self.vehicle_ids)
+        ]
+
+
+
+    def checkpoints(self):
+        checkpoints = []
+        for i, vehicle_id in enumerate(self.vehicle_ids):
+            (route_id, direction), _, _ = self.track_keys[self.track[i]]
+            status = STATUS_NAMES[self.status[i]]
+            distance, segment_index = float(self.distance[i]), int(self.point_index[i])
+            if self.status[i] == FINISHED:
+                direction = 'backward' if direction == 'forward' else 'forward'
+                distance, segment_index = 0.0, 0
+            checkpoints.append(Checkpoint(vehicle_id, route_id, direction, distance, segment_index,
+                                          float(self.lat[i]), float(self.lon[i]), status,
+                                          max(float(self.dwell_remaining[i]), 0.0) if status != "moving" else 0.0))
+        return checkpoints
+
+
+
+    async def run(self):
+        while True:
+            tick_started = self.clock.now()
+            started = time.perf_counter()
+            packets, arrivals, departures, finished = self.step(self.update_interval)
+            elapsed = time.perf_counter() - started
+            metrics.observe("fleet_step", elapsed)
+
+            self.gps_writer.submit_many(packets)
+            self.stop_events.arrivals(arrivals)
+            self.stop_events.departures(departures)
+            if finished:
+                await get_db(DB_PATH).arun(self._save_finished, finished)
+
+            self.stats["ticks"] += 1
+            self.stats["packets"] += len(packets)
+            self.stats["arrivals"] += len(arrivals)
+            self.stats["departures"] += len(departures)
+            self.stats["last_step_ms"] = round(elapsed * 1000, 2)
+            self.stats["max_step_ms"] = round(max(self.stats["max_step_ms"], elapsed * 1000), 2)
+
+            # keep the tick cadence in simulated time; under a virtual clock no time passes while stepping
+            spent = (self.clock.now() - tick_started).total_seconds()
+            await self.clock.sleep(max(0.0, self.update_interval - spent))
+
+
+    def start(self):
+        return asyncio.create_task(self.clock.track(self.run()))
@@ -1,8 +1,13 @@
+import hashlib
 import requests
 import json
 from dotenv import  load_dotenv
 import os
 import folium
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from route_geometry import great_circle_points
 
 load_dotenv()
 key = os.environ.get("ROUTE_API")
@@ -11,31 +16,170 @@ url = "https://api.geoapify.com/v1/routing"
 # waypoints = "48.184731,11.547931|48.168254,11.581501|48.179391,11.612174"
 
 
-def get_route(waypoints):
-    querystring = {
-        "waypoints": waypoints,
-        "mode": "truck", # options: drive   light_truck	  medium_truck	 truck	 (22t)	  heavy_truck	 (40t)
-        "apiKey": key
-    }
-    try:
-        response = requests.get(url, params=querystring)
-        response.raise_for_status()
-        data = response.json()
-
-        route_geometry = data["features"][0]["geometry"]["coordinates"]
-
-        all_route_points = []
-        for leg in route_geometry:
-            all_route_points.extend(leg)
+# ROUTE_PROVIDER picks where geometry comes from:
+#   geoapify  (default) live API, optionally saving responses to ROUTE_RECORD_DIR
+#   recorded  replays responses saved in ROUTE_RECORDINGS_DIR, no network
+#   synthetic great-circle lines between the waypoints, no network, for load tests
+ROUTE_PROVIDER = os.environ.get("ROUTE_PROVIDER", "geoapify")
+ROUTE_RECORDINGS_DIR = os.environ.get("ROUTE_RECORDINGS_DIR", "route_recordings")
+
+
+
+
+def _parse_waypoints(waypoints):
+    return [tuple(map(float, wp.split(","))) for wp in waypoints.split("|")]
+
+
+
+def _flatten_geoapify_response(data):
+    route_geometry = data["features"][0]["geometry"]["coordinates"]
+
+    all_route_points = []
+    for leg in route_geometry:
+        all_route_points.extend(leg)
+    return all_route_points
+
+
+
+def recording_path(directory, waypoints):
+    name = hashlib.sha1(waypoints.encode()).hexdigest()
+    return os.path.join(directory, f"{name}.json")
+
+
+
+
+class RoutingProvider:
+    name = "base"
+
+    # waypoints is "lat,lon|lat,lon|..."; returns [[lon, lat], ...] or None
+    def get_route(self, waypoints):
+        raise NotImplementedError
+
+
+
+
+class GeoapifyProvider(RoutingProvider):
+    name = "geoapify"
+
+    def __init__(self, api_key=None, timeout=(3.05, 20), max_retries=3, backoff_factor=0.5,
+                 pool_size=8, record_dir=None):
+        self.api_key = api_key or key
+        self.timeout = timeout
+        self.record_dir = record_dir
+
+        # retries 429/5xx and connection errors with exponential backoff, honouring Retry-After
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(["GET"]),
+        )
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+
+
+    def get_route(self, waypoints):
+        querystring = {
+            "waypoints": waypoints,
+            "mode": "truck", # options: drive   light_truck	  medium_truck	 truck	 (22t)	  heavy_truck	 (40t)
+            "apiKey": self.api_key
+        }
+        try:
+            response = self.session.get(url, params=querystring, timeout=self.timeout)
+            response.raise_for_status()
+            data = response.json()
+            all_route_points = _flatten_geoapify_response(data)
+
+            if self.record_dir:
+                os.makedirs(self.record_dir, exist_ok=True)
+                with open(recording_path(self.record_dir, waypoints), "w") as f:
+                    json.dump(data, f)
+            return all_route_points
+
+
+        except requests.exceptions.RequestException as e:
+            print(f"An error occurred with the API request: {e}")
+            return None
+        except (KeyError, IndexError) as e:
+            print(f"Could not find the coordinate data in the API response. Error: {e}")
+            return None
+
+
+
+
+class RecordedProvider(RoutingProvider):
+    name = "recorded"
+
+    def __init__(self, directory=ROUTE_RECORDINGS_DIR):
+        self.directory = directory
+
+
+    def get_route(self, waypoints):
+        path = recording_path(self.directory, waypoints)
+        try:
+            with open(path) as f:
+                return _flatten_geoapify_response(json.load(f))
+        except FileNotFoundError:
+            print(f"No recorded route for waypoints {waypoints} (expected {path})")
+            return None
+        except (KeyError, IndexError, ValueError) as e:
+            print(f"Recorded route {path} is not a valid routing response. Error: {e}")
+            return None
+
+
+
+
+class SyntheticProvider(RoutingProvider):
+    name = "synthetic"
+
+    def __init__(self, spacing_m=25.0):
+        self.spacing_m = spacing_m
+
+
+    def get_route(self, waypoints):
+        points = _parse_waypoints(waypoints)
+        if len(points) < 2:
+            return None
+
+        all_route_points = [[points[0][1], points[0][0]]]
+        for (lat1, lon1), (lat2, lon2) in zip(points, points[1:]):
+            lats, lons = great_circle_points(lat1, lon1, lat2, lon2, self.spacing_m)
+            # first point of each leg is the last point of the previous one
+            all_route_points.extend([[lon, lat] for lat, lon in zip(lats[1:].tolist(), lons[1:].tolist())])
         return all_route_points
 
 
-    except requests.exceptions.RequestException as e:
-        print(f"An error occurred with the API request: {e}")
-        return None
-    except (KeyError, IndexError) as e:
-        print(f"Could not find the coordinate data in the API response. Error: {e}")
-        return None
+
+
+PROVIDERS = {
+    "geoapify": lambda: GeoapifyProvider(record_dir=os.environ.get("ROUTE_RECORD_DIR")),
+    "recorded": lambda: RecordedProvider(),
+    "synthetic": lambda: SyntheticProvider(),
+}
+
+_provider = None
+
+
+
+def get_provider():
+    global _provider
+    if _provider is None:
+        if ROUTE_PROVIDER not in PROVIDERS:
+            raise ValueError(f"Unknown ROUTE_PROVIDER '{ROUTE_PROVIDER}', expected one of {sorted(PROVIDERS)}")
+        _provider = PROVIDERS[ROUTE_PROVIDER]()
+    return _provider
+
+
+
+def set_provider(provider):
+    global _provider
+    _provider = provider
+
+
+
+def get_route(waypoints):
+    return get_provider().get_route(waypoints)
 
 
 
@@ -0,0 +1,290 @@
+import asyncio
+import json
+import struct
+import time
+import zlib
+from datetime import datetime, timezone, timedelta
+
+import numpy as np
+
+from database import ensure_epoch_columns
+from db import DB_PATH, get_db
+from route_geometry import simplify_polyline
+
+
+
+# two storage tiers for gps trails:
+#   hot   live_gps_positions, raw packets from the last `hot_window` seconds
+#   cold  one gps_history_YYYYMMDD table per day; each row is one chunk of one
+#         vehicle's (downsampled) trail packed column-wise into a zlib'd blob
+# compact() moves everything older than the hot window into its day partition,
+# `chunk_rows` rows per writer transaction (a vehicle's day can span several chunks);
+# query() reads only the partitions a time window overlaps, plus the hot table
+
+HOT_WINDOW = 3600           # seconds of raw points kept in live_gps_positions
+COMPACT_CHUNK_ROWS = 20000  # hot rows read, packed and deleted per writer transaction
+SIMPLIFY_TOLERANCE_M = 5.0
+BLOB_VERSION = 1
+
+# blob layout (little-endian, then zlib):
+#   header  version u8, point count u32, codebook length u16, codebook json
+#   columns time offset ms u32, lat/lon 1e-6 deg i32, speed 0.1 km/h u16,
+#           heading 0.01 deg u16, status code u8 (index into the codebook)
+HEADER = struct.Struct("<BIH")
+COORD_SCALE = 1e6
+
+
+
+
+def parse_timestamp(value):
+    ts = datetime.fromisoformat(value)
+    return ts.astimezone(timezone.utc) if ts.tzinfo else ts.replace(tzinfo=timezone.utc)
+
+
+
+def to_epoch_ms(value):
+    return int(parse_timestamp(value).timestamp() * 1000)
+
+
+
+def partition_table(day):
+    return f"gps_history_{day:%Y%m%d}"
+
+
+
+
+def pack_points(start_ms, ts_ms, lats, lons, speeds, headings, statuses):
+    codebook = sorted(set(statuses))
+    code_of = {s: i for i, s in enumerate(codebook)}
+    codebook_json = json.dumps(codebook, separators=(",", ":")).encode()
+    parts = [
+        HEADER.pack(BLOB_VERSION, len(ts_ms), len(codebook_json)), codebook_json,
+        (np.asarray(ts_ms, dtype=np.int64) - start_ms).astype("<u4").tobytes(),
+        np.round(np.asarray(lats) * COORD_SCALE).astype("<i4").tobytes(),
+        np.round(np.asarray(lons) * COORD_SCALE).astype("<i4").tobytes(),
+        np.round(np.nan_to_num(np.asarray(speeds, dtype=np.float64)) * 10).clip(0, 65535).astype("<u2").tobytes(),
+        np.round(np.nan_to_num(np.asarray(headings, dtype=np.float64)) % 360 * 100).astype("<u2").tobytes(),
+        np.array([code_of[s] for s in statuses], dtype=np.uint8).tobytes(),
+    ]
+    return zlib.compress(b"".join(parts), 6)
+
+
+
+def unpack_points(start_ms, blob):
+    raw = zlib.decompress(blob)
+    version, n, codebook_len = HEADER.unpack_from(raw)
+    if version != BLOB_VERSION:
+        raise ValueError(f"Unsupported history blob version {version}")
+    offset = HEADER.size
+    codebook = json.loads(raw[offset:offset + codebook_len])
+    offset += codebook_len
+
+    columns = {}
+    for name, dtype in (("t", "<u4"), ("lat", "<i4"), ("lon", "<i4"), ("speed", "<u2"), ("heading", "<u2"), ("status", "u1")):
+        columns[name] = np.frombuffer(raw, dtype=dtype, count=n, offset=offset)
+        offset += n * np.dtype(dtype).itemsize
+
+    return {
+        "ts_ms": columns["t"].astype(np.int64) + start_ms,
+        "lat": columns["lat"] / COORD_SCALE,
+        "lon": columns["lon"] / COORD_SCALE,
+        "speed": columns["speed"] / 10,
+        "heading": columns["heading"] / 100,
+        "status": [codebook[c] for c in columns["status"]],
+    }
+
+
+
+def thin_by_interval(ts_ms, interval_s):
+    # first point in every interval_s bucket
+    buckets = np.asarray(ts_ms, dtype=np.int64) // int(interval_s * 1000)
+    return np.flatnonzero(np.concatenate(([True], buckets[1:] != buckets[:-1])))
+
+
+
+
+class HistoryStore:
+
+    def __init__(self, db=None, hot_window=HOT_WINDOW, tolerance_m=SIMPLIFY_TOLERANCE_M, min_interval=None,
+                 chunk_rows=COMPACT_CHUNK_ROWS, pause=0.01):
+        # min_interval (seconds) thins by time instead of Douglas-Peucker; pause is wall-clock between chunks
+        self.db = db or get_db(DB_PATH)
+        self.hot_window = hot_window
+        self.tolerance_m = tolerance_m
+        self.min_interval = min_interval
+        self.chunk_rows = chunk_rows
+        self.pause = pause
+        self.stats = {"compactions": 0, "points_in": 0, "points_kept": 0, "chunks": 0, "bytes": 0,
+                      "last_compact_ms": 0.0, "chunks_written": 0, "max_write_ms": 0.0}
+        with self.db.transaction("history_schema") as conn:
+            ensure_epoch_columns(conn)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS gps_history_partitions (
+                    day TEXT PRIMARY KEY,
+                    table_name TEXT NOT NULL,
+                    chunks INTEGER NOT NULL DEFAULT 0,
+                    points_in INTEGER NOT NULL DEFAULT 0,
+                    points_kept INTEGER NOT NULL DEFAULT 0,
+                    bytes INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+
+
+    def _downsample(self, ts_ms, lats, lons, statuses):
+        # status changes (arrive/depart/turnaround) survive any downsampling
+        changes = [i for i in range(1, len(statuses)) if statuses[i] != statuses[i - 1]]
+        if self.min_interval:
+            return np.union1d(thin_by_interval(ts_ms, self.min_interval), [0, len(ts_ms) - 1, *changes]).astype(np.int64)
+        return simplify_polyline(lats, lons, self.tolerance_m, keep=changes)
+
+
+    def _build_chunks(self, rows):
+        # rows ordered by vehicle, timestamp -> one packed chunk per (vehicle, day)
+        groups = {}
+        for row in rows:
+            ts = parse_timestamp(row['timestamp'])
+            groups.setdefault((row['vehicle_id'], ts.date()), []).append((int(ts.timestamp() * 1000), row))
+
+        chunks = []
+        for (vehicle_id, day), points in groups.items():
+            points.sort(key=lambda p: p[0])
+            ts_ms = np.array([p[0] for p in points], dtype=np.int64)
+            lats = np.array([p[1]['latitude'] for p in points])
+            lons = np.array([p[1]['longitude'] for p in points])
+            statuses = [f"{p[1]['status']}|{p[1]['gps_status']}" for p in points]
+            kept = self._downsample(ts_ms, lats, lons, statuses)
+
+            speeds = np.array([p[1]['speed_kmh'] for p in points], dtype=np.float64)
+            headings = np.array([p[1]['heading'] for p in points], dtype=np.float64)
+            start_ms = int(ts_ms[kept[0]])
+            blob = pack_points(start_ms, ts_ms[kept], lats[kept], lons[kept], speeds[kept], headings[kept],
+                               [statuses[i] for i in kept])
+            chunks.append((day, vehicle_id, start_ms, int(ts_ms[kept[-1]]), len(points), len(kept), blob))
+        return chunks
+
+
+    def _compact_chunk(self, cutoff_epoch):
+        # the oldest `chunk_rows` hot rows before the cutoff -> their day partitions.
+        # read and pack on a reader connection so the writer is only held for the
+        # inserts and the delete of exactly the rows read; returns how many moved
+        rows = self.db.read("""
+            SELECT id, vehicle_id, timestamp, latitude, longitude, speed_kmh, heading, status, gps_status
+            FROM live_gps_positions WHERE ts_epoch < ? ORDER BY ts_epoch LIMIT ?
+        """, (cutoff_epoch, self.chunk_rows), label="history_compact_read")
+        if not rows:
+            return 0
+        chunks = self._build_chunks(rows)
+
+        by_day = {}
+        for chunk in chunks:
+            by_day.setdefault(chunk[0], []).append(chunk)
+
+        started = time.perf_counter()
+        with self.db.transaction("history_compact_write") as conn:
+            for day, day_chunks in by_day.items():
+                table = partition_table(day)
+                conn.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {table} (
+                        vehicle_id TEXT NOT NULL,
+                        start_ms INTEGER NOT NULL,
+                        end_ms INTEGER NOT NULL,
+                        points INTEGER NOT NULL,
+                        data BLOB NOT NULL
+                    )
+                """)
+                conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_vehicle ON {table} (vehicle_id, start_ms)")
+                conn.executemany(
+                    f"INSERT INTO {table} (vehicle_id, start_ms, end_ms, points, data) VALUES (?, ?, ?, ?, ?)",
+                    [(vehicle_id, start_ms, end_ms, kept, blob) for _, vehicle_id, start_ms, end_ms, _, kept, blob in day_chunks],
+                )
+                conn.execute("""
+                    INSERT INTO gps_history_partitions (day, table_name, chunks, points_in, points_kept, bytes)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (day) DO UPDATE SET
+                        chunks = chunks + excluded.chunks,
+                        points_in = points_in + excluded.points_in,
+                        points_kept = points_kept + excluded.points_kept,
+                        bytes = bytes + excluded.bytes
+                """, (day.isoformat(), table, len(day_chunks), sum(c[4] for c in day_chunks),
+                      sum(c[5] for c in day_chunks), sum(len(c[6]) for c in day_chunks)))
+            conn.executemany("DELETE FROM live_gps_positions WHERE id = ?", [(row['id'],) for row in rows])
+        held_ms = (time.perf_counter() - started) * 1000
+
+        s = self.stats
+        s["chunks_written"] += 1
+        s["points_in"] += len(rows)
+        s["points_kept"] += sum(c[5] for c in chunks)
+        s["chunks"] += len(chunks)
+        s["bytes"] += sum(len(c[6]) for c in chunks)
+        s["max_write_ms"] = round(max(s["max_write_ms"], held_ms), 2)
+        return len(rows)
+
+
+    async def compact(self, now=None):
+        # now defaults to wall-clock, simulated runs pass clock.now(). one short writer
+        # transaction per chunk of rows, with a yield in between so the gps writer's
+        # batches interleave; memory is bounded by chunk_rows, not by the backlog
+        started = time.perf_counter()
+        now = (now or datetime.now(timezone.utc)).astimezone(timezone.utc)
+        cutoff_epoch = int((now - timedelta(seconds=self.hot_window)).timestamp())
+
+        moved = 0
+        while True:
+            n = await self.db.arun(self._compact_chunk, cutoff_epoch)
+            moved += n
+            if n < self.chunk_rows:
+                break
+            await asyncio.sleep(self.pause)
+
+        if moved:
+            self.stats["compactions"] += 1
+            self.stats["last_compact_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        return moved
+
+
+    def partitions(self):
+        return self.db.read("SELECT * FROM gps_history_partitions ORDER BY day", label="history_partitions")
+
+
+    def query(self, vehicle_id, start, end):
+        # points for one vehicle with start <= timestamp <= end (aware datetimes), oldest first;
+        # cold points are the downsampled trail, hot points are raw
+        start, end = start.astimezone(timezone.utc), end.astimezone(timezone.utc)
+        start_ms = int(start.timestamp() * 1000)
+        end_ms = int(end.timestamp() * 1000)
+        first_day, last_day = start.date(), end.date()
+        partitions = self.db.read(
+            "SELECT day, table_name FROM gps_history_partitions WHERE day BETWEEN ? AND ?",
+            (first_day.isoformat(), last_day.isoformat()), label="history_partitions",
+        )
+
+        points = []
+        for partition in partitions:
+            chunks = self.db.read(f"""
+                SELECT start_ms, data FROM {partition['table_name']}
+                WHERE vehicle_id = ? AND start_ms <= ? AND end_ms >= ?
+            """, (vehicle_id, end_ms, start_ms), label="history_query_cold")
+            for chunk in chunks:
+                cols = unpack_points(chunk['start_ms'], chunk['data'])
+                for i in np.flatnonzero((cols["ts_ms"] >= start_ms) & (cols["ts_ms"] <= end_ms)):
+                    status, _, gps_status = cols["status"][i].partition("|")
+                    points.append({
+                        "timestamp": datetime.fromtimestamp(cols["ts_ms"][i] / 1000, timezone.utc).isoformat(),
+                        "latitude": float(cols["lat"][i]),
+                        "longitude": float(cols["lon"][i]),
+                        "speed_kmh": float(cols["speed"][i]),
+                        "heading": float(cols["heading"][i]),
+                        "status": status,
+                        "gps_status": gps_status,
+                    })
+
+        # hot rows are compared as epoch too, iso strings with and without microseconds don't sort together
+        hot = self.db.read("""
+            SELECT timestamp, latitude, longitude, speed_kmh, heading, status, gps_status
+            FROM live_gps_positions WHERE vehicle_id = ? AND timestamp >= ? AND timestamp <= ?
+        """, (vehicle_id, (start - timedelta(seconds=1)).isoformat(), (end + timedelta(seconds=1)).isoformat()),
+            label="history_query_hot")
+        points.extend(p for p in hot if start_ms <= to_epoch_ms(p['timestamp']) <= end_ms)
+
+        points.sort(key=lambda p: to_epoch_ms(p['timestamp']))
+        return points
@@ -0,0 +1,180 @@
+import bisect
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+
+
+# in-process timers/gauges for simulation.py and server.py, rendered in the
+# prometheus text format by server.py at /metrics. the simulator ships its
+# snapshot over the event bus (topic "metrics") so one scrape covers both.
+# observe() is called from a single thread per process (the asyncio loop or the
+# gevent hub), so there's no locking on the hot path
+
+# histogram upper bounds, seconds
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+PREFIX = "tracking"
+
+
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+
+def _labels(**labels):
+    return ",".join(f'{k}="{escape_label(v)}"' for k, v in labels.items())
+
+
+
+
+class Metrics:
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.timers = {}    # phase -> [bucket counts..., +Inf count, sum, max]
+        self.gauges = {}
+        self.counters = {}
+        self.remote = {}    # source -> snapshot from another process
+
+
+    def observe(self, phase, seconds):
+        t = self.timers.get(phase)
+        if t is None:
+            t = self.timers[phase] = [0] * (len(self.buckets) + 1) + [0.0, 0.0]
+        t[bisect.bisect_left(self.buckets, seconds)] += 1
+        t[-2] += seconds
+        if seconds > t[-1]:
+            t[-1] = seconds
+
+
+    @contextmanager
+    def timer(self, phase):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.perf_counter() - started)
+
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+
+    def inc(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+
+    def snapshot(self):
+        return {
+            "timers": {phase: list(t) for phase, t in list(self.timers.items())},
+            "gauges": dict(self.gauges),
+            "counters": dict(self.counters),
+        }
+
+
+    def set_remote(self, source, snapshot):
+        self.remote[source] = snapshot
+
+
+    def render(self, source="server", extra=None):
+        # prometheus text exposition; `extra` is more lines from the caller
+        sources = [(source, self.snapshot())] + list(self.remote.items())
+        lines = [f"# TYPE {PREFIX}_phase_seconds histogram"]
+        for src, snap in sources:
+            for phase, t in sorted(snap["timers"].items()):
+                labels = _labels(source=src, phase=phase)
+                cumulative = 0
+                for bound, count in zip(self.buckets, t):
+                    cumulative += count
+                    lines.append(f'{PREFIX}_phase_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                cumulative += t[len(self.buckets)]
+                lines.append(f'{PREFIX}_phase_seconds_bucket{{{labels},le="+Inf"}} {cumulative}')
+                lines.append(f"{PREFIX}_phase_seconds_sum{{{labels}}} {t[-2]}")
+                lines.append(f"{PREFIX}_phase_seconds_count{{{labels}}} {cumulative}")
+
+        lines.append(f"# TYPE {PREFIX}_phase_seconds_max gauge")
+        for src, snap in sources:
+            for phase, t in sorted(snap["timers"].items()):
+                lines.append(f"{PREFIX}_phase_seconds_max{{{_labels(source=src, phase=phase)}}} {t[-1]}")
+
+        for kind, key in (("gauge", "gauges"), ("counter", "counters")):
+            names = sorted({name for _, snap in sources for name in snap[key]})
+            for name in names:
+                metric = f"{PREFIX}_{name}" + ("_total" if kind == "counter" else "")
+                lines.append(f"# TYPE {metric} {kind}")
+                for src, snap in sources:
+                    if name in snap[key]:
+                        lines.append(f"{metric}{{{_labels(source=src)}}} {snap[key][name]}")
+
+        lines.extend(extra or ())
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+
+
+class SamplingProfiler:
+    # background thread that samples every other thread's stack each `interval`
+    # seconds; report() gives collapsed stacks ("a;b;c count") for flamegraph.pl
+    # or speedscope. costs nothing until started
+
+    def __init__(self, interval=0.005, max_depth=48):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = Counter()
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.started_at = None
+
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+
+    def start(self):
+        if self.running:
+            return False
+        self.samples.clear()
+        self.stop_event.clear()
+        self.started_at = time.time()
+        self.thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self.thread.start()
+        return True
+
+
+    def stop(self):
+        if not self.running:
+            return False
+        self.stop_event.set()
+        self.thread.join()
+        return True
+
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.samples[";".join(reversed(stack))] += 1
+
+
+    def report(self, top=None):
+        items = self.samples.most_common(top)
+        return "\n".join(f"{stack} {count}" for stack, count in items) + ("\n" if items else "")
+
+
+profiler = SamplingProfiler()
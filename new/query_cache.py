@@ -0,0 +1,128 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+
+# read-through cache for server.py's client-facing lookups. results live until
+# the next emitter tick boundary (so everything cached within one tick expires
+# together, when fresh positions may have landed), concurrent callers asking for
+# the same key wait on one query instead of each running it, and the entry count
+# is LRU-bounded. entries carry tags (route ids) so new positions on one route
+# drop only the lookups that touched it
+#
+# server.py runs on gevent without monkeypatching, so it passes
+# gevent.event.Event as event_factory: waiters then yield to the hub instead of
+# blocking the one os thread
+
+DEFAULT_TTL = 2.0
+
+
+
+
+class _Inflight:
+    __slots__ = ("event", "value", "error")
+
+    def __init__(self, event):
+        self.event = event
+        self.value = None
+        self.error = None
+
+
+
+
+class QueryCache:
+
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=1024, event_factory=threading.Event, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.event_factory = event_factory
+        self.clock = clock
+        self.lock = threading.Lock()    # bookkeeping only, never held across compute()
+        self.entries = OrderedDict()    # key -> (expires_at, tags, value)
+        self.inflight = {}
+        # bumped by invalidate(), everything or per tag; a result computed across a
+        # bump of the generation or of one of its own tags isn't stored
+        self.generation = 0
+        self.tag_generations = {}
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "expired": 0, "evictions": 0, "invalidations": 0}
+
+
+    def _expires_at(self, now):
+        # the end of the current ttl-sized tick, not now + ttl
+        return (now // self.ttl + 1) * self.ttl
+
+
+    def get(self, key, compute, tags=()):
+        # compute() -> value on a miss; tags: what invalidate(tags=...) can drop it by
+        tags = frozenset(tags)
+        owner = False
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > self.clock():
+                    self.entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return entry[2]
+                del self.entries[key]
+                self.stats["expired"] += 1
+
+            waiter = self.inflight.get(key)
+            if waiter is not None:
+                self.stats["coalesced"] += 1
+            else:
+                self.stats["misses"] += 1
+                waiter = self.inflight[key] = _Inflight(self.event_factory())
+                owner = True
+                generation = self._generation_of(tags)
+
+        if not owner:
+            waiter.event.wait()
+            if waiter.error is not None:
+                raise waiter.error
+            return waiter.value
+
+        try:
+            waiter.value = compute()
+        except Exception as e:
+            waiter.error = e
+            raise
+        else:
+            with self.lock:
+                if generation == self._generation_of(tags):
+                    self.entries[key] = (self._expires_at(self.clock()), tags, waiter.value)
+                    self.entries.move_to_end(key)
+                    while len(self.entries) > self.max_entries:
+                        self.entries.popitem(last=False)
+                        self.stats["evictions"] += 1
+            return waiter.value
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+            waiter.event.set()
+
+
+    def _generation_of(self, tags):
+        # under self.lock
+        return self.generation, tuple(self.tag_generations.get(tag, 0) for tag in tags)
+
+
+    def invalidate(self, tags=None):
+        # tags=None drops everything
+        with self.lock:
+            if tags is None:
+                self.generation += 1
+                dropped = list(self.entries)
+            else:
+                tags = set(tags)
+                for tag in tags:
+                    self.tag_generations[tag] = self.tag_generations.get(tag, 0) + 1
+                dropped = [key for key, (_, entry_tags, _) in self.entries.items() if entry_tags & tags]
+            for key in dropped:
+                del self.entries[key]
+            self.stats["invalidations"] += len(dropped)
+        return len(dropped)
+
+
+    def __len__(self):
+        return len(self.entries)
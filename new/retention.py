@@ -0,0 +1,160 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+
+from database import ensure_epoch_columns
+from db import DB_PATH, get_db
+from metrics import metrics
+
+
+
+# age-based pruning of the append-only tables. each pass deletes in chunks of
+# `chunk_size` rows, one short writer transaction per chunk, and yields to the
+# event loop in between so the gps writer's batches interleave instead of queuing
+# behind one huge DELETE. rows are picked through the integer epoch columns from
+# database.EPOCH_COLUMNS and their indexes, oldest first. afterwards up to
+# `vacuum_pages` free pages go back to the filesystem with PRAGMA incremental_vacuum,
+# so a big backlog is reclaimed over several passes
+#
+# live_gps_positions is normally emptied by HistoryStore.compact() well before its
+# policy applies; the policy is the bound for when compaction falls behind or is off
+
+RetentionPolicy = namedtuple("RetentionPolicy", "table epoch_column max_age chunk_size")
+
+DAY = 86400
+RETENTION_INTERVAL = float(os.environ.get("RETENTION_INTERVAL", 3600))
+RETENTION_CHUNK_SIZE = int(os.environ.get("RETENTION_CHUNK_SIZE", 5000))
+VACUUM_PAGES = int(os.environ.get("RETENTION_VACUUM_PAGES", 2000))
+
+# max_age 0 turns a table's policy off
+DEFAULT_POLICIES = (
+    RetentionPolicy("waypoint_history", "arrival_epoch",
+                    float(os.environ.get("RETENTION_WAYPOINT_HISTORY_DAYS", 3)) * DAY, RETENTION_CHUNK_SIZE),
+    RetentionPolicy("live_gps_positions", "ts_epoch",
+                    float(os.environ.get("RETENTION_LIVE_GPS_DAYS", 1)) * DAY, RETENTION_CHUNK_SIZE),
+)
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+
+
+class RetentionManager:
+
+    def __init__(self, db=None, policies=DEFAULT_POLICIES, pause=0.01, vacuum_pages=VACUUM_PAGES):
+        # pause: wall-clock seconds between chunks
+        self.db = db or get_db(DB_PATH)
+        self.policies = [p for p in policies if p.max_age > 0]
+        self.pause = pause
+        self.vacuum_pages = vacuum_pages
+        self.stats = {"passes": 0, "rows_pruned": 0, "chunks": 0, "lock_ms": 0.0, "max_lock_ms": 0.0, "pages_freed": 0}
+        with self.db.transaction("retention_schema") as conn:
+            ensure_epoch_columns(conn)
+            self.incremental_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()["auto_vacuum"] == AUTO_VACUUM_INCREMENTAL
+
+
+    def _delete_chunk(self, policy, cutoff):
+        # -> (rows deleted, seconds the writer was held)
+        with self.db.transaction(f"retention_{policy.table}") as conn:
+            started = time.perf_counter()
+            deleted = conn.execute(f"""
+                DELETE FROM {policy.table} WHERE rowid IN (
+                    SELECT rowid FROM {policy.table} WHERE {policy.epoch_column} < ?
+                    ORDER BY {policy.epoch_column} LIMIT ?
+                )
+            """, (cutoff, policy.chunk_size)).rowcount
+        return deleted, time.perf_counter() - started
+
+
+    def _vacuum(self):
+        # -> (pages freed, free pages left)
+        # on the writer under write_lock but outside transaction(), so the pragma runs in
+        # autocommit mode. execute() only steps it once, which frees one page, hence the loop
+        conn = self.db.writer
+        with self.db.write_lock:
+            free = conn.execute("PRAGMA freelist_count").fetchone()["freelist_count"]
+            for _ in range(min(free, self.vacuum_pages)):
+                conn.execute("PRAGMA incremental_vacuum(1)")
+            left = conn.execute("PRAGMA freelist_count").fetchone()["freelist_count"]
+        return free - left, left
+
+
+    async def prune(self, now=None):
+        # one pass over every policy; now defaults to wall-clock, simulated runs pass clock.now()
+        now = (now or datetime.now(timezone.utc)).timestamp()
+        report = {"tables": {}}
+        for policy in self.policies:
+            cutoff = int(now - policy.max_age)
+            t = report["tables"][policy.table] = {"rows": 0, "chunks": 0, "lock_ms": 0.0, "max_lock_ms": 0.0}
+            while True:
+                deleted, held = await self.db.arun(self._delete_chunk, policy, cutoff)
+                metrics.observe("retention_chunk", held)
+                t["rows"] += deleted
+                t["chunks"] += 1
+                t["lock_ms"] += held * 1000
+                t["max_lock_ms"] = max(t["max_lock_ms"], held * 1000)
+                if deleted < policy.chunk_size:
+                    break
+                await asyncio.sleep(self.pause)
+            t["lock_ms"] = round(t["lock_ms"], 2)
+            t["max_lock_ms"] = round(t["max_lock_ms"], 2)
+
+        if self.incremental_vacuum:
+            pages_freed, free_pages = await self.db.arun(self._vacuum)
+            report["vacuum"] = {"pages_freed": pages_freed, "free_pages": free_pages}
+
+        s = self.stats
+        s["passes"] += 1
+        for t in report["tables"].values():
+            s["rows_pruned"] += t["rows"]
+            s["chunks"] += t["chunks"]
+            s["lock_ms"] = round(s["lock_ms"] + t["lock_ms"], 2)
+            s["max_lock_ms"] = max(s["max_lock_ms"], t["max_lock_ms"])
+        s["pages_freed"] += report.get("vacuum", {}).get("pages_freed", 0)
+        for key in ("rows_pruned", "pages_freed"):
+            metrics.set_gauge(f"retention_{key}", s[key])
+        return report
+
+
+    async def run(self, clock, interval=RETENTION_INTERVAL):
+        # simulated-time cadence, like the compactor and checkpointer
+        if not self.incremental_vacuum:
+            print("[retention] auto_vacuum is not incremental, freed pages are reused but not returned; "
+                  "run `python retention.py --enable-incremental-vacuum` once while nothing is writing")
+        while True:
+            await clock.sleep(interval)
+            report = await self.prune(clock.now())
+            pruned = {table: t for table, t in report["tables"].items() if t["rows"]}
+            if pruned:
+                tables = ", ".join(f"{table} {t['rows']} rows in {t['chunks']} chunks "
+                                   f"(writer held {t['lock_ms']}ms, max {t['max_lock_ms']}ms)"
+                                   for table, t in pruned.items())
+                print(f"[retention] {tables}; freed {report.get('vacuum', {}).get('pages_freed', 0)} pages")
+
+
+
+
+def enable_incremental_vacuum(path=DB_PATH):
+    # switching an existing file over needs a full VACUUM, which rewrites the whole database
+    db = get_db(path)
+    with db.write_lock:
+        db.writer.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        db.writer.execute("VACUUM")
+        # pooled readers opened before the VACUUM still report the old mode
+        return db.writer.execute("PRAGMA auto_vacuum").fetchone()["auto_vacuum"]
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prune waypoint_history and live_gps_positions by age")
+    parser.add_argument("--enable-incremental-vacuum", action="store_true",
+                        help="switch tracking.db to auto_vacuum=INCREMENTAL (full VACUUM, stop writers first)")
+    args = parser.parse_args()
+
+    if args.enable_incremental_vacuum:
+        print(f"auto_vacuum = {enable_incremental_vacuum()}")
+    print(json.dumps(asyncio.run(RetentionManager().prune()), indent=2))
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from route_geometry import RouteGeometry
+
+
+ROUTE_CACHE_PATH = 'route_cache.db'
+
+
+
+
+def route_cache_key(route_id, direction, mission_waypoints, provider="geoapify", simplify_m=0):
+    # the waypoint hash catches edits to a route's stops without needing a version bump;
+    # the provider keeps synthetic/recorded geometry from being served as real API routes,
+    # and a simplified polyline is its own entry
+    digest = hashlib.sha1()
+    for wp in mission_waypoints:
+        digest.update(f"{wp.get('waypoint_id')}:{wp['latitude']:.6f},{wp['longitude']:.6f};".encode())
+    key = f"{provider}:{route_id}:{direction}:{digest.hexdigest()[:16]}"
+    return f"{key}:s{simplify_m:g}" if simplify_m else key
+
+
+
+
+class RouteCacheStore:
+    # on-disk LRU so restarts don't re-hit the routing API; bounded by total blob bytes
+
+    def __init__(self, path=ROUTE_CACHE_PATH, max_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS route_cache (
+                cache_key TEXT PRIMARY KEY,
+                route_id INTEGER,
+                direction TEXT,
+                coords BLOB NOT NULL,
+                stop_indices TEXT NOT NULL,
+                size_bytes INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_route_cache_last_used ON route_cache (last_used)")
+        self.conn.commit()
+
+
+    def get(self, key, dtype=np.float64):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT coords, stop_indices FROM route_cache WHERE cache_key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE route_cache SET last_used = ? WHERE cache_key = ?", (time.time(), key))
+            self.conn.commit()
+
+        geometry = RouteGeometry.from_api_coords(np.frombuffer(row[0], dtype=np.float64), dtype)
+        stop_indices = {int(k): v for k, v in json.loads(row[1]).items()}
+        return geometry, stop_indices
+
+
+    def put(self, key, route_id, direction, geometry, stop_indices):
+        blob = geometry.to_api_coords().astype(np.float64).tobytes()
+        stops = json.dumps(stop_indices)
+        with self.lock:
+            self.conn.execute("""
+                INSERT OR REPLACE INTO route_cache
+                (cache_key, route_id, direction, coords, stop_indices, size_bytes, last_used)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (key, route_id, direction, blob, stops, len(blob) + len(stops), time.time()))
+            self._evict()
+            self.conn.commit()
+
+
+    def _evict(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM route_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self.conn.execute("SELECT cache_key, size_bytes FROM route_cache ORDER BY last_used ASC").fetchall()
+        evicted = []
+        for key, size in rows[:-1]:
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        self.conn.executemany("DELETE FROM route_cache WHERE cache_key = ?", evicted)
+
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+
+
+class RouteCache:
+    # in-memory LRU in front of the disk store; only touched from the event loop,
+    # disk reads/writes go through RouteManager so they can run off-loop
+
+    def __init__(self, store=None, max_entries=256):
+        self.store = store
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "inflight_waits": 0}
+
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+
+    def remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
@@ -0,0 +1,187 @@
+import numpy as np
+
+
+EARTH_RADIUS_M = 6371008.8
+
+
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    # works on scalars or numpy arrays (broadcasts), all inputs in degrees
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    d_lat = lat2 - lat1
+    d_lon = lon2 - lon1
+    a = np.sin(d_lat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(d_lon / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+
+
+def initial_bearing(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    d_lon = lon2 - lon1
+    y = np.sin(d_lon) * np.cos(lat2)
+    x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(d_lon)
+    return (np.degrees(np.arctan2(y, x)) + 360) % 360
+
+
+
+
+class RouteGeometry:
+    # polyline held as lat/lon arrays instead of a list of [lon, lat] pairs, with
+    # per-segment length/bearing and cumulative distance precomputed once so a
+    # vehicle's position is just "metres along the route".
+    # one instance is shared by every vehicle on a route+direction, so the arrays
+    # are read-only. dtype=np.float32 halves them (~0.5 m at these longitudes);
+    # derived values are computed in float64 first, and cumulative stays float64
+    # since it's the axis positions are searched on
+
+    def __init__(self, lats, lons, dtype=np.float64):
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        segment_lengths = haversine_m(lats[:-1], lons[:-1], lats[1:], lons[1:])
+
+        self.dtype = np.dtype(dtype)
+        self.lats = lats.astype(self.dtype, copy=False)
+        self.lons = lons.astype(self.dtype, copy=False)
+        self.segment_lengths = segment_lengths.astype(self.dtype, copy=False)
+        self.bearings = initial_bearing(lats[:-1], lons[:-1], lats[1:], lons[1:]).astype(self.dtype, copy=False)
+        self.cumulative = np.concatenate(([0.0], np.cumsum(segment_lengths)))
+        self.total_length = float(self.cumulative[-1]) if len(self.cumulative) else 0.0
+        for arr in self.arrays():
+            arr.setflags(write=False)
+
+
+    @classmethod
+    def from_api_coords(cls, coords, dtype=np.float64):
+        # geoapify returns [lon, lat] pairs
+        arr = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        return cls(arr[:, 1], arr[:, 0], dtype)
+
+
+    def __len__(self):
+        return len(self.lats)
+
+
+    def arrays(self):
+        return (self.lats, self.lons, self.segment_lengths, self.bearings, self.cumulative)
+
+
+    @property
+    def nbytes(self):
+        return sum(arr.nbytes for arr in self.arrays())
+
+
+    def simplified(self, tolerance_m, keep=()):
+        # (geometry, old index -> new index); `keep` indices (snapped stops) survive
+        kept = simplify_polyline(self.lats, self.lons, tolerance_m, keep=keep)
+        remap = {int(old): new for new, old in enumerate(kept)}
+        return RouteGeometry(self.lats[kept], self.lons[kept], self.dtype), remap
+
+
+    def to_api_coords(self):
+        return np.column_stack((self.lons, self.lats))
+
+
+    def point_index_at(self, distance):
+        # index of the last polyline point at or before `distance`
+        idx = int(np.searchsorted(self.cumulative, distance, side='right')) - 1
+        return min(max(idx, 0), len(self.lats) - 1)
+
+
+    def position_at(self, distance, point_index=None):
+        # (lat, lon, bearing, segment_index) at `distance` metres along the route;
+        # pass point_index if the caller already looked it up
+        if point_index is None:
+            point_index = self.point_index_at(distance)
+        seg = min(point_index, len(self.lats) - 2)
+        start = float(self.cumulative[seg])
+        length = float(self.segment_lengths[seg])
+        frac = (distance - start) / length if length > 0 else 0.0
+        frac = min(max(frac, 0.0), 1.0)
+        lat0, lat1 = float(self.lats[seg]), float(self.lats[seg + 1])
+        lon0, lon1 = float(self.lons[seg]), float(self.lons[seg + 1])
+        return lat0 + frac * (lat1 - lat0), lon0 + frac * (lon1 - lon0), float(self.bearings[seg]), seg
+
+
+    def nearest_index(self, lat, lon):
+        return int(np.argmin(haversine_m(lat, lon, self.lats, self.lons)))
+
+
+    def nearest_indices(self, lats, lons, chunk_size=64):
+        # snaps every query point in one pass; chunked so a long stop list
+        # against a long polyline doesn't build one huge distance matrix
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        out = np.empty(len(lats), dtype=np.int64)
+        for start in range(0, len(lats), chunk_size):
+            q_lat = lats[start:start + chunk_size, None]
+            q_lon = lons[start:start + chunk_size, None]
+            dist = haversine_m(q_lat, q_lon, self.lats[None, :], self.lons[None, :])
+            out[start:start + chunk_size] = np.argmin(dist, axis=1)
+        return out
+
+
+
+
+def great_circle_points(lat1, lon1, lat2, lon2, spacing_m=25.0):
+    # points every ~spacing_m along the great circle, both ends included
+    distance = float(haversine_m(lat1, lon1, lat2, lon2))
+    n = max(1, int(np.ceil(distance / spacing_m)))
+    if distance == 0:
+        return np.full(n + 1, lat1, dtype=np.float64), np.full(n + 1, lon1, dtype=np.float64)
+
+    phi1, lam1, phi2, lam2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    delta = distance / EARTH_RADIUS_M
+    f = np.linspace(0.0, 1.0, n + 1)
+    a = np.sin((1 - f) * delta) / np.sin(delta)
+    b = np.sin(f * delta) / np.sin(delta)
+    x = a * np.cos(phi1) * np.cos(lam1) + b * np.cos(phi2) * np.cos(lam2)
+    y = a * np.cos(phi1) * np.sin(lam1) + b * np.cos(phi2) * np.sin(lam2)
+    z = a * np.sin(phi1) + b * np.sin(phi2)
+    lats = np.degrees(np.arctan2(z, np.sqrt(x * x + y * y)))
+    lons = np.degrees(np.arctan2(y, x))
+    return lats, lons
+
+
+
+
+def simplify_polyline(lats, lons, tolerance_m, keep=None):
+    # Douglas-Peucker: sorted indices of the points to keep so no dropped point is
+    # more than tolerance_m from the simplified line. `keep` indices (stops, status
+    # changes) are always kept and split the line. distances are on a local
+    # equirectangular projection, plenty accurate at city/route scale
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    n = len(lats)
+    if n <= 2:
+        return np.arange(n)
+
+    cos_lat = np.cos(np.radians(lats.mean()))
+    x = np.radians(lons) * cos_lat * EARTH_RADIUS_M
+    y = np.radians(lats) * EARTH_RADIUS_M
+
+    mask = np.zeros(n, dtype=bool)
+    mask[[0, -1]] = True
+    if keep is not None:
+        mask[np.asarray(list(keep), dtype=np.int64)] = True
+
+    anchors = np.flatnonzero(mask)
+    stack = list(zip(anchors[:-1].tolist(), anchors[1:].tolist()))
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        dx, dy = x[end] - x[start], y[end] - y[start]
+        px, py = x[start + 1:end] - x[start], y[start + 1:end] - y[start]
+        length_sq = dx * dx + dy * dy
+        # distance to the segment, not the infinite line, so trails that double back are kept
+        t = np.clip((px * dx + py * dy) / length_sq, 0.0, 1.0) if length_sq > 0 else 0.0
+        dist = np.hypot(px - t * dx, py - t * dy)
+        i = int(np.argmax(dist))
+        if dist[i] > tolerance_m:
+            split = start + 1 + i
+            mask[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+    return np.flatnonzero(mask)
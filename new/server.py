@@ -1,7 +1,18 @@
 import time
-import sqlite3
-from flask import Flask, render_template
-from flask_socketio import SocketIO
+import gevent
+import gevent.event
+import gevent.socket
+from flask import Flask, Response, jsonify, render_template, request
+from flask_socketio import SocketIO, emit, join_room, leave_room
+
+from db import get_db
+from eta import EtaEngine, parse_epoch
+from event_bus import EVENT_BUS_ADDRESS, split_addresses, subscribe
+from metrics import escape_label, metrics, profiler
+from query_cache import QueryCache
+from spatial_index import GridIndex
+from subscriptions import RoomRegistry, parse_room, route_room, stop_room
+from wire_format import Encoder, format_info, negotiate, pack_records
 
 
 
@@ -12,73 +23,648 @@ socketio = SocketIO(app, async_mode='gevent')
 
 
 
+# sqlite calls block, so they run on gevent's native threadpool while the
+# calling greenlet waits; the hub keeps serving sockets in the meantime
+def db_read(sql, params=(), label=None):
+    return gevent.get_hub().threadpool.apply(get_db(DB_PATH).read, (sql, params, label))
 
 
+def db_read_one(sql, params=(), label=None):
+    return gevent.get_hub().threadpool.apply(get_db(DB_PATH).read_one, (sql, params, label))
 
-# Updated gets vehicle data by users location, eg for jalandhar bus stand 
-# it fetches all busses which have that stop in common
-def get_vehicles_data_by_waypoint(waypoint_name):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    cursor.execute("""
+
+def get_data_version(name):
+    row = db_read_one("SELECT version FROM data_versions WHERE name = ?", (name,), label=f"{name}_version")
+    return row['version'] if row else 0
+
+
+def get_routes_version():
+    return get_data_version('routes')
+
+
+EMIT_INTERVAL = 2
+
+# client-facing lookups; entries expire with the emitter tick and are dropped
+# early when positions on their routes change
+query_cache = QueryCache(ttl=EMIT_INTERVAL, event_factory=gevent.event.Event)
+
+
+
+
+
+
+
+class WaypointRouteIndex:
+    # waypoint_name -> route_ids, rebuilt only when add_data bumps the 'routes' version.
+    # refresh() reads that version, so it runs from the background tasks; lookups
+    # only read the in-memory map
+
+    def __init__(self):
+        self.version = None
+        self.routes_by_waypoint = {}
+
+
+    def _rebuild(self, version):
+        # the first build has nothing cached on top of it to drop
+        changed = self.version is not None and self.version != version
+        routes_by_waypoint = {}
+        for row in db_read("SELECT DISTINCT waypoint_name, route_id FROM waypoints", label="waypoint_route_index"):
+            routes_by_waypoint.setdefault(row['waypoint_name'], set()).add(row['route_id'])
+        self.routes_by_waypoint = routes_by_waypoint
+        self.version = version
+        if changed:
+            query_cache.invalidate()
+
+
+    def refresh(self):
+        version = get_routes_version()
+        if version != self.version:
+            self._rebuild(version)
+
+
+    def route_ids_for(self, waypoint_names):
+        if self.version is None:
+            self.refresh()
+        route_ids = set()
+        for name in waypoint_names:
+            route_ids.update(self.routes_by_waypoint.get(name, ()))
+        return route_ids
+
+
+    def invalidate(self):
+        self.version = None
+
+
+waypoint_route_index = WaypointRouteIndex()
+rooms = RoomRegistry()
+
+
+
+
+
+
+
+def _query_vehicles_on_routes(route_ids):
+    if not route_ids:
+        return []
+    placeholders = ",".join("?" * len(route_ids))
+    return db_read(f"""
         SELECT
             p.vehicle_id,
+            p.timestamp,
             p.latitude,
             p.longitude,
             p.heading,
             p.status,
             p.speed_kmh,
-            p.gps_status
-        FROM live_gps_positions p
-        INNER JOIN (
-            SELECT vehicle_id, MAX(timestamp) as max_ts
-            FROM live_gps_positions
-            GROUP BY vehicle_id
-        ) latest ON p.vehicle_id = latest.vehicle_id AND p.timestamp = latest.max_ts
+            p.gps_status,
+            v.current_route_id
+        FROM vehicle_latest_position p
         INNER JOIN vehicles v ON p.vehicle_id = v.vehicle_id
-        WHERE v.current_route_id IN (
-            SELECT DISTINCT route_id FROM waypoints WHERE waypoint_name = ?
-        )
-    """, (waypoint_name,))
-    
-    vehicles = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+        WHERE v.current_route_id IN ({placeholders})
+    """, sorted(route_ids), label="vehicles_on_routes")
+
+
+
+
+# all vehicles on any route that serves one of the given stops, one row per vehicle.
+# with the event bus they come from live_state, which is ahead of tracking.db
+def get_vehicles_data_by_waypoints(waypoint_names):
+    route_ids = waypoint_route_index.route_ids_for(waypoint_names)
+    if live_state.active:
+        return live_state.vehicles_by_room({None: route_ids})[None]
+    vehicles = _query_vehicles_on_routes(route_ids)
+    for vehicle in vehicles:
+        del vehicle['current_route_id']
     return vehicles
 
 
 
 
+# Updated gets vehicle data by users location, eg for jalandhar bus stand 
+# it fetches all busses which have that stop in common
+def get_vehicles_data_by_waypoint(waypoint_name):
+    with metrics.timer("get_vehicles_data_by_waypoint"):
+        route_ids = waypoint_route_index.route_ids_for([waypoint_name])
+        return query_cache.get(("vehicles_by_waypoint", waypoint_name),
+                               lambda: get_vehicles_data_by_waypoints([waypoint_name]), tags=route_ids)
+
+
+
+
+def _routes_of_rooms(room_names):
+    routes_of_room = {}
+    for room in room_names:
+        kind, key = parse_room(room)
+        if kind == "route":
+            routes_of_room[room] = {key}
+        else:
+            routes_of_room[room] = waypoint_route_index.routes_by_waypoint.get(key, set())
+    return routes_of_room
+
+
+
+
+# vehicles for each stop:/route: room, from a single query over the union of their routes
+# (or straight from memory when positions arrive over the event bus)
+def get_vehicles_by_room(room_names):
+    waypoint_route_index.refresh()
+    routes_of_room = _routes_of_rooms(room_names)
+
+    if live_state.active:
+        live_state.refresh_routes()
+        return live_state.vehicles_by_room(routes_of_room)
+
+    by_route = {}
+    for vehicle in _query_vehicles_on_routes(set().union(*routes_of_room.values())):
+        by_route.setdefault(vehicle.pop('current_route_id'), []).append(vehicle)
+
+    return {
+        room: [v for route_id in route_ids for v in by_route.get(route_id, ())]
+        for room, route_ids in routes_of_room.items()
+    }
+
+
+
+
+class LiveVehicleState:
+    # latest position per vehicle fed by the event bus, so pushes don't wait on tracking.db
+
+    def __init__(self):
+        self.active = False
+        self.positions = {}
+        self.route_of = {}
+        self.vehicles_on_route = {}
+        self.dirty_routes = set()
+        self.routes_version = None
+        self.unknown_vehicles = False
+        self.stats = {"packets": 0}
+
+
+    def load(self):
+        self.refresh_routes(force=True)
+        for row in db_read("""
+            SELECT vehicle_id, timestamp, latitude, longitude, heading, status, speed_kmh, gps_status
+            FROM vehicle_latest_position
+        """, label="latest_positions"):
+            self.positions[row['vehicle_id']] = row
+        self.active = True
+
+
+    def refresh_routes(self, force=False):
+        version = get_routes_version()
+        if not force and not self.unknown_vehicles and version == self.routes_version:
+            return
+        rows = db_read("SELECT vehicle_id, current_route_id FROM vehicles", label="vehicle_routes")
+        self.route_of = {row['vehicle_id']: row['current_route_id'] for row in rows}
+        self.vehicles_on_route = {}
+        for vehicle_id, route_id in self.route_of.items():
+            self.vehicles_on_route.setdefault(route_id, set()).add(vehicle_id)
+        self.routes_version = version
+        self.unknown_vehicles = False
+
+
+    def on_message(self, topic, packet):
+        if topic == "metrics":
+            metrics.set_remote("simulator", packet)
+            return
+        if topic != "gps":
+            return
+        vehicle_id = packet['vehicle_id']
+        self.positions[vehicle_id] = {
+            'vehicle_id': vehicle_id,
+            'timestamp': packet['timestamp'],
+            'latitude': packet['location']['lat'],
+            'longitude': packet['location']['lon'],
+            'heading': packet['heading'],
+            'status': packet['status'],
+            'speed_kmh': packet['speed_kmh'],
+            'gps_status': packet['gps_status'],
+        }
+        nearby.on_position(self.positions[vehicle_id])
+        route_id = self.route_of.get(vehicle_id)
+        if route_id is None:
+            self.unknown_vehicles = True
+        else:
+            self.dirty_routes.add(route_id)
+        self.stats["packets"] += 1
+
+
+    def take_dirty_routes(self):
+        dirty, self.dirty_routes = self.dirty_routes, set()
+        return dirty
+
+
+    def vehicles_by_room(self, routes_of_room):
+        positions = self.positions
+        return {
+            room: [positions[v] for route_id in route_ids for v in self.vehicles_on_route.get(route_id, ()) if v in positions]
+            for room, route_ids in routes_of_room.items()
+        }
 
 
+live_state = LiveVehicleState()
 
 
 
+
+MAX_NEARBY_RADIUS_M = 50000
+MAX_NEARBY_RESULTS = 100
+
+class NearbyIndex:
+    # latest vehicle positions and every waypoint in grid indexes, for "near me"
+    # lookups by rider location; queries never touch tracking.db
+
+    def __init__(self):
+        self.vehicles = GridIndex()
+        self.waypoints = GridIndex()
+        self.positions = {}
+        self.waypoint_rows = {}
+        self.routes_version = None
+        self.last_timestamp = ""
+
+
+    def on_position(self, position):
+        vehicle_id = position['vehicle_id']
+        self.positions[vehicle_id] = position
+        self.vehicles.upsert(vehicle_id, position['latitude'], position['longitude'])
+
+
+    def refresh_waypoints(self):
+        version = get_routes_version()
+        if version == self.routes_version:
+            return
+        rows = db_read(
+            "SELECT waypoint_id, route_id, waypoint_name, latitude, longitude FROM waypoints", label="nearby_waypoints"
+        )
+        self.waypoints = GridIndex()
+        self.waypoint_rows = {}
+        for row in rows:
+            self.waypoint_rows[row['waypoint_id']] = row
+            self.waypoints.upsert(row['waypoint_id'], row['latitude'], row['longitude'])
+        self.routes_version = version
+
+
+    def refresh_vehicles(self):
+        # without the event bus, pick up whatever the simulator wrote since the last pass
+        rows = db_read("""
+            SELECT vehicle_id, timestamp, latitude, longitude, heading, status, speed_kmh, gps_status
+            FROM vehicle_latest_position WHERE timestamp >= ?
+        """, (self.last_timestamp,), label="nearby_vehicles")
+        for row in rows:
+            self.last_timestamp = max(self.last_timestamp, row['timestamp'])
+            self.on_position(row)
+
+
+    def query(self, lat, lon, radius_m=None, k=10):
+        k = min(k, MAX_NEARBY_RESULTS)
+        if radius_m is None:
+            found = self.vehicles.nearest(lat, lon, k, max_radius_m=MAX_NEARBY_RADIUS_M)
+        else:
+            found = self.vehicles.within(lat, lon, min(radius_m, MAX_NEARBY_RADIUS_M), limit=k)
+        vehicles = [dict(self.positions[vehicle_id], distance_m=round(distance, 1)) for vehicle_id, distance in found]
+
+        nearest_waypoint = None
+        for waypoint_id, distance in self.waypoints.nearest(lat, lon, 1):
+            nearest_waypoint = dict(self.waypoint_rows[waypoint_id], distance_m=round(distance, 1))
+        return {"vehicles": vehicles, "nearest_waypoint": nearest_waypoint}
+
+
+nearby = NearbyIndex()
+
+
+def _nearby_args(args):
+    # lat/lon required; radius (metres) and k optional. raises ValueError on bad input
+    lat, lon = float(args['lat']), float(args['lon'])
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError("lat/lon out of range")
+    radius = args.get('radius')
+    k = int(args.get('k', 10))
+    if k <= 0 or (radius is not None and float(radius) <= 0):
+        raise ValueError("radius and k must be positive")
+    return lat, lon, float(radius) if radius is not None else None, k
+
+
+
+
+ETA_POLL_INTERVAL = 2
+ETA_QUANTUM = 15    # seconds; an ETA is pushed again only once it moves by this much
+
+class EtaFeed:
+    # tails waypoint_history by history_id into the eta engine and builds the
+    # per-stop-room 'eta' payloads that go out next to the position deltas.
+    # arrivals are on the simulator's clock, which may be accelerated or virtual,
+    # so "now" is the latest timestamp seen on a position or arrival, not time.time()
+
+    def __init__(self):
+        self.engine = EtaEngine()
+        self.routes_version = None
+        self.sent = {}
+        self.now = None
+
+
+    def refresh(self):
+        version = get_routes_version()
+        if version == self.routes_version:
+            return
+        self.engine.load_stops(db_read("""
+            SELECT waypoint_id, route_id, sequence, waypoint_name, latitude, longitude, waypoint_type, is_skippable
+            FROM waypoints
+        """, label="eta_stops"))
+        self.engine.load_vehicles(db_read("SELECT vehicle_id, service_type, direction FROM vehicles", label="eta_vehicles"))
+        self.routes_version = version
+
+
+    def poll(self, batch_size=5000):
+        self.refresh()
+        while True:
+            rows = db_read("""
+                SELECT history_id, vehicle_id, waypoint_id, arrival_timestamp FROM waypoint_history
+                WHERE history_id > ? ORDER BY history_id LIMIT ?
+            """, (self.engine.last_history_id, batch_size), label="eta_tail")
+            for row in rows:
+                self.engine.on_arrival(row['history_id'], row['vehicle_id'], row['waypoint_id'], row['arrival_timestamp'])
+            if rows:
+                self._seen(parse_epoch(rows[-1]['arrival_timestamp']))
+            if len(rows) < batch_size:
+                break
+        for room in list(self.sent):
+            if room not in rooms.members:
+                del self.sent[room]
+
+
+    def payload(self, room, vehicles=()):
+        kind, name = parse_room(room)
+        if kind != "stop":
+            return None
+        for v in vehicles:
+            at = parse_epoch(v['timestamp'])
+            self._seen(at)
+            self.engine.on_position(v['vehicle_id'], v['latitude'], v['longitude'], at)
+        etas = [[vehicle_id, round(eta / ETA_QUANTUM) * ETA_QUANTUM] for vehicle_id, eta in self.engine.etas_for_stop(name)]
+        # t: the simulator's "now" the etas are against, for clients to offset their own clock by
+        return {"r": room, "t": round(self.now if self.now is not None else time.time()), "e": etas}
+
+
+    def _seen(self, epoch):
+        if self.now is None or epoch > self.now:
+            self.now = epoch
+
+
+    def update(self, room, vehicles):
+        # the payload if it differs from what this room last got, else None
+        payload = self.payload(room, vehicles)
+        if payload is None or self.sent.get(room) == payload["e"]:
+            return None
+        self.sent[room] = payload["e"]
+        return payload
+
+
+eta_feed = EtaFeed()
+
+
+
+
+
+
+
+
+
+DEFAULT_TRACKED_STOPS = ["Ludhiana Bus Stand", "Phillaur", "Jalandhar Bus Stand"]
+
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_template('index.html', stops=DEFAULT_TRACKED_STOPS)
+
+@app.route('/api/nearby')
+def api_nearby():
+    # /api/nearby?lat=30.9&lon=75.85&radius=2000&k=10 (no radius: the k nearest)
+    try:
+        lat, lon, radius, k = _nearby_args(request.args)
+    except (KeyError, ValueError) as e:
+        return jsonify({"error": f"bad query: {e}"}), 400
+    return jsonify(nearby.query(lat, lon, radius, k))
+
+@app.route('/api/vehicles')
+def api_vehicles():
+    # /api/vehicles?stop=Phillaur, every vehicle on a route serving the stop
+    stop = request.args.get('stop')
+    if not stop:
+        return jsonify({"error": "bad query: stop is required"}), 400
+    return jsonify(get_vehicles_data_by_waypoint(stop))
+
+@app.route('/metrics')
+def prometheus_metrics():
+    metrics.set_gauge("connected_clients", len(connected_clients))
+    metrics.set_gauge("active_rooms", len(rooms.members))
+    metrics.set_gauge("bus_packets", live_state.stats["packets"])
+    metrics.set_gauge("query_cache_entries", len(query_cache))
+    for key, value in query_cache.stats.items():
+        metrics.set_gauge(f"query_cache_{key}", value)
+    lines = ["# TYPE tracking_db_query_seconds_total counter", "# TYPE tracking_db_queries_total counter"]
+    for label, q in sorted(get_db(DB_PATH).metrics().items()):
+        query = escape_label(label)
+        lines.append(f'tracking_db_query_seconds_total{{source="server",query="{query}"}} {q["total_ms"] / 1000}')
+        lines.append(f'tracking_db_queries_total{{source="server",query="{query}"}} {q["count"]}')
+    return Response(metrics.render(extra=lines), mimetype="text/plain; version=0.0.4")
+
+@app.route('/debug/profiler', methods=['GET', 'POST'])
+def debug_profiler():
+    # POST ?action=start|stop toggles the sampler; GET returns collapsed stacks so far
+    if request.method == 'POST':
+        action = request.args.get('action')
+        if action == 'start':
+            profiler.start()
+        elif action == 'stop':
+            profiler.stop()
+        else:
+            return jsonify({"error": "action must be start or stop"}), 400
+        return jsonify({"running": profiler.running, "samples": sum(profiler.samples.values())})
+    return Response(profiler.report(), mimetype="text/plain")
+
+@app.route('/api/db-stats')
+def db_stats():
+    # per-query timings from the shared connection pool
+    return jsonify(get_db(DB_PATH).metrics())
+
+def push_room_updates(room_names):
+    with metrics.timer("emitter_cycle"):
+        _push_room_updates(room_names)
+
+def emit_room_payload(event, room, payload):
+    # json clients share one emit to the socket.io room; binary ones each get a
+    # frame against their own vehicle-id dictionary, with the records packed once
+    members = rooms.members.get(room, ())
+    binary = [sid for sid in members if sid in wire_encoders]
+    if len(binary) < len(members):
+        socketio.emit(event, payload, to=room, skip_sid=binary or None)
+    if binary:
+        records = pack_records(payload["u"])
+        for sid in binary:
+            frame = _encode_for(sid, event, payload, records)
+            if frame is not None:
+                socketio.emit(event, frame, to=sid)
+
+def _encode_for(sid, event, payload, records=None):
+    # None when this payload can't be framed for the connection (an id over 255
+    # bytes, too many new ids); it is skipped there and every other client still gets it
+    try:
+        return wire_encoders[sid].encode(event, payload, records)
+    except ValueError as e:
+        metrics.inc("wire_encode_errors")
+        print(f"[wire] dropped a {event} for {sid} in {payload['r']}: {e}")
+        return None
+
+def _push_room_updates(room_names):
+    with metrics.timer("get_vehicles_by_room"):
+        vehicles_by_room = get_vehicles_by_room(room_names)
+    for room, vehicles in vehicles_by_room.items():
+        delta = rooms.update(room, vehicles)
+        if delta:
+            emit_room_payload('delta', room, delta)
+        etas = eta_feed.update(room, vehicles)
+        if etas:
+            socketio.emit('eta', etas, to=room)
+
+def background_refresher():
+    # slow-moving state: new arrivals for ETAs, route edits, and positions for
+    # the nearby index when there's no event bus feeding it
+    while True:
+        waypoint_route_index.refresh()
+        eta_feed.poll()
+        nearby.refresh_waypoints()
+        if not live_state.active:
+            nearby.refresh_vehicles()
+        socketio.sleep(ETA_POLL_INTERVAL)
 
 def background_location_emitter():
-    tracked_locations = ["Ludhiana Bus Stand", "Phillaur", "Jalandhar Bus Stand"]
+    positions_version = None
     while True:
-        all_vehicles = {}
-        for location in tracked_locations:
-            vehicles_for_location = get_vehicles_data_by_waypoint(location)
-            for vehicle in vehicles_for_location:
-                all_vehicles[vehicle['vehicle_id']] = vehicle
-
-        if all_vehicles:
-            socketio.emit('live_location_update', {'vehicles': list(all_vehicles.values())})
+        # the simulator bumps 'positions' on every batch it writes
+        version = get_data_version('positions')
+        if version != positions_version:
+            query_cache.invalidate()
+            positions_version = version
+
+        # rooms with nobody in them cost nothing; each room's payload is built once
+        active = rooms.active_rooms()
+        if active:
+            push_room_updates(active)
         
-        socketio.sleep(2)
+        socketio.sleep(EMIT_INTERVAL)
+
+BUS_PUSH_INTERVAL = 0.1
+
+def event_bus_emitter():
+    # with the bus, only rooms whose routes saw a packet since the last pass are rebuilt
+    while True:
+        socketio.sleep(BUS_PUSH_INTERVAL)
+        dirty = live_state.take_dirty_routes()
+        if not dirty and not live_state.unknown_vehicles:
+            continue
+        query_cache.invalidate(tags=dirty)
+        active = rooms.active_rooms()
+        touched = [room for room, route_ids in _routes_of_rooms(active).items() if route_ids & dirty]
+        if touched or live_state.unknown_vehicles:
+            push_room_updates(touched)
+
+def start_event_bus_consumer():
+    waypoint_route_index.refresh()
+    live_state.load()
+    # several addresses when following a sharded simulator, one per shard
+    for address in split_addresses(EVENT_BUS_ADDRESS):
+        socketio.start_background_task(
+            subscribe, address, live_state.on_message, socket_module=gevent.socket, sleep=socketio.sleep
+        )
+    socketio.start_background_task(target=event_bus_emitter)
+
+connected_clients = set()
+# sid -> wire_format.Encoder for clients that negotiated the binary format
+wire_encoders = {}
 
 @socketio.on('connect')
-def handle_connect():
+def handle_connect(auth=None):
+    connected_clients.add(request.sid)
+    fmt = negotiate((auth or {}).get('format') if isinstance(auth, dict) else None)
+    if fmt == "binary":
+        wire_encoders[request.sid] = Encoder()
+    emit('format', format_info(fmt))
     print('Client connected to user server')
 
+@socketio.on('disconnect')
+def handle_disconnect():
+    connected_clients.discard(request.sid)
+    wire_encoders.pop(request.sid, None)
+    rooms.drop(request.sid)
+
+def _requested_rooms(data):
+    # stop names and integer route ids from a subscribe/unsubscribe payload. raises ValueError on bad input
+    data = data or {}
+    if not isinstance(data, dict):
+        raise ValueError("expected an object with 'stops' and/or 'routes'")
+    stops, routes = data.get('stops', []), data.get('routes', [])
+    if not isinstance(stops, list) or not isinstance(routes, list):
+        raise ValueError("'stops' and 'routes' must be lists")
+    if not all(isinstance(name, str) and name for name in stops):
+        raise ValueError("stop names must be non-empty strings")
+    if not all((isinstance(r, int) and not isinstance(r, bool)) or (isinstance(r, str) and r.isdecimal()) for r in routes):
+        raise ValueError("route ids must be integers")
+    return [stop_room(name) for name in stops] + [route_room(int(r)) for r in routes]
+
+@socketio.on('subscribe')
+def handle_subscribe(data):
+    try:
+        requested = _requested_rooms(data)
+    except ValueError as e:
+        emit('subscribe', {"error": f"bad request: {e}"})
+        return
+    fresh = [room for room in requested if not rooms.has_state(room)]
+    if fresh:
+        for room, vehicles in get_vehicles_by_room(fresh).items():
+            rooms.update(room, vehicles)
+
+    for room in requested:
+        join_room(room)
+        rooms.join(request.sid, room)
+        snapshot = rooms.snapshot(room)
+        if request.sid in wire_encoders:
+            frame = _encode_for(request.sid, 'snapshot', snapshot)
+            if frame is not None:
+                emit('snapshot', frame)
+        else:
+            emit('snapshot', snapshot)
+        etas = eta_feed.payload(room)
+        if etas:
+            emit('eta', etas)
+
+@socketio.on('nearby')
+def handle_nearby(data):
+    try:
+        lat, lon, radius, k = _nearby_args(data or {})
+    except (KeyError, ValueError, TypeError) as e:
+        emit('nearby', {"error": f"bad query: {e}"})
+        return
+    emit('nearby', nearby.query(lat, lon, radius, k))
+
+@socketio.on('unsubscribe')
+def handle_unsubscribe(data):
+    try:
+        requested = _requested_rooms(data)
+    except ValueError as e:
+        emit('unsubscribe', {"error": f"bad request: {e}"})
+        return
+    for room in requested:
+        leave_room(room)
+        rooms.leave(request.sid, room)
+
 if __name__ == '__main__':
-    socketio.start_background_task(target=background_location_emitter)
+    nearby.refresh_waypoints()
+    nearby.refresh_vehicles()
+    socketio.start_background_task(target=background_refresher)
+    if EVENT_BUS_ADDRESS:
+        start_event_bus_consumer()
+    else:
+        socketio.start_background_task(target=background_location_emitter)
     socketio.run(app, debug=True, port=5000, host='0.0.0.0', allow_unsafe_werkzeug=True)
 
 
@@ -0,0 +1,287 @@
+import argparse
+import asyncio
+import multiprocessing as mp
+import queue
+import random
+import signal
+import time
+import zlib
+
+from db import get_db
+from event_bus import EVENT_BUS_ADDRESS, EventPublisher, PacketFanout, shard_address
+from history_store import HistoryStore
+from retention import RetentionManager
+from route_cache import RouteCache, RouteCacheStore
+from sim_clock import SIM_SEED, VirtualClock, make_clock, vehicle_rng
+from simulation import (
+    DB_PATH, SIM_WARM_START, GpsWriter, RouteManager, StopEventLog, VehicleSimulator,
+    get_vehicles_for_simulation, load_checkpoints, periodic_checkpointer, periodic_compactor, save_checkpoints,
+)
+
+
+
+# python sharding.py --shards 8 --by route
+# splits the fleet over worker processes, each running its own simulators and
+# GpsWriter against tracking.db; the coordinator only sees per-shard stats.
+# with EVENT_BUS_ADDRESS set every shard publishes on its own address
+# (event_bus.shard_address) and server.py subscribes to the whole list.
+# live_gps_positions isn't trimmed per vehicle; the first shard also runs the
+# history compactor and retention for the whole file, as simulation.main does
+
+
+
+
+def partition_vehicles(vehicles, shards, by="route"):
+    buckets = [[] for _ in range(shards)]
+    if by == "hash":
+        # crc32 rather than hash(), which is salted per process
+        for v in vehicles:
+            buckets[zlib.crc32(v['vehicle_id'].encode()) % shards].append(v)
+        return buckets
+
+    # whole routes per shard so route geometry is fetched/cached once per process;
+    # biggest routes first onto the emptiest shard keeps the split roughly even
+    by_route = {}
+    for v in vehicles:
+        by_route.setdefault(v['current_route_id'], []).append(v)
+    for route_vehicles in sorted(by_route.values(), key=len, reverse=True):
+        min(buckets, key=len).extend(route_vehicles)
+    return buckets
+
+
+
+
+class PacketCounter:
+    # stands in for GpsWriter when a run shouldn't touch the database (benchmarks)
+
+    def __init__(self):
+        self.stats = {"submitted": 0, "rows_written": 0, "last_flush_ms": 0.0, "queue_depth": 0}
+
+    def submit(self, packet):
+        self.stats["submitted"] += 1
+
+    def submit_many(self, packets):
+        self.stats["submitted"] += len(packets)
+
+    def start(self):
+        return asyncio.create_task(asyncio.sleep(float("inf")))
+
+    async def close(self):
+        pass
+
+
+
+
+async def run_shard(shard_id, vehicles, stats_queue, stop_event, engine="tasks",
+                    write_db=True, update_interval=1, report_interval=5, seed=SIM_SEED,
+                    event_bus_address=EVENT_BUS_ADDRESS, maintenance=False):
+    # maintenance: compact and prune the shared tables from this shard
+    clock = make_clock()
+    route_manager = RouteManager(route_cache=RouteCache(store=RouteCacheStore()))
+    # bounded by the history store's hot window instead of per-vehicle trims
+    gps_writer = GpsWriter(max_entries=None, report_interval=0) if write_db else PacketCounter()
+    writer_task = gps_writer.start()
+    sink, publisher = gps_writer, None
+    if event_bus_address:
+        publisher = EventPublisher(shard_address(event_bus_address, shard_id))
+        await publisher.start()
+        sink = PacketFanout(gps_writer, publisher)
+    stop_events = StopEventLog(publisher, write_db=write_db)
+    stop_events_task = stop_events.start()
+    if isinstance(clock, VirtualClock) and write_db:
+        clock.add_barrier(gps_writer.wait_for_capacity)
+    clock_task = clock.start()
+    speeds = [vehicle_rng(seed, v['vehicle_id']).randint(35, 60) for v in vehicles]
+    # this shard's vehicles only, and not from before a route reassignment (as in simulation.main)
+    checkpoints = {}
+    if write_db and SIM_WARM_START:
+        route_of = {v['vehicle_id']: v['current_route_id'] for v in vehicles}
+        checkpoints = {
+            vehicle_id: c for vehicle_id, c in (await get_db(DB_PATH).arun(load_checkpoints)).items()
+            if c.route_id == route_of.get(vehicle_id)
+        }
+        if checkpoints:
+            print(f"[shard-{shard_id}] warm start, resuming {len(checkpoints)} of {len(vehicles)} vehicles")
+
+    if engine == "vectorized":
+        from fleet_engine import FleetEngine
+        fleet = FleetEngine(route_manager, sink, update_interval=update_interval, clock=clock,
+                            stop_events=stop_events, rng=random.Random(f"{seed}:shard-{shard_id}") if seed is not None else None)
+        await fleet.load(vehicles, speeds, checkpoints)
+        tasks = [fleet.start()]
+        vehicle_ticks = lambda: fleet.stats["ticks"] * len(fleet.vehicle_ids)
+        collect_checkpoints = fleet.checkpoints
+    else:
+        simulators = [
+            VehicleSimulator(v, route_manager, sink, speed_kmh=speed, update_interval=update_interval,
+                             clock=clock, rng=vehicle_rng(seed, v['vehicle_id']), stop_events=stop_events,
+                             checkpoint=checkpoints.get(v['vehicle_id']))
+            for v, speed in zip(vehicles, speeds)
+        ]
+        tasks = [s.start() for s in simulators]
+        vehicle_ticks = lambda: sum(s.ticks for s in simulators)
+        collect_checkpoints = lambda: [c for c in (s.checkpoint() for s in simulators) if c is not None]
+    checkpointer_task = None
+    if write_db:
+        checkpointer_task = asyncio.create_task(clock.track(periodic_checkpointer(collect_checkpoints, clock)))
+    maintenance_tasks = []
+    if write_db and maintenance:
+        maintenance_tasks = [
+            asyncio.create_task(clock.track(periodic_compactor(HistoryStore(), clock))),
+            asyncio.create_task(clock.track(RetentionManager().run(clock))),
+        ]
+
+    def report(stopped=False):
+        writer_stats = gps_writer.stats
+        stats_queue.put({
+            "shard": shard_id,
+            "vehicles": len(vehicles),
+            "vehicle_ticks": vehicle_ticks(),
+            "packets": writer_stats["submitted"],
+            "rows_written": writer_stats["rows_written"],
+            "last_flush_ms": writer_stats["last_flush_ms"],
+            "queue_depth": writer_stats["queue_depth"],
+            "failed_tasks": sum(1 for t in tasks if t.done() and not t.cancelled() and t.exception()),
+            "time": time.time(),
+            "stopped": stopped,
+        })
+
+    last_report = 0.0
+    try:
+        while not stop_event.is_set():
+            await asyncio.sleep(min(report_interval, 0.5))
+            if time.time() - last_report >= report_interval:
+                report()
+                last_report = time.time()
+    finally:
+        # taken before cancelling, which cuts dwells short
+        final_checkpoints, ended_at = collect_checkpoints(), clock.now().isoformat()
+        for t in tasks + maintenance_tasks + [checkpointer_task]:
+            if t is not None:
+                t.cancel()
+        await asyncio.gather(*tasks, *maintenance_tasks, return_exceptions=True)
+        if clock_task is not None:
+            clock_task.cancel()
+
+        if write_db:
+            # also updates vehicles.last_known_*, as save_vehicle_states did
+            await get_db(DB_PATH).arun(save_checkpoints, final_checkpoints, ended_at)
+        for t in (stop_events_task, writer_task):
+            t.cancel()
+        await asyncio.gather(stop_events_task, writer_task, return_exceptions=True)
+        await gps_writer.close()
+        if publisher is not None:
+            await publisher.close()
+        report(stopped=True)
+
+
+
+def shard_worker(shard_id, vehicles, stats_queue, stop_event, options):
+    # ctrl-c goes to the coordinator, which then asks every shard to stop cleanly
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(run_shard(shard_id, vehicles, stats_queue, stop_event, **options))
+
+
+
+
+class Coordinator:
+
+    def __init__(self, shards, by="route", **shard_options):
+        self.shards = shards
+        self.by = by
+        self.shard_options = shard_options
+        self.stats_queue = mp.Queue()
+        self.stop_event = mp.Event()
+        self.processes = []
+        self.shard_ids = []
+        self.event_bus_address = shard_options.get("event_bus_address", EVENT_BUS_ADDRESS)
+        self.latest = {}
+        self.rates = {}     # shard -> ticks/sec between its last two running reports
+
+
+    def start(self, vehicles):
+        for shard_id, shard_vehicles in enumerate(partition_vehicles(vehicles, self.shards, self.by)):
+            if not shard_vehicles:
+                continue
+            # exactly one shard compacts and prunes
+            options = dict(self.shard_options, maintenance=not self.processes)
+            p = mp.Process(
+                target=shard_worker, name=f"shard-{shard_id}",
+                args=(shard_id, shard_vehicles, self.stats_queue, self.stop_event, options),
+            )
+            p.start()
+            self.processes.append(p)
+            self.shard_ids.append(shard_id)
+        print(f"[coordinator] {len(vehicles)} vehicles over {len(self.processes)} shards (by {self.by})")
+        if self.event_bus_address:
+            addresses = ",".join(shard_address(self.event_bus_address, shard_id) for shard_id in self.shard_ids)
+            print(f"[coordinator] start server.py with EVENT_BUS_ADDRESS={addresses}")
+
+
+    def poll(self, timeout=1.0):
+        deadline = time.time() + timeout
+        while True:
+            try:
+                stats = self.stats_queue.get(timeout=max(0.0, deadline - time.time()))
+            except queue.Empty:
+                break
+            shard = stats["shard"]
+            prev = self.latest.get(shard)
+            # the final report can land right after a periodic one, so it doesn't set the rate
+            if prev and not stats["stopped"] and stats["time"] > prev["time"]:
+                self.rates[shard] = (stats["vehicle_ticks"] - prev["vehicle_ticks"]) / (stats["time"] - prev["time"])
+            self.latest[shard] = stats
+        return self.aggregate()
+
+
+    def aggregate(self):
+        totals = {"shards": len(self.latest), "vehicles": 0, "vehicle_ticks": 0, "packets": 0,
+                  "rows_written": 0, "queue_depth": 0, "failed_tasks": 0, "ticks_per_sec": 0.0}
+        for shard, stats in self.latest.items():
+            for key in ("vehicles", "vehicle_ticks", "packets", "rows_written", "queue_depth", "failed_tasks"):
+                totals[key] += stats[key]
+            totals["ticks_per_sec"] += self.rates.get(shard, 0.0)
+        totals["ticks_per_sec"] = round(totals["ticks_per_sec"], 1)
+        totals["alive"] = sum(1 for p in self.processes if p.is_alive())
+        return totals
+
+
+    def stop(self, timeout=30):
+        self.stop_event.set()
+        deadline = time.time() + timeout
+        for p in self.processes:
+            p.join(max(0.0, deadline - time.time()))
+        for p in self.processes:
+            if p.is_alive():
+                print(f"[coordinator] {p.name} did not stop in time, terminating")
+                p.terminate()
+                p.join()
+        return self.poll(timeout=0.5)
+
+
+    def run(self, vehicles, duration=None, report_interval=5):
+        self.start(vehicles)
+        started = time.time()
+        try:
+            while duration is None or time.time() - started < duration:
+                totals = self.poll(timeout=report_interval)
+                print(f"[coordinator] {totals}")
+                if totals["alive"] == 0:
+                    break
+        except KeyboardInterrupt:
+            print("[coordinator] stopping shards...")
+        return self.stop()
+
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the simulation sharded over worker processes")
+    parser.add_argument("--shards", type=int, default=mp.cpu_count())
+    parser.add_argument("--by", choices=["route", "hash"], default="route")
+    parser.add_argument("--engine", choices=["tasks", "vectorized"], default="tasks")
+    parser.add_argument("--duration", type=float, default=None, help="seconds, default runs until ctrl-c")
+    args = parser.parse_args()
+
+    coordinator = Coordinator(args.shards, by=args.by, engine=args.engine)
+    print(coordinator.run(get_vehicles_for_simulation(), duration=args.duration))
@@ -0,0 +1,172 @@
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import time
+from datetime import datetime, timezone, timedelta
+
+from metrics import metrics
+
+
+
+# SIM_CLOCK picks how simulated time relates to wall time:
+#   realtime     (default) sleeps and timestamps are wall-clock
+#   accelerated  SIM_SPEEDUP x faster than wall-clock
+#   virtual      as fast as possible; time jumps to the next wake-up once every
+#                simulator is asleep, so a day of traffic takes as long as the maths
+# SIM_START fixes the simulated start time (ISO 8601) and SIM_SEED the random
+# stream, which together make a run replayable
+SIM_CLOCK = os.environ.get("SIM_CLOCK", "realtime")
+SIM_SPEEDUP = float(os.environ.get("SIM_SPEEDUP", "10"))
+SIM_START = os.environ.get("SIM_START")
+SIM_SEED = os.environ.get("SIM_SEED")
+
+
+
+
+class RealTimeClock:
+
+    def now(self):
+        return datetime.now(timezone.utc)
+
+    async def sleep(self, seconds):
+        # tick lag: how much later than asked the loop woke us, i.e. how far behind it is
+        started = time.monotonic()
+        await asyncio.sleep(seconds)
+        metrics.observe("tick_lag", max(time.monotonic() - started - seconds, 0.0))
+
+    def track(self, coro):
+        # virtual clocks need to know which tasks drive simulated time
+        return coro
+
+    def start(self):
+        return None
+
+
+
+
+class AcceleratedClock(RealTimeClock):
+
+    def __init__(self, speedup, start=None):
+        self.speedup = speedup
+        self.sim_start = start or datetime.now(timezone.utc)
+        self.wall_start = time.monotonic()
+
+    def now(self):
+        return self.sim_start + timedelta(seconds=(time.monotonic() - self.wall_start) * self.speedup)
+
+    async def sleep(self, seconds):
+        started = time.monotonic()
+        await asyncio.sleep(seconds / self.speedup)
+        metrics.observe("tick_lag", max(time.monotonic() - started - seconds / self.speedup, 0.0))
+
+
+
+
+class VirtualClock(RealTimeClock):
+
+    def __init__(self, start=None):
+        self.sim_start = start or datetime.now(timezone.utc)
+        self.elapsed = 0.0
+        self.participants = 0
+        self.parked = 0
+        self.sleepers = []
+        self._seq = itertools.count()
+        self._all_parked = asyncio.Event()
+        self.barriers = []
+
+
+    def now(self):
+        return self.sim_start + timedelta(seconds=self.elapsed)
+
+
+    def add_barrier(self, coro_fn):
+        # awaited before every time jump, e.g. to let the gps writer catch up
+        self.barriers.append(coro_fn)
+
+
+    def _check(self):
+        if self.participants and self.parked >= self.participants:
+            self._all_parked.set()
+
+
+    async def sleep(self, seconds):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.sleepers, (self.elapsed + max(seconds, 0.0), next(self._seq), future))
+        self.parked += 1
+        self._check()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self.parked -= 1
+                self._check()
+            raise
+
+
+    def track(self, coro):
+        self.participants += 1
+
+        async def participant():
+            try:
+                return await coro
+            finally:
+                self.participants -= 1
+                self._check()
+        return participant()
+
+
+    async def run(self):
+        while True:
+            await self._all_parked.wait()
+            self._all_parked.clear()
+            for barrier in self.barriers:
+                await barrier()
+
+            while self.sleepers and self.sleepers[0][2].done():
+                heapq.heappop(self.sleepers)
+            if not self.sleepers:
+                continue
+
+            wake_at = self.sleepers[0][0]
+            self.elapsed = max(self.elapsed, wake_at)
+            while self.sleepers and self.sleepers[0][0] <= wake_at:
+                _, _, future = heapq.heappop(self.sleepers)
+                if not future.done():
+                    future.set_result(None)
+                    self.parked -= 1
+            # woken tasks run before we look again
+            await asyncio.sleep(0)
+
+
+    def start(self):
+        return asyncio.create_task(self.run())
+
+
+
+
+def parse_start(value):
+    if not value:
+        return None
+    start = datetime.fromisoformat(value)
+    return start if start.tzinfo else start.replace(tzinfo=timezone.utc)
+
+
+
+def make_clock(mode=SIM_CLOCK, speedup=SIM_SPEEDUP, start=SIM_START):
+    if mode == "realtime":
+        return RealTimeClock()
+    if mode == "accelerated":
+        return AcceleratedClock(speedup, parse_start(start))
+    if mode == "virtual":
+        return VirtualClock(parse_start(start))
+    raise ValueError(f"Unknown SIM_CLOCK '{mode}', expected realtime, accelerated or virtual")
+
+
+
+def vehicle_rng(seed, vehicle_id):
+    # one stream per vehicle so replays don't depend on task scheduling order
+    if seed is None:
+        return random.Random()
+    return random.Random(f"{seed}:{vehicle_id}")
@@ -1,125 +1,425 @@
 import asyncio
 import json
-import math
+import os
 import random
-from datetime import datetime, timezone, timedelta
-import sqlite3
+import signal
+from collections import namedtuple
+from datetime import timedelta
+import time
 
-from geopy.distance import geodesic
-from geopy.point import Point
-from get_routes import get_route
+import numpy as np
+
+from database import bump_data_version
+from db import get_db
+from event_bus import EVENT_BUS_ADDRESS, EventPublisher, PacketFanout
+from get_routes import get_route, get_provider
+from history_store import HistoryStore
+from metrics import metrics, profiler
+from retention import RetentionManager
+from route_cache import RouteCache, RouteCacheStore, route_cache_key
+from route_geometry import RouteGeometry
+from sim_clock import RealTimeClock, VirtualClock, SIM_SEED, make_clock, vehicle_rng
 
 
 
 
 DB_PATH = 'tracking.db'
 
+# "tasks": one VehicleSimulator coroutine per bus, "vectorized": fleet_engine.FleetEngine
+SIM_ENGINE = os.environ.get("SIM_ENGINE", "tasks")
+
+Position = namedtuple('Position', ['latitude', 'longitude'])
+Checkpoint = namedtuple('Checkpoint', [
+    'vehicle_id', 'route_id', 'direction', 'distance_along_route', 'segment_index',
+    'latitude', 'longitude', 'status', 'dwell_remaining',
+])
+
 
 
 
 
 def get_vehicles_for_simulation():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM vehicles WHERE region = 'Punjab'")
-    vehicles = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return vehicles
+    return get_db(DB_PATH).read(
+        "SELECT * FROM vehicles WHERE region = 'Punjab'", label="vehicles_for_simulation"
+    )
 
 
 
 
 
 def get_mission_waypoints_for_route(route_id):
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("""
+    return get_db(DB_PATH).read("""
         SELECT waypoint_id, latitude, longitude, waypoint_type, is_major_stop, is_skippable
         FROM waypoints WHERE route_id = ? ORDER BY sequence ASC
-    """, (route_id,))
-    waypoints = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return waypoints
+    """, (route_id,), label="mission_waypoints")
+
 
 
 
 
+INSERT_POSITION_SQL = """
+    INSERT INTO live_gps_positions (vehicle_id, timestamp, latitude, longitude, speed_kmh, heading, status, gps_status)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
 
-def update_live_position_in_db(packet, max_entries=1000):
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO live_gps_positions (vehicle_id, timestamp, latitude, longitude, speed_kmh, heading, status, gps_status)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
+UPSERT_LATEST_POSITION_SQL = """
+    INSERT INTO vehicle_latest_position (vehicle_id, timestamp, latitude, longitude, speed_kmh, heading, status, gps_status)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (vehicle_id) DO UPDATE SET
+        timestamp = excluded.timestamp,
+        latitude = excluded.latitude,
+        longitude = excluded.longitude,
+        speed_kmh = excluded.speed_kmh,
+        heading = excluded.heading,
+        status = excluded.status,
+        gps_status = excluded.gps_status
+    WHERE excluded.timestamp >= vehicle_latest_position.timestamp
+"""
+
+
+
+def packet_to_row(packet):
+    return (
         packet['vehicle_id'], packet['timestamp'], packet['location']['lat'],
-        packet['location']['lon'], packet['speed_kmh'], packet['heading'], 
+        packet['location']['lon'], packet['speed_kmh'], packet['heading'],
         packet['status'], packet['gps_status']
-    ))
-    cursor.execute("""
-        DELETE FROM live_gps_positions WHERE id IN (
-            SELECT id FROM live_gps_positions WHERE vehicle_id = ?
-            ORDER BY timestamp DESC LIMIT -1 OFFSET ?
-        )
-    """, (packet['vehicle_id'], max_entries))
-    conn.commit()
-    conn.close()
+    )
+
+
+
+TRIM_POSITIONS_SQL = """
+    DELETE FROM live_gps_positions WHERE id IN (
+        SELECT id FROM live_gps_positions WHERE vehicle_id = ?
+        ORDER BY timestamp DESC LIMIT -1 OFFSET ?
+    )
+"""
+
+
+
+class GpsWriter:
+
+    def __init__(self, db_path=DB_PATH, flush_interval=0.5, batch_size=1000,
+                 max_entries=1000, trim_interval=60, report_interval=30):
+        # max_entries=None skips the per-vehicle trim (the history store bounds the table instead)
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_entries = max_entries
+        self.trim_interval = trim_interval
+        self.report_interval = report_interval
+        self.queue = asyncio.Queue()
+        self.db = None
+        self._vehicles_since_trim = set()
+        self.stats = {
+            "submitted": 0,
+            "flushes": 0,
+            "rows_written": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "queue_depth": 0,
+            "max_queue_depth": 0,
+            "trims": 0,
+        }
+
+
+
+    def submit(self, packet):
+        self.queue.put_nowait(packet)
+        self.stats["submitted"] += 1
+        depth = self.queue.qsize()
+        if depth > self.stats["max_queue_depth"]:
+            self.stats["max_queue_depth"] = depth
+
+
+    def submit_many(self, packets):
+        for packet in packets:
+            self.queue.put_nowait(packet)
+        self.stats["submitted"] += len(packets)
+        depth = self.queue.qsize()
+        if depth > self.stats["max_queue_depth"]:
+            self.stats["max_queue_depth"] = depth
+
+
+
+    def _write_batch(self, rows):
+        with self.db.transaction("gps_batch") as conn:
+            conn.executemany(INSERT_POSITION_SQL, rows)
+            conn.executemany(UPSERT_LATEST_POSITION_SQL, rows)
+            # lets server.py drop cached lookups once new positions are readable
+            bump_data_version(conn, 'positions')
+
+
+
+    def _trim(self, vehicle_ids):
+        self.db.write_many(TRIM_POSITIONS_SQL, [(vehicle_id, self.max_entries) for vehicle_id in vehicle_ids],
+                           label="gps_trim")
+
+
+
+    def _drain(self):
+        rows = []
+        while len(rows) < self.batch_size and not self.queue.empty():
+            rows.append(packet_to_row(self.queue.get_nowait()))
+        return rows
+
+
+
+    async def flush(self):
+        # gps_flush: the whole backlog, gps_write_batch: each transaction in it
+        if self.queue.empty():
+            return
+        with metrics.timer("gps_flush"):
+            await self._flush()
+
+
+    async def _flush(self):
+        while not self.queue.empty():
+            self.stats["queue_depth"] = self.queue.qsize()
+            rows = self._drain()
+            started = time.perf_counter()
+            await self.db.arun(self._write_batch, rows)
+            elapsed = time.perf_counter() - started
+            metrics.observe("gps_write_batch", elapsed)
+            elapsed_ms = elapsed * 1000
+
+            self.stats["flushes"] += 1
+            self.stats["rows_written"] += len(rows)
+            self.stats["last_flush_ms"] = round(elapsed_ms, 2)
+            self.stats["max_flush_ms"] = round(max(self.stats["max_flush_ms"], elapsed_ms), 2)
+            if self.max_entries is not None:
+                self._vehicles_since_trim.update(row[0] for row in rows)
+
+
+
+    async def trim(self):
+        vehicle_ids = list(self._vehicles_since_trim)
+        self._vehicles_since_trim.clear()
+        if vehicle_ids:
+            with metrics.timer("gps_trim"):
+                await self.db.arun(self._trim, vehicle_ids)
+            self.stats["trims"] += 1
 
 
 
+    def report(self):
+        s = self.stats
+        print(f"[gps-writer] rows={s['rows_written']} flushes={s['flushes']} "
+              f"last_flush={s['last_flush_ms']}ms max_flush={s['max_flush_ms']}ms "
+              f"queue={self.queue.qsize()} max_queue={s['max_queue_depth']}")
+
+
+
+    async def run(self):
+        # the shared writer connection; sharded runs have one per process on the same file
+        self.db = get_db(self.db_path)
+        last_trim = last_report = time.monotonic()
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+
+                now = time.monotonic()
+                if now - last_trim >= self.trim_interval:
+                    await self.trim()
+                    last_trim = now
+                if self.report_interval and now - last_report >= self.report_interval:
+                    self.report()
+                    last_report = now
+        finally:
+            await self.close()
+
+
+
+    async def wait_for_capacity(self, max_depth=50000):
+        # backpressure for virtual-time runs, which produce packets far faster than wall-clock
+        while self.queue.qsize() > max_depth:
+            await asyncio.sleep(self.flush_interval)
+
+
+
+    async def close(self):
+        if self.db is None:
+            return
+        await self.flush()
+        await self.trim()
+        self.db = None
+
+    def start(self):
+        return asyncio.create_task(self.run())
+
+
+
+
+
+SAVE_VEHICLE_STATE_SQL = """
+    UPDATE vehicles SET last_known_lat = ?, last_known_lon = ?,
+    last_segment_index = ?, direction = ? WHERE vehicle_id = ?
+"""
+
 
 
 def save_vehicle_state(vehicle_id, lat, lon, segment_idx, direction):
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    cursor = conn.cursor()
-    cursor.execute("""
-        UPDATE vehicles SET last_known_lat = ?, last_known_lon = ?,
-        last_segment_index = ?, direction = ? WHERE vehicle_id = ?
-    """, (lat, lon, segment_idx, direction, vehicle_id))
-    conn.commit()
-    conn.close()
+    get_db(DB_PATH).write(SAVE_VEHICLE_STATE_SQL, (lat, lon, segment_idx, direction, vehicle_id),
+                          label="save_vehicle_state")
+
+
+
+
+def save_vehicle_states(states):
+    # states: [(vehicle_id, lat, lon, segment_idx, direction), ...]
+    get_db(DB_PATH).write_many(
+        SAVE_VEHICLE_STATE_SQL,
+        [(lat, lon, segment_idx, direction, vehicle_id) for vehicle_id, lat, lon, segment_idx, direction in states],
+        label="save_vehicle_states",
+    )
+
+
+
+
+
+
+SAVE_CHECKPOINT_SQL = """
+    INSERT INTO vehicle_checkpoints
+    (vehicle_id, route_id, direction, distance_along_route, segment_index, latitude, longitude, status, dwell_remaining, saved_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (vehicle_id) DO UPDATE SET
+        route_id = excluded.route_id,
+        direction = excluded.direction,
+        distance_along_route = excluded.distance_along_route,
+        segment_index = excluded.segment_index,
+        latitude = excluded.latitude,
+        longitude = excluded.longitude,
+        status = excluded.status,
+        dwell_remaining = excluded.dwell_remaining,
+        saved_at = excluded.saved_at
+"""
+
 
 
+def save_checkpoints(checkpoints, saved_at):
+    # one transaction for the whole fleet; vehicles.last_known_* follows along so a
+    # cold start (no checkpoint) still snaps close to where the bus really was
+    with get_db(DB_PATH).transaction("save_checkpoints") as conn:
+        conn.executemany(SAVE_CHECKPOINT_SQL, [(*c, saved_at) for c in checkpoints])
+        conn.executemany(SAVE_VEHICLE_STATE_SQL, [
+            (c.latitude, c.longitude, c.segment_index, c.direction, c.vehicle_id) for c in checkpoints
+        ])
 
 
 
+def load_checkpoints():
+    return {
+        row['vehicle_id']: Checkpoint(*(row[field] for field in Checkpoint._fields))
+        for row in get_db(DB_PATH).read("SELECT * FROM vehicle_checkpoints", label="load_checkpoints")
+    }
 
-def log_waypoint_arrival(vehicle_id, waypoint_id, timestamp):
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO waypoint_history (vehicle_id, waypoint_id, arrival_timestamp)
-        VALUES (?, ?, ?)
-    """, (vehicle_id, waypoint_id, timestamp))
-    conn.commit()
-    conn.close()
 
 
 
 
 
-def prune_waypoint_history(days=3):
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    cursor = conn.cursor()
-    cutoff_date = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
-    cursor.execute("DELETE FROM waypoint_history WHERE arrival_timestamp < ?", (cutoff_date,))
-    deleted_count = cursor.rowcount
-    conn.commit()
-    conn.close()
-    if deleted_count > 0:
-        print(f"Pruned {deleted_count} old waypoint history records.")
+INSERT_ARRIVAL_SQL = """
+    INSERT INTO waypoint_history (vehicle_id, waypoint_id, arrival_timestamp)
+    VALUES (?, ?, ?)
+"""
 
 
 
+def log_waypoint_arrivals(arrivals):
+    # arrivals: [(vehicle_id, waypoint_id, timestamp), ...]
+    get_db(DB_PATH).write_many(INSERT_ARRIVAL_SQL, arrivals, label="log_waypoint_arrivals")
+
+
+
+
+class StopEventLog:
+    # arrivals and departures from either engine. recording one is a list append;
+    # arrivals reach waypoint_history in one write_many per flush, and both kinds
+    # go out on the event bus as "arrival"/"departure" {vehicle_id, waypoint_id, timestamp}
+
+    def __init__(self, publisher=None, write_db=True, flush_interval=1.0):
+        self.publisher = publisher
+        self.write_db = write_db
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.stats = {"arrivals": 0, "departures": 0, "flushes": 0, "rows_written": 0}
+
+
+    def _publish(self, topic, events):
+        if self.publisher is not None:
+            self.publisher.publish_many(topic, [
+                {"vehicle_id": vehicle_id, "waypoint_id": waypoint_id, "timestamp": timestamp}
+                for vehicle_id, waypoint_id, timestamp in events
+            ])
+
+
+    def arrivals(self, events):
+        # events: [(vehicle_id, waypoint_id, timestamp), ...]
+        if not events:
+            return
+        self.stats["arrivals"] += len(events)
+        if self.write_db:
+            self.pending.extend(events)
+        self._publish("arrival", events)
+
+
+    def departures(self, events):
+        if not events:
+            return
+        self.stats["departures"] += len(events)
+        self._publish("departure", events)
+
+
+    def arrival(self, vehicle_id, waypoint_id, timestamp):
+        self.arrivals([(vehicle_id, waypoint_id, timestamp)])
+
+
+    def departure(self, vehicle_id, waypoint_id, timestamp):
+        self.departures([(vehicle_id, waypoint_id, timestamp)])
+
+
+    async def flush(self):
+        rows, self.pending = self.pending, []
+        if rows:
+            await get_db(DB_PATH).arun(log_waypoint_arrivals, rows)
+            self.stats["flushes"] += 1
+            self.stats["rows_written"] += len(rows)
+
+
+    async def run(self):
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+        finally:
+            await self.flush()
+
+
+    def start(self):
+        return asyncio.create_task(self.run())
+
+
+
+
+
+
+
+
+ROUTE_DTYPE = os.environ.get("SIM_ROUTE_DTYPE", "float64")
+ROUTE_SIMPLIFY_M = float(os.environ.get("SIM_ROUTE_SIMPLIFY_M", 0))
 
 
 
 class RouteManager:
 
-    def __init__(self, max_requests_per_second=4):
+    def __init__(self, max_requests_per_second=4, route_cache=None, dtype=ROUTE_DTYPE, simplify_m=ROUTE_SIMPLIFY_M):
+        # dtype: float32 halves the shared route arrays; simplify_m: Douglas-Peucker
+        # tolerance for the fetched polyline (0 keeps every point), stops always survive
         self.semaphore = asyncio.Semaphore(max_requests_per_second)
+        self.route_cache = route_cache if route_cache is not None else RouteCache()
+        self.dtype = np.dtype(dtype)
+        self.simplify_m = simplify_m
+        self._inflight = {}
 
 
     def _format_waypoints_for_api(self, waypoint_list):
@@ -127,39 +427,123 @@ class RouteManager:
     
 
 
-    async def build_full_route(self, mission_waypoints, vehicle_id):
+    async def build_full_route(self, mission_waypoints, vehicle_id, route_id=None, direction=None):
+        with metrics.timer("build_full_route"):
+            return await self._build_full_route(mission_waypoints, vehicle_id, route_id, direction)
+
+
+
+    async def _build_full_route(self, mission_waypoints, vehicle_id, route_id, direction):
+        # vehicles sharing a route+direction share one geometry; concurrent
+        # callers for the same key wait on a single fetch
+        key = route_cache_key(route_id, direction, mission_waypoints, get_provider().name, self.simplify_m)
+        cache = self.route_cache
+
+        entry = cache.get(key)
+        if entry is not None:
+            cache.stats["hits"] += 1
+            return entry
+
+        if key in self._inflight:
+            cache.stats["inflight_waits"] += 1
+            return await asyncio.shield(self._inflight[key])
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            entry = None
+            if cache.store is not None:
+                entry = await asyncio.to_thread(cache.store.get, key, self.dtype)
+                if entry is not None:
+                    cache.stats["disk_hits"] += 1
+
+            if entry is None:
+                cache.stats["misses"] += 1
+                entry = await self._fetch_route(mission_waypoints, vehicle_id)
+                if entry[0] and cache.store is not None:
+                    await asyncio.to_thread(cache.store.put, key, route_id, direction, *entry)
+
+            if entry[0]:
+                cache.remember(key, entry)
+            future.set_result(entry)
+            return entry
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # nobody may be waiting; don't let asyncio warn about an unretrieved exception
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+
+
+    async def _fetch_route(self, mission_waypoints, vehicle_id):
         print(f"[{vehicle_id}] Building new detailed route...")
         waypoints_str = self._format_waypoints_for_api(mission_waypoints)
 
         async with self.semaphore:
-            api_route_coords = await asyncio.to_thread(get_route, waypoints_str)
+            with metrics.timer("route_api"):
+                api_route_coords = await asyncio.to_thread(get_route, waypoints_str)
 
         if not api_route_coords: return [], {}
-        full_route_coords = api_route_coords
+        geometry = RouteGeometry.from_api_coords(api_route_coords, self.dtype)
         stop_indices = {}
 
-        for wp in mission_waypoints:
-            if wp.get('waypoint_type') != 'start':
-                wp_lat, wp_lon = wp['latitude'], wp['longitude']
-                closest_point_index = min(range(len(full_route_coords)),
-                    key=lambda i: geodesic((wp_lat, wp_lon), (full_route_coords[i][1], full_route_coords[i][0])).m)
-                stop_indices[closest_point_index] = {
-                    "waypoint_id": wp['waypoint_id'],
-                    "is_major": wp.get('is_major_stop', False),
-                    "is_skippable": wp.get('is_skippable', False)
-                }
+        stops = [wp for wp in mission_waypoints if wp.get('waypoint_type') != 'start']
+        snapped = geometry.nearest_indices(
+            [wp['latitude'] for wp in stops], [wp['longitude'] for wp in stops]
+        )
 
-        return full_route_coords, stop_indices
+        for wp, closest_point_index in zip(stops, snapped):
+            stop_indices[int(closest_point_index)] = {
+                "waypoint_id": wp['waypoint_id'],
+                "is_major": wp.get('is_major_stop', False),
+                "is_skippable": wp.get('is_skippable', False)
+            }
+
+        if self.simplify_m:
+            points = len(geometry)
+            geometry, remap = geometry.simplified(self.simplify_m, keep=list(stop_indices))
+            stop_indices = {remap[i]: info for i, info in stop_indices.items()}
+            print(f"[{vehicle_id}] Simplified route from {points} to {len(geometry)} points.")
+
+        return geometry, stop_indices
+
+
+    def memory_report(self, n_vehicles=None):
+        # bytes held by the shared route arrays, per cached route+direction
+        routes = [
+            {"key": key, "points": len(geometry), "bytes": geometry.nbytes}
+            for key, (geometry, _) in self.route_cache.entries.items() if geometry
+        ]
+        total = sum(r["bytes"] for r in routes)
+        return {
+            "dtype": self.dtype.name,
+            "simplify_m": self.simplify_m,
+            "routes": routes,
+            "total_bytes": total,
+            "bytes_per_route": round(total / len(routes)) if routes else 0,
+            "bytes_per_vehicle": round(total / n_vehicles) if n_vehicles else None,
+        }
 
 
 
 
 
 class VehicleSimulator:
-    def __init__(self, vehicle_data, route_manager, speed_kmh=50, update_interval=1):
+    def __init__(self, vehicle_data, route_manager, gps_writer, speed_kmh=50, update_interval=1,
+                 clock=None, rng=None, checkpoint=None, stop_events=None):
         self.vehicle_data = vehicle_data
         self.vehicle_id = vehicle_data['vehicle_id']
         self.route_manager = route_manager
+        self.gps_writer = gps_writer
+        # None only counts stop events (benchmarks); main() passes a started StopEventLog
+        self.stop_events = stop_events if stop_events is not None else StopEventLog(write_db=False)
+        self.clock = clock or RealTimeClock()
+        self.rng = rng or random.Random()
         self.speed_mps = speed_kmh * 1000 / 3600
         self.update_interval = update_interval
         self.current_pos = None
@@ -167,115 +551,130 @@ class VehicleSimulator:
         self.gps_status = "functional"
         self.direction = vehicle_data['direction']
         self.current_segment_index = vehicle_data['last_segment_index']
+        self.distance_along_route = 0.0
+        self.dwell_until = None
+        self.ticks = 0
+        # warm start: resume the first trip from the checkpoint instead of snapping
+        self.resume_from = checkpoint
+        if checkpoint is not None:
+            self.direction = checkpoint.direction
 
 
 
     async def run(self):
-        mission_waypoints = get_mission_waypoints_for_route(self.vehicle_data['current_route_id'])
+        db = get_db(DB_PATH)
+        mission_waypoints = await db.arun(get_mission_waypoints_for_route, self.vehicle_data['current_route_id'])
         if self.direction == 'backward':
             mission_waypoints.reverse()
 
+        # only the first trip resumes or snaps; later ones start at the terminus the bus turned around at
+        resume = self.resume_from
+        snap_to = None
+        if resume is None and self.vehicle_data.get('last_known_lat') and self.vehicle_data.get('last_known_lon'):
+            snap_to = (self.vehicle_data['last_known_lat'], self.vehicle_data['last_known_lon'])
 
         while True:
-            full_route_coords, stop_indices = await self.route_manager.build_full_route(mission_waypoints, self.vehicle_id)
-            if not full_route_coords:
-                await asyncio.sleep(60); continue
-
-            #  FIXEd starting opints  off the mapp
-            full_route_points = [Point(latitude=p[1], longitude=p[0]) for p in full_route_coords]
-
-            if self.vehicle_data.get('last_known_lat') and self.vehicle_data.get('last_known_lon'):
-               
-                initial_pos_from_db = Point(
-                    latitude=self.vehicle_data['last_known_lat'], 
-                    longitude=self.vehicle_data['last_known_lon']
-                )
-
-                
-                snapped_start_point = min(
-                    full_route_points,
-                    key=lambda p: geodesic(initial_pos_from_db, p).meters
-                )
-                
-                self.current_pos = snapped_start_point
-                
-                self.current_segment_index = full_route_points.index(snapped_start_point)
-                
-                
-                if self.current_segment_index >= len(full_route_points) - 1:
-                    self.current_segment_index = len(full_route_points) - 2
-
-                print(f"[{self.vehicle_id}] Snapped to route at index {self.current_segment_index}.")
-
+            geometry, stop_indices = await self.route_manager.build_full_route(
+                mission_waypoints, self.vehicle_id,
+                route_id=self.vehicle_data['current_route_id'], direction=self.direction
+            )
+            if not geometry or len(geometry) < 2:
+                await self.clock.sleep(60); continue
+
+            dwell = 0.0
+            if resume is not None:
+                self.distance_along_route = min(float(resume.distance_along_route), geometry.total_length)
+                point_index = geometry.point_index_at(self.distance_along_route)
+                if resume.status in ("stopped", "finished"):
+                    self.status, dwell = resume.status, resume.dwell_remaining
+            elif snap_to is not None:
+                #  FIXEd starting opints  off the mapp
+                point_index = min(geometry.nearest_index(*snap_to), len(geometry) - 2)
+                self.distance_along_route = float(geometry.cumulative[point_index])
+                print(f"[{self.vehicle_id}] Snapped to route at index {point_index}.")
             else:
-                
-                self.current_segment_index = 0
-                self.current_pos = full_route_points[0]
-            
+                point_index = 0
+                self.distance_along_route = 0.0
+            resume = snap_to = None
+
+            lat, lon, bearing, self.current_segment_index = geometry.position_at(self.distance_along_route, point_index)
+            self.current_pos = Position(lat, lon)
+
+            # stops in distance order; next_stop is the first one still ahead of the bus
+            stop_points = sorted(stop_indices)
+            stop_distances = geometry.cumulative[stop_points]
+            next_stop = int(np.searchsorted(stop_distances, self.distance_along_route, side='right'))
+            if dwell > 0:
+                await self.dwell(dwell)
+            if self.status == "stopped" and next_stop > 0 and stop_distances[next_stop - 1] >= self.distance_along_route - 1.0:
+                # resumed mid-dwell at a stop: its arrival went out before the restart
+                self.stop_events.departure(self.vehicle_id, stop_indices[stop_points[next_stop - 1]]['waypoint_id'],
+                                           self.clock.now().isoformat())
 
             self.status = "moving"
-            
-
+            express = self.vehicle_data['service_type'] == 'Express'
+
+
+            while self.distance_along_route < geometry.total_length:
+                step_started = time.perf_counter()
+                target_distance = min(self.distance_along_route + self.speed_mps * self.update_interval, geometry.total_length)
+
+                # every stop between here and target_distance, however many: express buses run
+                # through skippable ones, anything else pulls up at the stop instead of driving past
+                stop_info = None
+                while next_stop < len(stop_points) and stop_distances[next_stop] <= target_distance:
+                    info = stop_indices[stop_points[next_stop]]
+                    next_stop += 1
+                    if express and info['is_skippable']:
+                        continue
+                    stop_info = info
+                    target_distance = float(stop_distances[next_stop - 1])
+                    break
+
+                point_index = geometry.point_index_at(target_distance)
+                self.distance_along_route = target_distance
+                lat, lon, bearing, self.current_segment_index = geometry.position_at(target_distance, point_index)
+                self.current_pos = Position(lat, lon)
 
-            while self.current_segment_index < len(full_route_points) - 1:
-                distance_to_travel = self.speed_mps * self.update_interval
-                start_of_segment = self.current_pos
-                
-                
-                end_of_segment = full_route_points[self.current_segment_index + 1]
-                
-                bearing = self._calculate_bearing(start_of_segment, end_of_segment)
-                remaining_segment_distance = geodesic(start_of_segment, end_of_segment).meters
-
-                if distance_to_travel >= remaining_segment_distance:
-                    self.current_pos = end_of_segment
-                    self.current_segment_index += 1
-                else:
-                    destination = geodesic(meters=distance_to_travel).destination(start_of_segment, bearing)
-                    self.current_pos = destination
-                
                 packet = self.generate_gps_packet(bearing)
-                update_live_position_in_db(packet)
-
-                if self.current_segment_index in stop_indices:
-                    stop_info = stop_indices[self.current_segment_index]
-                    
-                    should_stop = True
-                    if stop_info['is_skippable'] and self.vehicle_data['service_type'] == 'Express':
-                        should_stop = False
-
-                    if should_stop:
-                        self.status = "stopped"
-                        stop_duration = 600 if stop_info["is_major"] else random.randint(240, 300)
-                        packet = self.generate_gps_packet(bearing)
-                        update_live_position_in_db(packet)
-                        log_waypoint_arrival(self.vehicle_id, stop_info['waypoint_id'], packet['timestamp'])
-                        await asyncio.sleep(stop_duration)
-                        self.status = "moving"
-                
-                await asyncio.sleep(self.update_interval)
+                self.gps_writer.submit(packet)
+                metrics.observe("movement_step", time.perf_counter() - step_started)
+
+                if stop_info is not None:
+                    self.status = "stopped"
+                    stop_duration = 600 if stop_info["is_major"] else self.rng.randint(240, 300)
+                    packet = self.generate_gps_packet(bearing)
+                    self.gps_writer.submit(packet)
+                    self.stop_events.arrival(self.vehicle_id, stop_info['waypoint_id'], packet['timestamp'])
+                    await self.dwell(stop_duration)
+                    self.stop_events.departure(self.vehicle_id, stop_info['waypoint_id'], self.clock.now().isoformat())
+                    self.status = "moving"
+
+                self.ticks += 1
+                await self.clock.sleep(self.update_interval)
 
             self.status = "finished"
-            end_stop_duration = random.randint(600, 900)
+            end_stop_duration = self.rng.randint(600, 900)
             packet = self.generate_gps_packet(0)
-            update_live_position_in_db(packet)
+            self.gps_writer.submit(packet)
             
+            # the terminus is the start of the next trip in the new direction
             self.direction = 'backward' if self.direction == 'forward' else 'forward'
             mission_waypoints.reverse()
-            
-            save_vehicle_state(self.vehicle_id, self.current_pos.latitude, self.current_pos.longitude, 0, self.direction)
-            await asyncio.sleep(end_stop_duration)
-    
+            self.distance_along_route = 0.0
+            self.current_segment_index = 0
 
+            await db.arun(save_vehicle_state, self.vehicle_id, self.current_pos.latitude, self.current_pos.longitude,
+                          self.current_segment_index, self.direction)
+            await self.dwell(end_stop_duration)
 
 
-    def _calculate_bearing(self, a, b):
-        lat1, lon1 = math.radians(a.latitude), math.radians(a.longitude)
-        lat2, lon2 = math.radians(b.latitude), math.radians(b.longitude)
-        d_lon = lon2 - lon1
-        y = math.sin(d_lon) * math.cos(lat2)
-        x = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * math.cos(lat2) * math.cos(d_lon)
-        return (math.degrees(math.atan2(y, x)) + 360) % 360
+    async def dwell(self, seconds):
+        self.dwell_until = self.clock.now() + timedelta(seconds=seconds)
+        try:
+            await self.clock.sleep(seconds)
+        finally:
+            self.dwell_until = None
 
 
 
@@ -283,7 +682,7 @@ class VehicleSimulator:
     def generate_gps_packet(self, heading):
         return {
             "vehicle_id": self.vehicle_id,
-            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "timestamp": self.clock.now().isoformat(),
             "location": {
                 "lat": round(self.current_pos.latitude, 6),
                 "lon": round(self.current_pos.longitude, 6)
@@ -295,41 +694,188 @@ class VehicleSimulator:
         }
 
 
+    def state(self):
+        if self.current_pos is None:
+            return None
+        return (self.vehicle_id, self.current_pos.latitude, self.current_pos.longitude,
+                self.current_segment_index, self.direction)
+
+
+    def checkpoint(self):
+        if self.current_pos is None:
+            return None
+        dwell = (self.dwell_until - self.clock.now()).total_seconds() if self.dwell_until else 0.0
+        return Checkpoint(self.vehicle_id, self.vehicle_data['current_route_id'], self.direction,
+                          self.distance_along_route, self.current_segment_index,
+                          self.current_pos.latitude, self.current_pos.longitude, self.status, max(dwell, 0.0))
+
+
     def start(self):
-        return asyncio.create_task(self.run())
+        return asyncio.create_task(self.clock.track(self.run()))
+
 
 
 
+COMPACT_INTERVAL = 600
 
-async def periodic_pruner():
+
+
+async def periodic_compactor(history_store, clock, interval=COMPACT_INTERVAL):
+    # simulated-time cadence so virtual runs roll history over just like real ones
     while True:
-        await asyncio.sleep(3600)
-        prune_waypoint_history()
+        await clock.sleep(interval)
+        moved = await history_store.compact(clock.now())
+        if moved:
+            s = history_store.stats
+            print(f"[history] compacted {moved} rows, kept {s['points_kept']}/{s['points_in']} points, "
+                  f"{s['bytes']} bytes in {s['last_compact_ms']}ms, writer held at most {s['max_write_ms']}ms")
 
 
 
-async def main():
-    route_manager = RouteManager()
-    vehicles_to_simulate = get_vehicles_for_simulation()
-    
-    pruner_task = asyncio.create_task(periodic_pruner())
-    
+CHECKPOINT_INTERVAL = float(os.environ.get("SIM_CHECKPOINT_INTERVAL", 60))
+SIM_WARM_START = os.environ.get("SIM_WARM_START", "1") != "0"
 
-    simulators = []
-    for vehicle_data in vehicles_to_simulate:
-        speed = random.randint(35, 60)
-        simulator = VehicleSimulator(vehicle_data, route_manager, speed_kmh=speed)
-        simulators.append(simulator)
-    
 
 
-    tasks = [s.start() for s in simulators]
-    tasks.append(pruner_task)
-        
-    await asyncio.gather(*tasks)
+async def periodic_checkpointer(collect, clock, interval=CHECKPOINT_INTERVAL):
+    # simulated-time cadence; `collect` snapshots every vehicle on the loop, the write happens off it
+    db = get_db(DB_PATH)
+    while True:
+        await clock.sleep(interval)
+        checkpoints = collect()
+        with metrics.timer("checkpoint"):
+            await db.arun(save_checkpoints, checkpoints, clock.now().isoformat())
+
+
+
+METRICS_INTERVAL = 5
+
+
+
+async def metrics_reporter(publisher, gps_writer, route_manager, interval=METRICS_INTERVAL):
+    # wall-clock cadence; the server merges these into its /metrics
+    while True:
+        await asyncio.sleep(interval)
+        for key in ("queue_depth", "rows_written", "last_flush_ms"):
+            metrics.set_gauge(f"gps_writer_{key}", gps_writer.stats[key])
+        for key, value in route_manager.route_cache.stats.items():
+            metrics.set_gauge(f"route_cache_{key}", value)
+        metrics.set_gauge("route_geometry_bytes", route_manager.memory_report()["total_bytes"])
+        metrics.set_gauge("event_bus_subscribers", publisher.stats["subscribers"])
+        metrics.set_gauge("event_bus_dropped", publisher.stats["dropped"])
+        publisher.publish("metrics", metrics.snapshot())
+
+
+
+def toggle_profiler():
+    # kill -USR1 <pid> starts sampling; the second one stops and writes collapsed stacks
+    if profiler.start():
+        print("[profiler] sampling started")
+        return
+    profiler.stop()
+    path = f"sim_profile_{os.getpid()}_{int(time.time())}.txt"
+    with open(path, "w") as f:
+        f.write(profiler.report())
+    print(f"[profiler] {sum(profiler.samples.values())} samples written to {path}")
+
+
+
+async def main(engine=SIM_ENGINE, clock=None, seed=SIM_SEED, duration=None):
+    # duration is in simulated seconds; None runs forever
+    clock = clock or make_clock()
+    route_manager = RouteManager(route_cache=RouteCache(store=RouteCacheStore()))
+    # live_gps_positions is bounded by the history store's hot window instead of per-vehicle trims
+    gps_writer = GpsWriter(max_entries=None)
+    history_store = HistoryStore()
+    retention = RetentionManager()
+    vehicles_to_simulate = get_vehicles_for_simulation()
+    speeds = [vehicle_rng(seed, v['vehicle_id']).randint(35, 60) for v in vehicles_to_simulate]
+    # a checkpoint from before a route reassignment is no use
+    route_of = {v['vehicle_id']: v['current_route_id'] for v in vehicles_to_simulate}
+    checkpoints = {
+        vehicle_id: c for vehicle_id, c in (load_checkpoints() if SIM_WARM_START else {}).items()
+        if c.route_id == route_of.get(vehicle_id)
+    }
+    if checkpoints:
+        print(f"[checkpoint] warm start, resuming {len(checkpoints)} of {len(vehicles_to_simulate)} vehicles")
+
+    writer_task = gps_writer.start()
+
+    # simulators submit to `sink`: the db writer, plus the live bus when enabled
+    sink = gps_writer
+    publisher = None
+    if EVENT_BUS_ADDRESS:
+        publisher = EventPublisher(EVENT_BUS_ADDRESS)
+        await publisher.start()
+        sink = PacketFanout(gps_writer, publisher)
+    stop_events = StopEventLog(publisher)
+    stop_events_task = stop_events.start()
+
+    if isinstance(clock, VirtualClock):
+        clock.add_barrier(gps_writer.wait_for_capacity)
+    clock_task = clock.start()
+    reporter_task = asyncio.create_task(metrics_reporter(publisher, gps_writer, route_manager)) if publisher else None
+    if hasattr(signal, "SIGUSR1"):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, toggle_profiler)
+    compactor_task = asyncio.create_task(clock.track(periodic_compactor(history_store, clock)))
+    pruner_task = asyncio.create_task(clock.track(retention.run(clock)))
+
+    if engine == "vectorized":
+        # imported here, fleet_engine imports the db helpers from this module
+        from fleet_engine import FleetEngine
+        fleet = FleetEngine(route_manager, sink, clock=clock, stop_events=stop_events,
+                            rng=random.Random(seed) if seed is not None else None)
+        await fleet.load(vehicles_to_simulate, speeds, checkpoints)
+        sim_tasks = [fleet.start()]
+        collect_checkpoints = fleet.checkpoints
+    else:
+        simulators = []
+        for vehicle_data, speed in zip(vehicles_to_simulate, speeds):
+            simulator = VehicleSimulator(vehicle_data, route_manager, sink, speed_kmh=speed,
+                                         clock=clock, rng=vehicle_rng(seed, vehicle_data['vehicle_id']),
+                                         checkpoint=checkpoints.get(vehicle_data['vehicle_id']),
+                                         stop_events=stop_events)
+            simulators.append(simulator)
+        sim_tasks = [s.start() for s in simulators]
+        collect_checkpoints = lambda: [c for c in (s.checkpoint() for s in simulators) if c is not None]
+    checkpointer_task = asyncio.create_task(clock.track(periodic_checkpointer(collect_checkpoints, clock)))
+
+    if duration is None:
+        await asyncio.gather(*sim_tasks, pruner_task, compactor_task, checkpointer_task, stop_events_task, writer_task)
+        return
+
+    await asyncio.create_task(clock.track(clock.sleep(duration)))
+    print(f"Simulated {duration}s, ending at {clock.now().isoformat()}")
+    final_checkpoints, ended_at = collect_checkpoints(), clock.now().isoformat()
+    for task in sim_tasks + [pruner_task, compactor_task, checkpointer_task, clock_task, reporter_task]:
+        if task is not None:
+            task.cancel()
+    await asyncio.gather(*sim_tasks, return_exceptions=True)
+    await get_db(DB_PATH).arun(save_checkpoints, final_checkpoints, ended_at)
+    # the last arrivals flush as the log's task unwinds
+    for task in (stop_events_task, writer_task):
+        task.cancel()
+    await asyncio.gather(stop_events_task, writer_task, return_exceptions=True)
+    if publisher is not None:
+        await publisher.close()
+    gps_writer.report()
+    routes = route_manager.memory_report(len(vehicles_to_simulate))
+    print(f"[routes] {len(routes['routes'])} routes, {routes['total_bytes']} bytes of {routes['dtype']} geometry, "
+          f"{routes['bytes_per_vehicle']} per vehicle")
+    vehicle_ticks = fleet.stats["packets"] if engine == "vectorized" else sum(s.ticks for s in simulators)
+    return {
+        "vehicles": len(vehicles_to_simulate),
+        "vehicle_ticks": vehicle_ticks,
+        "gps_writer": dict(gps_writer.stats),
+        "history": dict(history_store.stats),
+        "stop_events": dict(stop_events.stats),
+        "retention": dict(retention.stats),
+        "routes": {k: v for k, v in routes.items() if k != "routes"},
+    }
 
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    sim_duration = os.environ.get("SIM_DURATION")
+    asyncio.run(main(duration=float(sim_duration) if sim_duration else None))
 
@@ -0,0 +1,133 @@
+import math
+
+import numpy as np
+
+from route_geometry import haversine_m
+
+
+
+# uniform lat/lon grid over the latest positions: moving a vehicle is a couple of
+# dict operations, and radius / k-nearest queries only look at the cells around
+# the query point, so cost follows local density instead of fleet size
+
+CELL_DEG = 0.01             # ~1.1 km north-south
+METRES_PER_DEG = 111320.0
+
+
+
+
+class GridIndex:
+
+    def __init__(self, cell_deg=CELL_DEG):
+        self.cell_deg = cell_deg
+        self.points = {}    # id -> (lat, lon, cell)
+        self.cells = {}     # cell -> {id: (lat, lon)}
+
+
+    def __len__(self):
+        return len(self.points)
+
+
+    def _cell(self, lat, lon):
+        return (math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg))
+
+
+    def upsert(self, key, lat, lon):
+        cell = self._cell(lat, lon)
+        previous = self.points.get(key)
+        if previous is not None and previous[2] != cell:
+            self._remove_from_cell(key, previous[2])
+        self.points[key] = (lat, lon, cell)
+        self.cells.setdefault(cell, {})[key] = (lat, lon)
+
+
+    def remove(self, key):
+        previous = self.points.pop(key, None)
+        if previous is not None:
+            self._remove_from_cell(key, previous[2])
+
+
+    def _remove_from_cell(self, key, cell):
+        members = self.cells[cell]
+        del members[key]
+        if not members:
+            del self.cells[cell]
+
+
+    def _ring(self, center, r):
+        # cells at chebyshev distance exactly r from center
+        ci, cj = center
+        if r == 0:
+            yield center
+            return
+        for dj in range(-r, r + 1):
+            yield (ci - r, cj + dj)
+            yield (ci + r, cj + dj)
+        for di in range(-r + 1, r):
+            yield (ci + di, cj - r)
+            yield (ci + di, cj + r)
+
+
+    def _distances(self, lat, lon, cells):
+        keys, lats, lons = [], [], []
+        for cell in cells:
+            members = self.cells.get(cell)
+            if members:
+                for key, (p_lat, p_lon) in members.items():
+                    keys.append(key)
+                    lats.append(p_lat)
+                    lons.append(p_lon)
+        if not keys:
+            return keys, np.empty(0)
+        return keys, haversine_m(lat, lon, np.array(lats), np.array(lons))
+
+
+    def within(self, lat, lon, radius_m, limit=None):
+        # [(key, distance_m), ...] nearest first
+        d_lat = radius_m / METRES_PER_DEG
+        d_lon = radius_m / (METRES_PER_DEG * max(math.cos(math.radians(lat)), 1e-6))
+        i0, j0 = self._cell(lat - d_lat, lon - d_lon)
+        i1, j1 = self._cell(lat + d_lat, lon + d_lon)
+        if (i1 - i0 + 1) * (j1 - j0 + 1) > len(self.cells):
+            # huge radius: walking the occupied cells is cheaper than the empty ones
+            cells = [c for c in self.cells if i0 <= c[0] <= i1 and j0 <= c[1] <= j1]
+        else:
+            cells = [(i, j) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1)]
+
+        keys, dist = self._distances(lat, lon, cells)
+        inside = np.flatnonzero(dist <= radius_m)
+        inside = inside[np.argsort(dist[inside], kind="stable")]
+        if limit is not None:
+            inside = inside[:limit]
+        return [(keys[i], float(dist[i])) for i in inside]
+
+
+    def nearest(self, lat, lon, k=1, max_radius_m=None):
+        # k nearest [(key, distance_m), ...]; grows square rings of cells until
+        # nothing unseen can be closer than the k-th best so far
+        if not self.points or k <= 0:
+            return []
+        center = self._cell(lat, lon)
+        keys, dist = [], np.empty(0)
+        r = 0
+        while True:
+            if (2 * r + 1) ** 2 > len(self.cells):
+                # sparse index: scanning the occupied cells beats walking more empty rings
+                keys, dist = self._distances(lat, lon, list(self.cells))
+                break
+            ring_keys, ring_dist = self._distances(lat, lon, self._ring(center, r))
+            keys += ring_keys
+            dist = np.concatenate((dist, ring_dist))
+
+            # anything outside ring r is at least r cells away; a cell is narrowest
+            # east-west at the poleward edge of the rings walked so far
+            cos_lat = math.cos(math.radians(min(abs(lat) + (r + 1) * self.cell_deg, 89.0)))
+            reach = r * self.cell_deg * METRES_PER_DEG * cos_lat
+            if len(keys) >= k and np.partition(dist, k - 1)[k - 1] <= reach:
+                break
+            if max_radius_m is not None and reach >= max_radius_m:
+                break
+            r += 1
+
+        order = np.argsort(dist, kind="stable")[:k]
+        return [(keys[i], float(dist[i])) for i in order if max_radius_m is None or dist[i] <= max_radius_m]
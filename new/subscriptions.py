@@ -0,0 +1,96 @@
+# per-room state for the socket.io push in server.py. clients join "stop:<name>"
+# or "route:<id>" rooms, get one snapshot on join, then only the vehicles whose
+# quantized position/status changed since the last tick
+
+COORD_SCALE = 100000    # 1e-5 deg, ~1.1 m
+
+
+
+def stop_room(waypoint_name):
+    return f"stop:{waypoint_name}"
+
+
+
+def route_room(route_id):
+    return f"route:{route_id}"
+
+
+
+def parse_room(room):
+    # only for room names built by stop_room/route_room; client input goes through server._requested_rooms
+    kind, _, key = room.partition(":")
+    if kind == "route":
+        return kind, int(key)
+    return kind, key
+
+
+
+def quantize(vehicle):
+    return (
+        round(vehicle['latitude'] * COORD_SCALE),
+        round(vehicle['longitude'] * COORD_SCALE),
+        round(vehicle['heading'] or 0),
+        round(vehicle['speed_kmh'] or 0),
+        vehicle['status'],
+        vehicle['gps_status'],
+    )
+
+
+
+
+class RoomRegistry:
+
+    def __init__(self):
+        self.members = {}
+        self.rooms_of = {}
+        self.state = {}
+
+
+    def join(self, sid, room):
+        self.members.setdefault(room, set()).add(sid)
+        self.rooms_of.setdefault(sid, set()).add(room)
+
+
+    def leave(self, sid, room):
+        members = self.members.get(room)
+        if members is not None:
+            members.discard(sid)
+            if not members:
+                # nobody left to diff against
+                del self.members[room]
+                self.state.pop(room, None)
+        rooms = self.rooms_of.get(sid)
+        if rooms is not None:
+            rooms.discard(room)
+            if not rooms:
+                del self.rooms_of[sid]
+
+
+    def drop(self, sid):
+        for room in list(self.rooms_of.get(sid, ())):
+            self.leave(sid, room)
+
+
+    def active_rooms(self):
+        return list(self.members)
+
+
+    def has_state(self, room):
+        return room in self.state
+
+
+    def update(self, room, vehicles):
+        # returns the delta payload for this room, or None if nothing changed
+        previous = self.state.get(room, {})
+        current = {v['vehicle_id']: quantize(v) for v in vehicles}
+        self.state[room] = current
+
+        changed = [[vehicle_id, *q] for vehicle_id, q in current.items() if previous.get(vehicle_id) != q]
+        removed = [vehicle_id for vehicle_id in previous if vehicle_id not in current]
+        if not changed and not removed:
+            return None
+        return {"r": room, "u": changed, "d": removed}
+
+
+    def snapshot(self, room):
+        return {"r": room, "u": [[vehicle_id, *q] for vehicle_id, q in self.state.get(room, {}).items()], "d": []}
@@ -0,0 +1,161 @@
+import struct
+
+import numpy as np
+
+
+
+# opt-in binary encoding of the 'snapshot'/'delta' room payloads from
+# subscriptions.RoomRegistry. clients ask for it on connect
+# (io.connect(url, {auth: {format: 'binary'}})) and get a 'format' event back
+# with what the server picked plus the status codebooks.
+#
+# each binary connection has its own vehicle-id dictionary: an id goes over the
+# wire once, after that the connection only sees its u32 index. a frame is
+# (little-endian):
+#   header   version u8, kind u8, room length u16, new ids u16, updates u32, removed u32
+#   room     utf-8
+#   new ids  per id: index u32, length u8, utf-8 (ids over 255 bytes are rejected)
+#   indices  updates x u32
+#   records  updates x RECORD (13 bytes, fixed-point, same quantization as the json rows)
+#   removed  removed x u32
+# records don't depend on the connection, so they're packed once per room and
+# only the index columns are per connection
+
+FORMATS = ("json", "binary")
+WIRE_VERSION = 1
+KIND_SNAPSHOT, KIND_DELTA = 0, 1
+KINDS = {"snapshot": KIND_SNAPSHOT, "delta": KIND_DELTA}
+
+STATUS_CODES = ("initializing", "moving", "stopped", "finished")
+GPS_STATUS_CODES = ("functional",)
+UNKNOWN_CODE = 255
+
+HEADER = struct.Struct("<BBHHII")
+NEW_ID = struct.Struct("<IB")
+RECORD = np.dtype([
+    ("lat", "<i4"),         # 1e-5 deg, subscriptions.COORD_SCALE
+    ("lon", "<i4"),
+    ("heading", "<u2"),     # whole degrees
+    ("speed", "u1"),        # km/h, clamped to 255
+    ("status", "u1"),       # index into STATUS_CODES, UNKNOWN_CODE otherwise
+    ("gps_status", "u1"),   # index into GPS_STATUS_CODES
+])
+
+_status_code = {s: i for i, s in enumerate(STATUS_CODES)}
+_gps_status_code = {s: i for i, s in enumerate(GPS_STATUS_CODES)}
+
+
+
+
+def negotiate(requested):
+    # requested: a format name or a list in order of preference; json unless binary is asked for
+    if isinstance(requested, str):
+        requested = [requested]
+    return next((f for f in requested or () if f in FORMATS), "json")
+
+
+
+def format_info(fmt):
+    return {"format": fmt, "version": WIRE_VERSION, "statuses": STATUS_CODES, "gps_statuses": GPS_STATUS_CODES}
+
+
+
+def pack_records(rows):
+    # rows as in RoomRegistry payloads: [vehicle_id, lat_q, lon_q, heading, speed, status, gps_status]
+    records = np.empty(len(rows), dtype=RECORD)
+    if rows:
+        records["lat"] = [row[1] for row in rows]
+        records["lon"] = [row[2] for row in rows]
+        records["heading"] = [row[3] % 360 for row in rows]
+        records["speed"] = [min(max(row[4], 0), 255) for row in rows]
+        records["status"] = [_status_code.get(row[5], UNKNOWN_CODE) for row in rows]
+        records["gps_status"] = [_gps_status_code.get(row[6], UNKNOWN_CODE) for row in rows]
+    return records.tobytes()
+
+
+
+
+class Encoder:
+    # one per binary connection
+
+    def __init__(self):
+        self.ids = {}
+
+
+    def encode(self, event, payload, records=None):
+        # records: pack_records(payload["u"]) when the caller shares it across connections
+        if records is None:
+            records = pack_records(payload["u"])
+        room = payload["r"].encode()
+
+        new_ids = []
+        try:
+            # steady state: every vehicle already has an index on this connection
+            indices = [self.ids[row[0]] for row in payload["u"]]
+        except KeyError:
+            # checked in full before any index is handed out, so a rejected frame
+            # leaves the dictionary as the client last decoded it
+            unseen = {}
+            for row in payload["u"]:
+                vehicle_id = row[0]
+                if vehicle_id not in self.ids and vehicle_id not in unseen:
+                    encoded = vehicle_id.encode()
+                    # a truncated id could split a character or collide with another one
+                    if len(encoded) > 255:
+                        raise ValueError(f"Vehicle id longer than 255 bytes: {vehicle_id[:32]!r}...")
+                    unseen[vehicle_id] = encoded
+            if len(unseen) > 0xFFFF:
+                raise ValueError(f"Too many new vehicle ids in one frame: {len(unseen)}")
+            for vehicle_id, encoded in unseen.items():
+                index = self.ids[vehicle_id] = len(self.ids)
+                new_ids.append(NEW_ID.pack(index, len(encoded)) + encoded)
+            indices = [self.ids[row[0]] for row in payload["u"]]
+        indices = np.asarray(indices, dtype="<u4")
+        # a vehicle this connection never saw can't be on its map
+        removed = np.asarray([self.ids[v] for v in payload["d"] if v in self.ids], dtype="<u4")
+
+        return b"".join([
+            HEADER.pack(WIRE_VERSION, KINDS[event], len(room), len(new_ids), len(indices), len(removed)),
+            room, *new_ids, indices.tobytes(), records, removed.tobytes(),
+        ])
+
+
+
+
+class Decoder:
+    # python side of the decoder in templates/index.html, for tests and bench_wire_format.py
+
+    def __init__(self):
+        self.names = {}
+
+
+    def decode(self, frame):
+        version, kind, room_len, n_new, n_updates, n_removed = HEADER.unpack_from(frame)
+        if version != WIRE_VERSION:
+            raise ValueError(f"Unsupported wire format version {version}")
+        offset = HEADER.size
+        room = bytes(frame[offset:offset + room_len]).decode()
+        offset += room_len
+
+        for _ in range(n_new):
+            index, length = NEW_ID.unpack_from(frame, offset)
+            offset += NEW_ID.size
+            self.names[index] = bytes(frame[offset:offset + length]).decode()
+            offset += length
+
+        indices = np.frombuffer(frame, dtype="<u4", count=n_updates, offset=offset)
+        offset += 4 * n_updates
+        records = np.frombuffer(frame, dtype=RECORD, count=n_updates, offset=offset)
+        offset += RECORD.itemsize * n_updates
+        removed = np.frombuffer(frame, dtype="<u4", count=n_removed, offset=offset)
+
+        def code(codes, c):
+            return codes[c] if c < len(codes) else "unknown"
+
+        updates = [
+            [self.names[int(i)], int(r["lat"]), int(r["lon"]), int(r["heading"]), int(r["speed"]),
+             code(STATUS_CODES, r["status"]), code(GPS_STATUS_CODES, r["gps_status"])]
+            for i, r in zip(indices, records)
+        ]
+        event = "snapshot" if kind == KIND_SNAPSHOT else "delta"
+        return event, {"r": room, "u": updates, "d": [self.names[int(i)] for i in removed]}